@@ -0,0 +1,745 @@
+import io
+import os
+import re
+import sys
+import json
+import asyncio
+import sqlite3
+import hashlib
+import mimetypes
+import collections
+import concurrent.futures
+from werkzeug.datastructures import Headers
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, File, Data
+from werkzeug.sansio.request import Request
+from werkzeug.sansio.response import Response
+from werkzeug.utils import secure_filename
+
+# Make the project root importable when run as `python api/asgi.py`
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api.index import (app as flask_app, logger, sessions, get_db_connection, submit_write, run_write, log_write_failure,
+                       reindex_file, files_page, encrypt_user_file, decrypt_user_file,
+                       find_user, insert_user, update_password_hash, find_upload, BATCH_OPERATIONS, batch_stream,
+                       open_archive)
+from api.files import add_file, finish_file, link_duplicate, discard_file, log_action
+from api.chunk_store import (CHUNK_SIZE, UPLOAD_WRITE_WINDOW, append_chunk, prepare_chunk, get_manifest, stored_size,
+                             iter_file_range, iter_manifest_range)
+from api.stream_cipher import decrypt_pieces, plaintext_size, is_stream_encrypted
+from api.compression import choose_codec, decompress_after_decryption, file_codec
+from api.database import POOL_SIZE
+from api.envelope import key_resolver, stream_header
+from api.auth import AuthBusy, check_password, hash_new_password
+from api.resumable import MAX_PARTS, new_attempt_id, append_part_chunk, finish_part, discard_part
+from api.batch import ARCHIVE_TYPES, batch_items
+
+# Asyncio (ASGI) server for the file API: `uvicorn api.asgi:app`.
+#
+# Under gunicorn's sync workers every request holds a worker process for as
+# long as its client takes to send or receive the body, so a few slow
+# uploads stall the server. Here uploads, downloads, listings, encryption
+# and decryption are coroutines: request and response bodies move through
+# the event loop without tying up a thread, and only the blocking parts run
+# elsewhere. SQLite reads go to a small thread pool, hashing and decryption
+# to another, and writes to the single writer thread (api/database.py),
+# whose futures are awaited. One process can so hold thousands of
+# transfers, bounded by memory (about a chunk each) rather than threads.
+# Encryption and decryption run on a crypto thread from start to finish,
+# queueing their new chunks and the final swap for the writer as they go
+# (see api/rewrite.py).
+#
+# Logins and registrations await their bcrypt run on the auth pool
+# (api/auth.py), so a burst of them holds no thread here either.
+#
+# Every other route is answered by the Flask app in api/index.py, run in a
+# thread with its request and response buffered, and shares its sessions.
+DB_THREADS = int(os.environ.get("SFMS_ASYNC_DB_THREADS", POOL_SIZE))
+CRYPTO_THREADS = int(os.environ.get("SFMS_ASYNC_CRYPTO_THREADS", os.cpu_count() or 1))
+FLASK_THREADS = int(os.environ.get("SFMS_ASYNC_FLASK_THREADS", 8))
+# Largest body read into memory: JSON requests and requests for Flask routes
+MAX_BUFFERED_BODY = 1024 * 1024
+
+_db_executor = concurrent.futures.ThreadPoolExecutor(DB_THREADS, thread_name_prefix="asgi-db")
+_crypto_executor = concurrent.futures.ThreadPoolExecutor(CRYPTO_THREADS, thread_name_prefix="asgi-crypto")
+_flask_executor = concurrent.futures.ThreadPoolExecutor(FLASK_THREADS, thread_name_prefix="asgi-flask")
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def _offload(executor, fn, *args):
+    return asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def _write(fn, *args):
+    """Queue a write; awaiting the result doesn't block the event loop"""
+    return asyncio.wrap_future(submit_write(fn, *args))
+
+
+def _write_chunk(data, codec, fn, *args):
+    """Prepare a chunk on the crypto threads (see prepare_chunk), then queue the write `fn(cursor, *args, chunk)`
+
+    Returns a task, so the chunk is on its way while the next one is read.
+    """
+    async def write():
+        chunk = await _offload(_crypto_executor, prepare_chunk, data, codec, run_write)
+        return await _write(fn, *args, chunk)
+    return asyncio.ensure_future(write())
+
+
+def _request(scope):
+    """Parse the headers and query string of a request (but not its body)"""
+    headers = Headers([(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']])
+    client = scope.get('client')
+    return Request(scope['method'], scope.get('scheme', 'http'), scope.get('server'), scope.get('root_path', ''),
+                   scope['path'], scope.get('query_string', b''), headers, client[0] if client else None)
+
+
+async def _start_response(send, request, response):
+    origin = request.headers.get('Origin')
+    if origin:
+        # As flask_cors does for the Flask routes, with credentials allowed
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers.add('Vary', 'Origin')
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response.headers.items()]})
+
+
+async def _send_json(send, request, body, status=200, response=None):
+    """Send `body` as JSON; `response` can carry extra headers or cookies"""
+    data = json.dumps(body).encode('utf-8')
+    response = response or Response(status=status)
+    response.mimetype = 'application/json'
+    response.headers['Content-Length'] = str(len(data))
+    await _start_response(send, request, response)
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def _iter_body(receive):
+    """Yield the request body as it arrives"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionResetError("Client disconnected")
+        if message.get('body'):
+            yield message['body']
+        if not message.get('more_body'):
+            return
+
+
+async def _read_body(receive, limit=MAX_BUFFERED_BODY):
+    body = bytearray()
+    async for piece in _iter_body(receive):
+        body += piece
+        if len(body) > limit:
+            raise BodyTooLarge(f"Request body is larger than {limit} bytes")
+    return bytes(body)
+
+
+async def _read_json(receive):
+    try:
+        return json.loads(await _read_body(receive))
+    except BodyTooLarge:
+        raise
+    except ValueError:
+        return None
+
+
+async def _iter_chunks(pieces, chunk_size=CHUNK_SIZE):
+    """Coalesce an async iterator of bytes into chunks the way chunk_store.iter_chunks does"""
+    buffer = bytearray()
+    async for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def _multipart_file(receive, boundary):
+    """Find the `file` part of a multipart/form-data body
+
+    Returns (filename, content type, async iterator over its bytes), or None
+    if there is no such part. Only the form fields before it are buffered.
+    """
+    decoder = MultipartDecoder(boundary, MAX_BUFFERED_BODY)
+
+    async def events():
+        async for piece in _iter_body(receive):
+            decoder.receive_data(piece)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                yield event
+                event = decoder.next_event()
+        decoder.receive_data(None)
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            yield event
+            event = decoder.next_event()
+
+    stream = events()
+    async for event in stream:
+        if isinstance(event, File) and event.name == 'file':
+            break
+    else:
+        return None
+
+    async def data():
+        async for part in stream:
+            if isinstance(part, Data):
+                if part.data:
+                    yield part.data
+                if not part.more_data:
+                    return
+
+    return event.filename, event.headers.get('Content-Type') or 'application/octet-stream', data()
+
+
+async def save_upload(user_id, filename, file_type, pieces, expected_hash=None):
+    """Counterpart of api.index.save_upload for an async iterator of bytes"""
+    codec = choose_codec(file_type, filename)
+    if expected_hash:
+        linked = await _write(link_duplicate, user_id, filename, file_type, codec, expected_hash)
+        if linked is not None:
+            return linked + (True,)
+
+    file_id = await _write(add_file, user_id, filename, file_type, codec)
+    try:
+        file_size, content_hash = await _write_chunks(
+            pieces, lambda seq, data: _write_chunk(data, codec, append_chunk, file_id, seq))
+        if expected_hash and content_hash != expected_hash:
+            raise ValueError("Content does not match X-Content-SHA256")
+        await _write(finish_file, file_id, content_hash, file_size)
+        return file_id, file_size, False
+    except BaseException:
+        # Also reached when the client goes away, so nothing here is awaited.
+        # The writer runs jobs in order: chunks still queued are skipped or
+        # written before the upload is discarded.
+        submit_write(discard_file, file_id).add_done_callback(log_write_failure)
+        raise
+
+
+async def _write_chunks(pieces, write_chunk):
+    """Counterpart of api.index.write_chunks for an async iterator of bytes
+
+    Chunks are hashed on the crypto threads and written by the writer
+    thread, at most UPLOAD_WRITE_WINDOW of them queued at a time, so a
+    fast client waits on the database rather than filling memory. On
+    failure the queued writes that haven't started are cancelled.
+    """
+    pending = collections.deque()
+    try:
+        digest = hashlib.sha256()
+        size = 0
+        seq = 0
+        async for data in _iter_chunks(pieces):
+            await _offload(_crypto_executor, digest.update, data)
+            pending.append(write_chunk(seq, data))
+            if len(pending) >= UPLOAD_WRITE_WINDOW:
+                await pending.popleft()
+            size += len(data)
+            seq += 1
+        while pending:
+            await pending.popleft()
+        return size, digest.hexdigest()
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+
+
+async def upload(request, receive, send, user_id):
+    content_hash = None
+    if request.mimetype != 'multipart/form-data':
+        filename = secure_filename(request.args.get('filename', ''))
+        if not filename:
+            return await _send_json(send, request, {'success': False, 'message': 'Filename is required'})
+        file_type = request.mimetype
+        if not file_type or file_type == 'application/octet-stream':
+            file_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        pieces = _iter_body(receive)
+        content_hash = request.headers.get('X-Content-SHA256', '').strip().lower()
+    else:
+        boundary = request.mimetype_params.get('boundary', '').encode('latin-1')
+        part = await _multipart_file(receive, boundary) if boundary else None
+        if part is None:
+            return await _send_json(send, request, {'success': False, 'message': 'No file part'})
+        filename, file_type, pieces = part
+        if not filename:
+            return await _send_json(send, request, {'success': False, 'message': 'No selected file'})
+        filename = secure_filename(filename)
+
+    try:
+        file_id, file_size, deduplicated = await save_upload(user_id, filename, file_type, pieces, content_hash)
+        await _offload(_db_executor, reindex_file, file_id)
+        body = {'success': True, 'message': 'File uploaded successfully', 'id': file_id, 'size': file_size,
+                'deduplicated': deduplicated}
+    except sqlite3.IntegrityError:
+        body = {'success': False, 'message': 'A file with this name already exists'}
+    except ConnectionResetError:
+        raise
+    except Exception as e:
+        body = {'success': False, 'message': f'Upload failed: {str(e)}'}
+    await _send_json(send, request, body)
+
+
+async def save_part(upload, part_number, pieces, expected_hash=None):
+    """Counterpart of api.index.save_part for an async iterator of bytes"""
+    upload_id = upload['upload_id']
+    attempt = new_attempt_id()
+    try:
+        size, content_hash = await _write_chunks(pieces, lambda seq, data: _write_chunk(
+            data, upload['codec'], append_part_chunk, upload_id, part_number, attempt, seq))
+        if expected_hash and content_hash != expected_hash:
+            raise ValueError("Content does not match X-Content-SHA256")
+        await _write(finish_part, upload_id, part_number, attempt, size, content_hash)
+        return size, content_hash
+    except BaseException:
+        submit_write(discard_part, upload_id, part_number, attempt).add_done_callback(log_write_failure)
+        raise
+
+
+async def upload_part(request, receive, send, user_id, upload_id, part_number):
+    part_number = int(part_number)
+    if not 1 <= part_number <= MAX_PARTS:
+        return await _send_json(send, request, {'success': False, 'message': f'Part numbers go from 1 to {MAX_PARTS}'})
+    upload = await _offload(_db_executor, find_upload, user_id, upload_id)
+    if upload is None:
+        return await _send_json(send, request, {'success': False, 'message': 'Upload not found'})
+
+    try:
+        size, content_hash = await save_part(upload, part_number, _iter_body(receive),
+                                             request.headers.get('X-Content-SHA256', '').strip().lower())
+        body = {'success': True, 'part_number': part_number, 'size': size, 'sha256': content_hash}
+    except LookupError:
+        body = {'success': False, 'message': 'Upload not found'}
+    except ConnectionResetError:
+        raise
+    except Exception as e:
+        body = {'success': False, 'message': f'Part upload failed: {str(e)}'}
+    await _send_json(send, request, body)
+
+
+async def get_files(request, receive, send, user_id):
+    try:
+        body = await _offload(_db_executor, files_page, user_id, request.args)
+    except ValueError as e:
+        body = {'success': False, 'message': str(e)}
+    except Exception as e:
+        body = {'success': False, 'message': f'Failed to get files: {str(e)}'}
+    await _send_json(send, request, body)
+
+
+def _find_download(user_id, filename):
+    """(id, type, etag, stored length, manifest) of a user's file, or None"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, file_type, content_hash FROM files WHERE file_name = ? AND user_id = ?",
+                       (filename, user_id))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        file_id, file_type, content_hash = result
+        length = stored_size(cursor, file_id)
+        return file_id, file_type, content_hash or f"legacy-{file_id}-{length}", length, get_manifest(cursor, file_id)
+    finally:
+        if 'VERCEL' not in os.environ:
+            conn.close()
+
+
+def _read_pieces(file_id, manifest, start, stop):
+    """Yield bytes [start, stop) of a file a chunk at a time, borrowing a connection for each
+
+    Holding one connection for a whole transfer would let a few dozen slow
+    downloads exhaust the pool. The manifest is the one read when the
+    download started, so a file rewritten meanwhile is still served whole.
+    """
+    if manifest:
+        spans = []
+        offset = 0
+        for entry in manifest:
+            size = entry[1]
+            if offset + size > start and offset < stop:
+                spans.append(([entry], max(start - offset, 0), min(stop - offset, size)))
+            offset += size
+    else:
+        # Inline data of a file the migration hasn't moved yet
+        spans = [(None, offset, min(offset + CHUNK_SIZE, stop)) for offset in range(start, stop, CHUNK_SIZE)]
+    for entries, span_start, span_stop in spans:
+        conn = get_db_connection()
+        try:
+            if entries:
+                pieces = iter_manifest_range(conn.cursor(), entries, span_start, span_stop)
+            else:
+                pieces = iter_file_range(conn.cursor(), file_id, span_start, span_stop)
+            data = b"".join(pieces)
+        finally:
+            if 'VERCEL' not in os.environ:
+                conn.close()
+        yield data
+
+
+def _open_plaintext(file_id, manifest, length, password, user_id):
+    """Start decrypting a file; returns (first piece, iterator over the rest, plaintext length)
+
+    Raises ValueError if the file isn't encrypted or the password is wrong.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        header = stream_header(cursor, file_id)
+        if header is None:
+            raise ValueError('File is not encrypted')
+        codec = file_codec(cursor, file_id)
+        plaintext = decompress_after_decryption(
+            decrypt_pieces(_read_pieces(file_id, manifest, 0, length), password,
+                           key=key_resolver(cursor, password, scope=user_id)),
+            codec)
+        try:
+            # Authenticates the first segment (and looks up the key) before committing to a response
+            first = next(plaintext)
+        except Exception:
+            raise ValueError('Decryption failed. Incorrect password!')
+        if codec and not is_stream_encrypted(first):
+            cursor.execute("SELECT file_size FROM files WHERE id = ?", (file_id,))
+            content_length = cursor.fetchone()[0]
+        else:
+            content_length = plaintext_size(length, header)
+        return first, plaintext, content_length
+    finally:
+        if 'VERCEL' not in os.environ:
+            conn.close()
+
+
+async def _send_pieces(send, pieces, executor, first=b""):
+    """Stream a blocking iterator as the response body, stepping it on `executor`"""
+    if first:
+        await send({'type': 'http.response.body', 'body': first, 'more_body': True})
+    while True:
+        piece = await _offload(executor, next, pieces, None)
+        if piece is None:
+            break
+        if piece:
+            # Waits while the client's socket buffer is full
+            await send({'type': 'http.response.body', 'body': piece, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def download(request, receive, send, user_id):
+    filename = request.args.get('filename')
+    if not filename:
+        return await _send_json(send, request, {'success': False, 'message': 'Filename is required'})
+
+    try:
+        found = await _offload(_db_executor, _find_download, user_id, filename)
+    except Exception as e:
+        return await _send_json(send, request, {'success': False, 'message': f'Download failed: {str(e)}'})
+    if not found:
+        return await _send_json(send, request, {'success': False, 'message': 'File not found'})
+    file_id, file_type, etag, length, manifest = found
+
+    password = request.headers.get('X-File-Password')
+    if password:
+        try:
+            first, plaintext, content_length = await _offload(_crypto_executor, _open_plaintext, file_id, manifest,
+                                                              length, password, user_id)
+        except ValueError as e:
+            return await _send_json(send, request, {'success': False, 'message': str(e)})
+        response = Response(mimetype=file_type)
+        response.headers['Content-Length'] = str(content_length)
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+        response.set_etag(f"{etag}-plain", weak=True)
+        await _start_response(send, request, response)
+        return await _send_pieces(send, plaintext, _crypto_executor, first)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        await _start_response(send, request, response)
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    # Honour a single byte range unless If-Range says the file has changed
+    start, stop = 0, length
+    partial = False
+    if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        if_range = request.if_range
+        if not (if_range.etag or if_range.date) or if_range.etag == etag:
+            byte_range = request.range.range_for_length(length)
+            if byte_range is None:
+                response = Response(status=416)
+                response.headers['Content-Range'] = f'bytes */{length}'
+                response.headers['Content-Length'] = '0'
+                await _start_response(send, request, response)
+                return await send({'type': 'http.response.body', 'body': b''})
+            start, stop = byte_range
+            partial = True
+
+    # Log the download once, not for every follow-up range request
+    if start == 0:
+        submit_write(log_action, file_id, 'Downloaded').add_done_callback(log_write_failure)
+
+    response = Response(status=206 if partial else 200, mimetype=file_type)
+    response.headers['Content-Length'] = str(stop - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if partial:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.set_etag(etag)
+    await _start_response(send, request, response)
+    await _send_pieces(send, _read_pieces(file_id, manifest, start, stop), _db_executor)
+
+
+async def encrypt(request, receive, send, user_id):
+    data = await _read_json(receive) or {}
+    filename = data.get('filename')
+    password = data.get('password')
+    if not filename or not password:
+        return await _send_json(send, request, {'success': False, 'message': 'Filename and password are required'})
+
+    try:
+        if await _offload(_crypto_executor, encrypt_user_file, user_id, filename, password):
+            body = {'success': True, 'message': 'File encrypted successfully'}
+        else:
+            body = {'success': False, 'message': 'File not found'}
+    except Exception as e:
+        body = {'success': False, 'message': f'Encryption failed: {str(e)}'}
+    await _send_json(send, request, body)
+
+
+async def decrypt(request, receive, send, user_id):
+    data = await _read_json(receive) or {}
+    filename = data.get('filename')
+    password = data.get('password')
+    if not filename or not password:
+        return await _send_json(send, request, {'success': False, 'message': 'Filename and password are required'})
+
+    try:
+        file_id = await _offload(_crypto_executor, decrypt_user_file, user_id, filename, password)
+    except Exception:
+        # As in the Flask route, the file keeps its contents
+        return await _send_json(send, request, {'success': False, 'message': 'Decryption failed. Incorrect password!'})
+    if not file_id:
+        return await _send_json(send, request, {'success': False, 'message': 'File not found'})
+    await _offload(_db_executor, reindex_file, file_id)
+    await _send_json(send, request, {'success': True, 'message': 'File decrypted successfully'})
+
+
+async def _send_auth_busy(send, request):
+    response = Response(status=503)
+    response.headers['Retry-After'] = '1'
+    await _send_json(send, request, {'success': False, 'message': 'Too many logins in progress, try again shortly'},
+                     response=response)
+
+
+async def register(request, receive, send):
+    data = await _read_json(receive) or {}
+    username = data.get('username')
+    password = data.get('password')
+    if not username or not password:
+        return await _send_json(send, request, {'success': False, 'message': 'Username and password are required'})
+
+    try:
+        hashed_password = await asyncio.wrap_future(hash_new_password(password))
+        await _write(insert_user, username, hashed_password)
+        body = {'success': True, 'message': f'User {username} registered successfully'}
+    except AuthBusy:
+        return await _send_auth_busy(send, request)
+    except sqlite3.IntegrityError:
+        body = {'success': False, 'message': 'Username already exists'}
+    except Exception as e:
+        body = {'success': False, 'message': f'Registration failed: {str(e)}'}
+    await _send_json(send, request, body)
+
+
+async def login(request, receive, send):
+    data = await _read_json(receive) or {}
+    username = data.get('username')
+    password = data.get('password')
+    if not username or not password:
+        return await _send_json(send, request, {'success': False, 'message': 'Username and password are required'})
+
+    invalid = {'success': False, 'message': 'Invalid username or password'}
+    try:
+        result = await _offload(_db_executor, find_user, username)
+        if result is None:
+            return await _send_json(send, request, invalid)
+        ok, new_hash = await asyncio.wrap_future(check_password(username, password, result[1]))
+        if not ok:
+            return await _send_json(send, request, invalid)
+        if new_hash:
+            submit_write(update_password_hash, result[0], new_hash).add_done_callback(log_write_failure)
+        session_id = await _offload(_db_executor, sessions.create, result[0], username)
+    except AuthBusy:
+        return await _send_auth_busy(send, request)
+    except Exception as e:
+        return await _send_json(send, request, {'success': False, 'message': f'Login failed: {str(e)}'})
+    response = Response()
+    response.set_cookie('session_id', session_id, httponly=True, secure=True, samesite='None')
+    await _send_json(send, request, {'success': True, 'message': 'Login successful', 'session_id': session_id},
+                     response=response)
+
+
+# (path, method) -> handler(request, receive, send); no session needed
+PUBLIC_ROUTES = {
+    ('/api/register', 'POST'): register,
+    ('/api/login', 'POST'): login,
+}
+
+async def batch(request, receive, send, user_id, operation):
+    data = await _read_json(receive) or {}
+    try:
+        items = batch_items(data.get('files'))
+    except ValueError as e:
+        return await _send_json(send, request, {'success': False, 'message': str(e)})
+
+    # The streams block on the writer and on reads, so they are stepped on the database threads
+    if operation == 'archive':
+        archive_format = data.get('format', 'zip')
+        try:
+            pieces, error = await _offload(_db_executor, open_archive, user_id, items, archive_format)
+        except Exception as e:
+            return await _send_json(send, request, {'success': False, 'message': f'Archive failed: {str(e)}'})
+        if error:
+            return await _send_json(send, request, {'success': False, 'message': error})
+        response = Response(mimetype=ARCHIVE_TYPES[archive_format])
+        response.headers.set('Content-Disposition', 'attachment', filename=f'files.{archive_format}')
+    else:
+        password = data.get('password')
+        if operation != 'delete' and not password:
+            return await _send_json(send, request, {'success': False, 'message': 'Password is required'})
+        pieces = batch_stream(user_id, operation, items, password)
+        response = Response(mimetype='application/x-ndjson')
+    await _start_response(send, request, response)
+    await _send_pieces(send, pieces, _db_executor)
+
+
+# (path, method) -> handler(request, receive, send, user_id); all need a session
+ROUTES = {
+    ('/api/upload', 'POST'): upload,
+    ('/api/upload', 'PUT'): upload,
+    ('/api/files', 'GET'): get_files,
+    ('/api/download', 'GET'): download,
+    ('/api/encrypt', 'POST'): encrypt,
+    ('/api/decrypt', 'POST'): decrypt,
+}
+# As ROUTES for paths with parameters, which are passed to the handler after user_id
+PATTERN_ROUTES = [
+    (re.compile(r'/api/uploads/([^/]+)/parts/(\d+)'), 'PUT', upload_part),
+    (re.compile(f"/api/batch/({'|'.join(BATCH_OPERATIONS + ('archive',))})"), 'POST', batch),
+]
+
+
+def _find_route(path, method):
+    """(handler, path parameters) for a route needing a session, or (None, ())"""
+    handler = ROUTES.get((path, method))
+    if handler is not None:
+        return handler, ()
+    for pattern, route_method, handler in PATTERN_ROUTES:
+        match = pattern.fullmatch(path)
+        if match and method == route_method:
+            return handler, match.groups()
+    return None, ()
+
+
+def _wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0] if client else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        if key in environ:
+            value = environ[key] + ('; ' if name == 'COOKIE' else ', ') + value
+        environ[key] = value
+    return environ
+
+
+def _call_flask(environ):
+    """Run the Flask app on a WSGI environ; returns (status, headers, body)"""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+
+    result = flask_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started[0], started[1], body
+
+
+async def _flask_route(scope, receive, send):
+    body = await _read_body(receive)
+    status, headers, data = await _offload(_flask_executor, _call_flask, _wsgi_environ(scope, body))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for executor in (_db_executor, _crypto_executor, _flask_executor):
+                executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    request = _request(scope)
+    try:
+        public = PUBLIC_ROUTES.get((scope['path'], scope['method']))
+        if public is not None:
+            return await public(request, receive, send)
+        handler, parameters = _find_route(scope['path'], scope['method'])
+        if handler is None:
+            return await _flask_route(scope, receive, send)
+        session_id = request.cookies.get('session_id')
+        # Only a session this process hasn't seen lately needs a database read
+        session = sessions.get_cached(session_id) or await _offload(_db_executor, sessions.load, session_id)
+        if session is None:
+            return await _send_json(send, request, {'success': False, 'message': 'Please login first'})
+        await handler(request, receive, send, session['user_id'], *parameters)
+    except BodyTooLarge as e:
+        await _send_json(send, request, {'error': 'Payload Too Large', 'message': str(e)}, 413)
+    except ConnectionResetError:
+        logger.info(f"Client went away during {scope['method']} {scope['path']}")
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run("api.asgi:app", host="127.0.0.1", port=int(os.environ.get("PORT", 8000)))
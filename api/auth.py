@@ -0,0 +1,169 @@
+import os
+import hmac
+import time
+import hashlib
+import threading
+import collections
+import concurrent.futures
+import bcrypt
+
+# Password hashing and checking.
+#
+# bcrypt is deliberately slow (a quarter of a second of CPU at the default
+# cost), so it runs on a small dedicated pool rather than on whichever
+# thread received the request. At most AUTH_WORKERS hashes run at once and
+# the rest of the server keeps its CPU share under a burst of logins. Once
+# AUTH_QUEUE_LIMIT jobs are waiting, new ones are refused with AuthBusy, so
+# a login storm gets fast "try again" answers instead of a growing queue.
+#
+# Successful checks are remembered for AUTH_CACHE_TTL seconds, keyed by an
+# HMAC of the password under a per-process secret and by the stored hash
+# (so a password change invalidates them). Failed checks are never cached,
+# so guessing still costs a full bcrypt run per attempt. Requests after
+# login carry a session id and don't involve passwords at all.
+#
+# Hashes made with a cost factor other than BCRYPT_ROUNDS are replaced the
+# next time their owner logs in.
+BCRYPT_ROUNDS = int(os.environ.get("SFMS_BCRYPT_ROUNDS", 12))
+AUTH_WORKERS = int(os.environ.get("SFMS_AUTH_WORKERS", os.cpu_count() or 1))
+AUTH_QUEUE_LIMIT = int(os.environ.get("SFMS_AUTH_QUEUE_LIMIT", 64))
+AUTH_CACHE_SIZE = int(os.environ.get("SFMS_AUTH_CACHE_SIZE", 1024))
+AUTH_CACHE_TTL = int(os.environ.get("SFMS_AUTH_CACHE_TTL", 300))
+
+
+class AuthBusy(Exception):
+    """Too many password checks are already waiting"""
+
+
+class AuthPool:
+    """Runs password hashing on `workers` threads, refusing work beyond `max_pending` queued or running jobs"""
+
+    def __init__(self, workers=AUTH_WORKERS, max_pending=AUTH_QUEUE_LIMIT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.completed = 0
+        self.rejected = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="auth")
+
+    def submit(self, fn, *args):
+        """Queue `fn(*args)`; returns a Future, or raises AuthBusy if the queue is full"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise AuthBusy(f"{self._pending} password checks are already waiting")
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'pending': self._pending, 'max_pending': self.max_pending,
+                    'completed': self.completed, 'rejected': self.rejected}
+
+
+class VerifyCache:
+    """Bounded LRU of recently verified (username, stored hash, password) triples, expiring after `ttl` seconds"""
+
+    def __init__(self, max_entries=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Passwords are only ever kept as an HMAC under a per-process secret
+        self._secret = os.urandom(32)
+
+    def _key(self, username, hashed, password):
+        return username, bytes(hashed), hmac.new(self._secret, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def contains(self, username, hashed, password):
+        key = self._key(username, hashed, password)
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires and expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            if expires:
+                del self._entries[key]
+            self.misses += 1
+        return False
+
+    def add(self, username, hashed, password):
+        if self.max_entries <= 0:
+            return
+        key = self._key(username, hashed, password)
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {'entries': size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+auth_pool = AuthPool()
+verify_cache = VerifyCache()
+
+
+def hash_password(password, rounds=None):
+    """bcrypt hash of a password at `rounds` (default BCRYPT_ROUNDS); slow, so call it on the auth pool"""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds or BCRYPT_ROUNDS))
+
+
+def hash_rounds(hashed):
+    """Cost factor a bcrypt hash was made with"""
+    return int(bytes(hashed).split(b"$")[2])
+
+
+def _check(username, password, hashed):
+    if not bcrypt.checkpw(password.encode('utf-8'), hashed):
+        return False, None
+    if hash_rounds(hashed) != BCRYPT_ROUNDS:
+        return True, hash_password(password)
+    verify_cache.add(username, hashed, password)
+    return True, None
+
+
+def check_password(username, password, hashed, pool=None):
+    """Check a password against a user's stored hash on the auth pool
+
+    Returns a Future of (ok, new_hash). `new_hash` is set when the stored
+    hash used another cost factor and should be replaced. Raises AuthBusy
+    when the pool's queue is full.
+    """
+    hashed = hashed.encode('utf-8') if isinstance(hashed, str) else bytes(hashed)
+    if hash_rounds(hashed) == BCRYPT_ROUNDS and verify_cache.contains(username, hashed, password):
+        # Recently verified: no need to queue behind other logins
+        future = concurrent.futures.Future()
+        future.set_result((True, None))
+        return future
+    return (pool or auth_pool).submit(_check, username, password, hashed)
+
+
+def hash_new_password(password, pool=None):
+    """Hash a new password on the auth pool; returns a Future of the hash, or raises AuthBusy"""
+    return (pool or auth_pool).submit(hash_password, password)
+
+
+def auth_stats():
+    return {'pool': auth_pool.stats(), 'cache': verify_cache.stats()}
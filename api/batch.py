@@ -0,0 +1,243 @@
+import os
+import time
+import tarfile
+import zipfile
+import datetime
+import threading
+import collections
+import concurrent.futures
+from api.chunk_store import iter_file_range, stored_size
+
+# Operations over many files in one request.
+#
+# Batch encrypt, decrypt and delete group the files BATCH_GROUP to a write
+# job, so each group is a single transaction instead of one per file. Each
+# file gets its own savepoint inside it: a file that fails (wrong password,
+# already deleted) is rolled back alone and reported, and the rest of its
+# group still commits. A few groups are queued on the writer at a time so
+# it never waits for the request to submit the next one, and results are
+# yielded as each group commits, so they can be streamed to the client.
+#
+# The slow part of encrypting or decrypting a file, reading it and running
+# the cipher, doesn't go into that transaction. It is done first, a file
+# per task on a pool of BATCH_WORKERS threads shared by all batches, and
+# leaves the new contents staged (see api/rewrite.py). A group's write job
+# then only swaps them in. The pool is separate from the cipher's own
+# (api/stream_cipher.py), whose segment tasks these wait on.
+#
+# Archives are written as they are sent, one chunk of one file at a time,
+# so exporting a selection never builds the archive in memory or on disk.
+BATCH_GROUP = int(os.environ.get("SFMS_BATCH_GROUP", 50))
+BATCH_WORKERS = int(os.environ.get("SFMS_BATCH_WORKERS", min(4, os.cpu_count() or 1)))
+# Groups queued on the writer ahead of the one being reported
+BATCH_WINDOW = 4
+MAX_BATCH_FILES = 10000
+ARCHIVE_TYPES = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+# Archive output smaller than this is gathered up before being sent
+ARCHIVE_PIECE = 256 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def batch_items(files):
+    """Validate a request's list of file ids and names; returns it with duplicates removed"""
+    if not isinstance(files, list) or not files:
+        raise ValueError("files must be a non-empty list of file ids or names")
+    if len(files) > MAX_BATCH_FILES:
+        raise ValueError(f"At most {MAX_BATCH_FILES} files can be processed at once")
+    for item in files:
+        if isinstance(item, bool) or not isinstance(item, (int, str)) or item == "":
+            raise ValueError("files must be a non-empty list of file ids or names")
+    return list(dict.fromkeys(files))
+
+
+def find_file(cursor, user_id, item):
+    """(id, name) of a user's file given its id (an int) or name, or None"""
+    if isinstance(item, int):
+        cursor.execute("SELECT id, file_name FROM files WHERE id = ? AND user_id = ?", (item, user_id))
+    else:
+        cursor.execute("SELECT id, file_name FROM files WHERE file_name = ? AND user_id = ?", (item, user_id))
+    return cursor.fetchone()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max(1, BATCH_WORKERS), thread_name_prefix="batch")
+        return _executor
+
+
+def _run_group(cursor, job, discard, prepared):
+    results = []
+    for item, ok, value in prepared:
+        if not ok:
+            results.append((item, False, value))
+            continue
+        cursor.execute("SAVEPOINT batch_item")
+        try:
+            result = job(cursor, value)
+        except Exception as e:
+            cursor.execute("ROLLBACK TO batch_item")
+            cursor.execute("RELEASE batch_item")
+            if discard is not None:
+                discard(cursor, value)
+            results.append((item, False, str(e)))
+            continue
+        cursor.execute("RELEASE batch_item")
+        results.append((item, True, result))
+    return results
+
+
+def _prepared(item, future):
+    if future is None:
+        return item, True, item
+    try:
+        return item, True, future.result()
+    except Exception as e:
+        return item, False, str(e)
+
+
+def _submit_group(submit_write, job, discard, group, futures):
+    # Waits for the group's items to be prepared, then queues its write
+    prepared = [_prepared(item, future) for item, future in zip(group, futures)]
+    return submit_write(_run_group, job, discard, prepared), futures
+
+
+def _discard_later(submit_write, discard, future):
+    # Prepared work that will never be applied
+    def finished(future):
+        if not future.cancelled() and future.exception() is None:
+            submit_write(discard, future.result())
+    future.add_done_callback(finished)
+
+
+def run_batch(submit_write, job, items, prepare=None, discard=None, group_size=BATCH_GROUP, window=BATCH_WINDOW):
+    """Run the write job `job(cursor, value)` for every item, `group_size` items per transaction
+
+    Without `prepare` the value is the item itself. Otherwise it is what
+    `prepare(item)` returns, run beforehand on the batch pool; an item it
+    raises for is reported failed without a write. `discard(cursor, value)`
+    undoes a prepared value that isn't applied after all.
+
+    `submit_write(fn, *args)` queues a write and returns its Future. Yields
+    (item, ok, result) in order as groups commit; for a failed item the
+    result is the error message. Work not yet started is cancelled if the
+    caller stops iterating.
+    """
+    executor = _get_executor() if prepare is not None else None
+    preparing = collections.deque()
+    committing = collections.deque()
+    try:
+        for start in range(0, len(items), group_size):
+            group = items[start:start + group_size]
+            preparing.append((group, [executor.submit(prepare, item) if executor else None for item in group]))
+            # A few groups are prepared ahead of the one being written
+            if len(preparing) < window:
+                continue
+            committing.append(_submit_group(submit_write, job, discard, *preparing.popleft()))
+            while committing and (len(committing) >= window or committing[0][0].done()):
+                yield from committing.popleft()[0].result()
+        while preparing:
+            committing.append(_submit_group(submit_write, job, discard, *preparing.popleft()))
+        while committing:
+            yield from committing.popleft()[0].result()
+    finally:
+        for _, futures in preparing:
+            for future in futures:
+                if future is not None and not future.cancel() and discard is not None:
+                    _discard_later(submit_write, discard, future)
+        for write, futures in committing:
+            if write.cancel() and discard is not None:
+                for future in futures:
+                    if future is not None:
+                        _discard_later(submit_write, discard, future)
+
+
+def archive_entries(cursor, user_id, items):
+    """Look up the files to archive; returns ([(id, name, size, timestamp)], [items not found])"""
+    entries = []
+    missing = []
+    for item in items:
+        found = find_file(cursor, user_id, item)
+        if found is None:
+            missing.append(item)
+            continue
+        file_id, name = found
+        cursor.execute("SELECT timestamp FROM files WHERE id = ?", (file_id,))
+        timestamp = cursor.fetchone()[0]
+        entries.append((file_id, name, stored_size(cursor, file_id), timestamp))
+    return entries, missing
+
+
+def _mtime(timestamp):
+    try:
+        return datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return datetime.datetime.now()
+
+
+class _Sink:
+    """Write-only file object collecting what an archive writer produces until it is drained"""
+
+    def __init__(self):
+        self._pieces = []
+
+    def write(self, data):
+        self._pieces.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._pieces)
+        self._pieces.clear()
+        return data
+
+
+def iter_archive(cursor, entries, archive_format):
+    """Yield a ZIP or TAR of `entries` (from archive_entries) as it is written
+
+    Files are stored as they are kept, so encrypted files stay encrypted.
+    ZIP entries aren't compressed again: most of the bytes have already
+    been through the upload codec or are ciphertext.
+    """
+    if archive_format not in ARCHIVE_TYPES:
+        raise ValueError(f"Unknown archive format {archive_format}; use one of {', '.join(ARCHIVE_TYPES)}")
+    buffer = bytearray()
+    for piece in _iter_archive(cursor, entries, archive_format):
+        buffer += piece
+        if len(buffer) >= ARCHIVE_PIECE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def _iter_archive(cursor, entries, archive_format):
+    sink = _Sink()
+    if archive_format == 'zip':
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+            for file_id, name, size, timestamp in entries:
+                info = zipfile.ZipInfo(name, _mtime(timestamp).timetuple()[:6])
+                info.file_size = size
+                with archive.open(info, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                    for piece in iter_file_range(cursor, file_id):
+                        member.write(piece)
+                        yield sink.drain()
+        yield sink.drain()
+    elif archive_format == 'tar':
+        # tarfile's stream mode would buffer a whole member, so the headers
+        # come from it and the data and padding are written here
+        for file_id, name, size, timestamp in entries:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = time.mktime(_mtime(timestamp).timetuple())
+            info.mode = 0o644
+            yield info.tobuf(tarfile.PAX_FORMAT)
+            for piece in iter_file_range(cursor, file_id):
+                yield piece
+            yield tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+        yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
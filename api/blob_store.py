@@ -0,0 +1,350 @@
+import os
+import sys
+import hmac
+import time
+import hashlib
+import logging
+import secrets
+import datetime
+import threading
+import http.client
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# Where chunk bytes are kept.
+#
+# The chunk store (api/chunk_store.py) keeps each distinct chunk's hash,
+# size, codec and refcount in SQLite. With the "sqlite" backend its bytes
+# sit in the same row, as they always have. The other backends keep them
+# outside the database as blobs named by the chunk hash, so the database
+# holds only metadata and backups, VACUUM, integrity checks and its page
+# cache no longer grow with the files stored:
+#
+#   local   a directory, fanned out by hash prefix (ab/cd/abcd...), each blob
+#           written to a temporary file and renamed into place
+#   s3      a bucket on S3 or any S3-compatible store, addressed path-style
+#
+# `chunks.location` names the backend holding a chunk, or is NULL when its
+# bytes are inline, so databases can mix both and inline chunks can be
+# moved out later (python -m api.blob_store).
+#
+# Uploads write a new chunk's blob before its row, outside the write
+# transaction, so the single writer never waits on the disk or the network
+# for it (see prepare_chunk in api/chunk_store.py). The blob is first
+# reserved: its hash goes into `blob_garbage` in a short write of its own,
+# and the chunk's row takes the reservation's place when it commits. A blob
+# whose row never does (the upload failed, its transaction rolled back, the
+# process died) is so swept like any other. Blobs are never deleted in the
+# transaction that drops their chunk, which might still roll back: the
+# hash goes to `blob_garbage` instead, and a sweep removes the blob later,
+# under the write lock and only if the chunk hasn't been stored again. The
+# sweep leaves blobs alone for BLOB_SWEEP_INTERVAL seconds after their
+# release or reservation, so downloads that already listed a chunk can
+# finish reading it and uploads can insert the row of a blob they wrote.
+STORAGE_BACKEND = os.environ.get("SFMS_STORAGE", "sqlite" if 'VERCEL' in os.environ else "local")
+STORAGE_PATH = os.environ.get("SFMS_STORAGE_PATH", "file_store")
+S3_ENDPOINT = os.environ.get("SFMS_S3_ENDPOINT", "")
+S3_BUCKET = os.environ.get("SFMS_S3_BUCKET", "")
+S3_PREFIX = os.environ.get("SFMS_S3_PREFIX", "")
+S3_REGION = os.environ.get("SFMS_S3_REGION", "us-east-1")
+S3_TIMEOUT = 60
+BLOB_SWEEP_INTERVAL = int(os.environ.get("SFMS_BLOB_SWEEP_INTERVAL", 600))
+# Released blobs removed per write transaction by a sweep
+SWEEP_BATCH = 200
+# Roughly how many bytes of inline chunks are moved out per transaction
+MOVE_BATCH_BYTES = 64 * 1024 * 1024
+
+
+def init_blob_tables(cursor):
+    """Create the table of released blobs if it doesn't exist"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS blob_garbage (
+                        hash TEXT PRIMARY KEY,
+                        location TEXT NOT NULL,
+                        released REAL NOT NULL
+                    ) WITHOUT ROWID''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_blob_garbage_released ON blob_garbage (released)")
+
+
+class LocalBlobs:
+    """Blobs as files under `root`, in two levels of directories named after the start of their hash"""
+
+    name = 'local'
+
+    def __init__(self, root=STORAGE_PATH):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers only ever see a missing or a complete blob
+        temporary = f"{path}.{secrets.token_hex(4)}.tmp"
+        try:
+            with open(temporary, 'wb') as blob:
+                blob.write(data)
+                blob.flush()
+                # The chunk's row may reach the disk before the data otherwise
+                os.fsync(blob.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key, start=0, end=None):
+        with open(self.path(key), 'rb') as blob:
+            if start:
+                blob.seek(start)
+            return blob.read() if end is None else blob.read(end - start)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+def _canonical_query(query):
+    return "&".join(f"{urllib.parse.quote(name, safe='-_.~')}={urllib.parse.quote(value, safe='-_.~')}"
+                    for name, value in sorted(query.items()))
+
+
+def sign_request(method, host, path, query, headers, body, region, access_key, secret_key, now=None):
+    """Return `headers` plus the AWS Signature Version 4 headers for an S3 request"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{amz_date[:8]}/{region}/s3/aws4_request"
+    payload_hash = hashlib.sha256(body).hexdigest()
+    headers = dict(headers, **{'Host': host, 'x-amz-content-sha256': payload_hash, 'x-amz-date': amz_date})
+    canonical = {name.lower(): " ".join(str(value).split()) for name, value in headers.items()}
+    signed_headers = ";".join(sorted(canonical))
+    canonical_request = "\n".join([
+        method, urllib.parse.quote(path, safe="/-_.~"), _canonical_query(query),
+        "".join(f"{name}:{canonical[name]}\n" for name in sorted(canonical)), signed_headers, payload_hash])
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                hashlib.sha256(canonical_request.encode()).hexdigest()])
+    key = f"AWS4{secret_key}".encode()
+    for part in (amz_date[:8], region, "s3", "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers['Authorization'] = (f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+                                f"SignedHeaders={signed_headers}, Signature={signature}")
+    return headers
+
+
+class S3Blobs:
+    """Blobs as objects in an S3-compatible bucket, one keep-alive connection per thread
+
+    Credentials come from AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+    unless given.
+    """
+
+    name = 's3'
+
+    def __init__(self, endpoint=S3_ENDPOINT, bucket=S3_BUCKET, prefix=S3_PREFIX, region=S3_REGION,
+                 access_key=None, secret_key=None, timeout=S3_TIMEOUT):
+        if not endpoint or not bucket:
+            raise ValueError("The s3 storage backend needs SFMS_S3_ENDPOINT and SFMS_S3_BUCKET")
+        url = urllib.parse.urlsplit(endpoint)
+        self.secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.access_key = os.environ.get("AWS_ACCESS_KEY_ID", "") if access_key is None else access_key
+        self.secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY", "") if secret_key is None else secret_key
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            connection = self._local.connection = connection_class(self.host, timeout=self.timeout)
+        return connection
+
+    def _request(self, method, key, body=b"", headers=None):
+        path = f"/{self.bucket}/{self.prefix}{key}"
+        headers = sign_request(method, self.host, path, {}, headers or {}, body, self.region,
+                               self.access_key, self.secret_key)
+        # Every request is idempotent, so one dropped keep-alive connection is retried
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, urllib.parse.quote(path, safe="/-_.~"), body=body, headers=headers)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+    def _check(self, method, key, status, data, expected):
+        if status not in expected:
+            raise OSError(f"S3 {method} of {key} failed with {status}: {data[:200].decode('utf-8', 'replace')}")
+
+    def put(self, key, data):
+        status, response = self._request('PUT', key, bytes(data))
+        self._check('PUT', key, status, response, (200,))
+
+    def get(self, key, start=0, end=None):
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = f"bytes={start}-{'' if end is None else end - 1}"
+        status, data = self._request('GET', key, headers=headers)
+        self._check('GET', key, status, data, (200, 206))
+        if status == 200 and headers:
+            # Servers may ignore Range and send the whole object
+            data = data[start:end]
+        return data
+
+    def delete(self, key):
+        status, response = self._request('DELETE', key)
+        self._check('DELETE', key, status, response, (200, 204, 404))
+
+
+BLOB_BACKENDS = {'local': LocalBlobs, 's3': S3Blobs}
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=STORAGE_BACKEND):
+    """Return the process-wide blob store for a backend name, or None for "sqlite" (bytes kept inline)"""
+    if name == 'sqlite':
+        return None
+    with _backends_lock:
+        if name not in _backends:
+            if name not in BLOB_BACKENDS:
+                raise ValueError(f"Unknown storage backend {name}; use sqlite or one of {', '.join(BLOB_BACKENDS)}")
+            _backends[name] = BLOB_BACKENDS[name]()
+        return _backends[name]
+
+
+def reserve_blob(cursor, key, location):
+    """Write job recording a blob about to be written ahead of its chunk's row
+
+    Returns False, reserving nothing, if the chunk is stored already.
+    """
+    cursor.execute("SELECT 1 FROM chunks WHERE hash = ?", (key,))
+    if cursor.fetchone() is not None:
+        return False
+    cursor.execute("INSERT OR REPLACE INTO blob_garbage (hash, location, released) VALUES (?, ?, ?)",
+                   (key, location, time.time()))
+    return True
+
+
+def _remove_garbage(cursor, released_before, limit):
+    # Written first so the write lock is held before anything is read: a
+    # chunk stored again since its release keeps its blob
+    cursor.execute("DELETE FROM blob_garbage WHERE hash IN (SELECT hash FROM chunks)")
+    cursor.execute("SELECT hash, location FROM blob_garbage WHERE released < ? LIMIT ?", (released_before, limit))
+    garbage = cursor.fetchall()
+    for chunk_hash, location in garbage:
+        get_backend(location).delete(chunk_hash)
+    cursor.executemany("DELETE FROM blob_garbage WHERE hash = ?", [(row[0],) for row in garbage])
+    return len(garbage)
+
+
+def sweep_blobs(run_write, grace=BLOB_SWEEP_INTERVAL):
+    """Delete the blobs of chunks released over `grace` seconds ago, a batch per transaction; returns how many
+
+    Chunks still held by staged contents that were never swapped in (see
+    api/chunk_store.py) are released first.
+    """
+    # Imported here because the chunk store imports this module
+    from api.chunk_store import sweep_stages
+
+    sweep_stages(run_write)
+    removed = 0
+    while True:
+        batch = run_write(_remove_garbage, time.time() - grace, SWEEP_BATCH)
+        removed += batch
+        if batch < SWEEP_BATCH:
+            return removed
+
+
+def start_blob_sweeper(run_write, interval=BLOB_SWEEP_INTERVAL):
+    """Delete released blobs every `interval` seconds on a daemon thread; `run_write(fn, *args)` commits a job"""
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = sweep_blobs(run_write)
+                if removed:
+                    logger.info(f"Deleted {removed} released blobs")
+            except Exception as e:
+                logger.error(f"Blob sweep failed: {e}")
+
+    thread = threading.Thread(target=sweep_forever, name="blob-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+
+def storage_stats(cursor):
+    """Chunks and bytes kept inline and in each backend, and blobs waiting to be deleted"""
+    cursor.execute('''SELECT COALESCE(location, 'sqlite'), COUNT(*), COALESCE(SUM(COALESCE(stored_size, length(data))), 0)
+                      FROM chunks GROUP BY location''')
+    locations = {row[0]: {'chunks': row[1], 'bytes': row[2]} for row in cursor.fetchall()}
+    cursor.execute("SELECT COUNT(*) FROM blob_garbage")
+    return {'backend': STORAGE_BACKEND, 'locations': locations, 'garbage': cursor.fetchone()[0]}
+
+
+def _move_chunks(cursor, name, batch_bytes, after_rowid):
+    """Move up to about `batch_bytes` of inline chunks with rowids above `after_rowid` to backend `name`"""
+    backend = get_backend(name)
+    cursor.execute('''SELECT rowid, hash, length(data) FROM chunks WHERE rowid > ? AND location IS NULL
+                      ORDER BY rowid LIMIT 256''', (after_rowid,))
+    rows = moved = 0
+    for rowid, chunk_hash, size in cursor.fetchall():
+        if rows and moved + size > batch_bytes:
+            break
+        cursor.execute("SELECT data FROM chunks WHERE rowid = ?", (rowid,))
+        backend.put(chunk_hash, cursor.fetchone()[0])
+        cursor.execute("UPDATE chunks SET data = X'', location = ?, stored_size = ? WHERE rowid = ?",
+                       (name, size, rowid))
+        rows += 1
+        moved += size
+        after_rowid = rowid
+    return rows, moved, after_rowid
+
+
+def move_inline_chunks(path=None, name=STORAGE_BACKEND, batch_bytes=MOVE_BATCH_BYTES, progress=None):
+    """Move every inline chunk to backend `name`, a batch per transaction through the write queue
+
+    Files stay readable throughout. `progress(rows, bytes)`, if given, is
+    called with the running totals after every batch. Returns them.
+    """
+    # Imported here because api.database imports the chunk store, which imports this module
+    from api.database import DB_PATH, get_writer
+    from api.schema import create_tables
+
+    if get_backend(name) is None:
+        raise ValueError("Chunks can only be moved out of the database to a blob backend")
+    writer = get_writer(path or DB_PATH)
+    writer.run(create_tables)
+    rows = done = 0
+    position = 0
+    while True:
+        batch_rows, batch_bytes_moved, position = writer.run(_move_chunks, name, batch_bytes, position)
+        if not batch_rows:
+            return rows, done
+        rows += batch_rows
+        done += batch_bytes_moved
+        if progress is not None:
+            progress(rows, done)
+
+
+if __name__ == "__main__":
+    arguments = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    mb = 1024 * 1024
+    moved_rows, moved_bytes = move_inline_chunks(
+        arguments[0] if arguments else None,
+        progress=lambda rows, done: print(f"Moved {rows} chunks, {done / mb:.1f} MB", flush=True))
+    print(f"Moved {moved_rows} chunks ({moved_bytes / mb:.1f} MB) to {STORAGE_BACKEND} storage. "
+          f"VACUUM the database to give the space back.")
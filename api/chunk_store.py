@@ -0,0 +1,546 @@
+import os
+import mmap
+import time
+import errno
+import hashlib
+import secrets
+import collections
+import concurrent.futures
+from api.compression import compress_chunk, decompress_chunk
+from api.blob_store import STORAGE_BACKEND, get_backend, reserve_blob
+
+# Files are split into fixed-size chunks stored once per content hash.
+# The `files` table only keeps metadata; the ordered list of chunk hashes
+# for each file lives in `file_chunks` (the manifest). Chunk data may be
+# compressed (see api/compression.py); `hash` and `size` always describe
+# the uncompressed bytes. New chunks' bytes go to the configured storage
+# backend (see api/blob_store.py), or stay in `data` with "sqlite".
+#
+# New contents for an existing file (an encryption pass, say) are written
+# into `staged_chunks` first, a chunk per write job, while the file keeps
+# its old manifest; one short job then swaps the staged chunks in.
+CHUNK_SIZE = 1024 * 1024  # 1 MiB
+# Chunk writes one upload may have queued before it waits for the oldest to commit
+UPLOAD_WRITE_WINDOW = 4
+
+# A chunk made ready for put_chunk by prepare_chunk: the hash and size of
+# its bytes, and either those bytes and the codec to try (`packed` false) or
+# the bytes to store and the codec they are compressed with. `location`
+# names the backend its blob has already been written to, if any.
+PreparedChunk = collections.namedtuple("PreparedChunk", "hash size data codec packed location")
+# Staged contents nothing has been added to for this long were left by a process that died
+STAGE_EXPIRY = 3600
+# Stale stages released per write transaction by a sweep
+STAGE_SWEEP_BATCH = 100
+
+
+def init_chunk_tables(cursor):
+    """Create the chunk and manifest tables if they don't exist"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS chunks (
+                        hash TEXT PRIMARY KEY,
+                        data BLOB NOT NULL,
+                        size INTEGER NOT NULL,
+                        refcount INTEGER NOT NULL DEFAULT 0,
+                        codec TEXT,
+                        location TEXT,
+                        stored_size INTEGER
+                    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS file_chunks (
+                        file_id INTEGER NOT NULL,
+                        seq INTEGER NOT NULL,
+                        chunk_hash TEXT NOT NULL,
+                        PRIMARY KEY (file_id, seq),
+                        FOREIGN KEY(file_id) REFERENCES files(id),
+                        FOREIGN KEY(chunk_hash) REFERENCES chunks(hash)
+                    ) WITHOUT ROWID''')
+    # New contents being written for an existing file, before they replace its manifest
+    cursor.execute('''CREATE TABLE IF NOT EXISTS staged_chunks (
+                        stage_id TEXT NOT NULL,
+                        seq INTEGER NOT NULL,
+                        chunk_hash TEXT NOT NULL,
+                        staged REAL NOT NULL,
+                        PRIMARY KEY (stage_id, seq),
+                        FOREIGN KEY(chunk_hash) REFERENCES chunks(hash)
+                    ) WITHOUT ROWID''')
+
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """Yield fixed-size pieces from a file object, bytes-like object, mmap or iterable of bytes
+
+    A bytes-like object or mmap is sliced through a memoryview, so only the
+    chunk being yielded is copied; the view is released once the generator
+    finishes or is closed, after which the mapping can be closed. Short
+    reads from sockets (or odd-sized pieces from a generator) are coalesced
+    so chunk boundaries, and hence chunk hashes, don't depend on how the
+    data arrived.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        with memoryview(source) as view:
+            for offset in range(0, len(view), chunk_size):
+                yield bytes(view[offset:offset + chunk_size])
+                if isinstance(source, mmap.mmap) and hasattr(mmap, "MADV_DONTNEED"):
+                    # Unmap pages already copied out, or the whole file ends up counted in RSS
+                    source.madvise(mmap.MADV_DONTNEED, offset, min(chunk_size, len(view) - offset))
+        return
+    if hasattr(source, "read"):
+        pieces = iter(lambda: source.read(chunk_size - len(buffer)), b"")
+    else:
+        pieces = iter(source)
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def write_chunks(stream, write_chunk, progress=None):
+    """Queue `write_chunk(seq, data)` for each chunk of a stream; returns (size, SHA-256 hex digest)
+
+    `stream` is anything iter_chunks takes. `write_chunk` returns the
+    Future of a queued write. Reading goes on while a few chunks are being
+    written, but no more. `progress(size)` is called with the bytes written
+    so far as each chunk commits. On failure the writes already queued are
+    waited for before the error is re-raised.
+    """
+    pending = collections.deque()
+    try:
+        digest = hashlib.sha256()
+        size = 0
+        seq = 0
+        for data in iter_chunks(stream):
+            if not data:
+                continue
+            digest.update(data)
+            size += len(data)
+            pending.append((write_chunk(seq, data), size))
+            if len(pending) >= UPLOAD_WRITE_WINDOW:
+                _wait_written(pending, progress)
+            seq += 1
+        while pending:
+            _wait_written(pending, progress)
+        return size, digest.hexdigest()
+    except Exception:
+        concurrent.futures.wait([future for future, _ in pending])
+        raise
+
+
+def _wait_written(pending, progress):
+    future, written = pending.popleft()
+    future.result()
+    if progress is not None:
+        progress(written)
+
+
+def prepare_chunk(data, codec=None, run_write=None):
+    """Do the slow part of storing a chunk before its write job is queued; returns a PreparedChunk
+
+    The chunk is hashed and compressed here, on the caller's thread, and
+    with a blob backend its blob is written here too, so the write job
+    (put_chunk) only inserts a row. `run_write(fn, *args)` commits a short
+    write and returns its result; it reserves the blob first (see
+    api/blob_store.py), which is also how a chunk already stored is
+    noticed and neither compressed nor written again. Without it, a blob
+    backend's chunk is left for put_chunk to write.
+    """
+    chunk_hash = hashlib.sha256(data).hexdigest()
+    backend = get_backend(STORAGE_BACKEND)
+    if backend is not None and (run_write is None or not run_write(reserve_blob, chunk_hash, backend.name)):
+        return PreparedChunk(chunk_hash, len(data), data, codec, False, None)
+    packed = compress_chunk(data, codec) if codec else None
+    stored = data if packed is None else packed
+    codec = None if packed is None else codec
+    if backend is not None:
+        backend.put(chunk_hash, stored)
+    return PreparedChunk(chunk_hash, len(data), stored, codec, True, None if backend is None else backend.name)
+
+
+def put_chunk(cursor, data, codec=None):
+    """Store a chunk (or bump its refcount if already present) and return its hash
+
+    `data` is the chunk's bytes or a PreparedChunk. A chunk that is already
+    stored only costs an index lookup; its bytes aren't compressed or
+    written again. New chunks are compressed with `codec` when that makes
+    them smaller, unless prepare_chunk has done so already.
+    """
+    chunk = data if isinstance(data, PreparedChunk) else PreparedChunk(
+        hashlib.sha256(data).hexdigest(), len(data), data, codec, False, None)
+    cursor.execute("UPDATE chunks SET refcount = refcount + 1 WHERE hash = ?", (chunk.hash,))
+    if cursor.rowcount:
+        return chunk.hash
+    stored, codec = chunk.data, chunk.codec
+    if not chunk.packed:
+        packed = compress_chunk(stored, codec) if codec else None
+        stored, codec = (stored, None) if packed is None else (packed, codec)
+    if chunk.location is not None:
+        # Written ahead by prepare_chunk; the row replaces its reservation, unless a
+        # sweep has taken that (and the blob) already, when it is written again below
+        cursor.execute("DELETE FROM blob_garbage WHERE hash = ?", (chunk.hash,))
+        if cursor.rowcount:
+            cursor.execute('''INSERT INTO chunks (hash, data, size, refcount, codec, location, stored_size)
+                              VALUES (?, X'', ?, 1, ?, ?, ?)''',
+                           (chunk.hash, chunk.size, codec, chunk.location, len(stored)))
+            return chunk.hash
+    backend = get_backend(STORAGE_BACKEND)
+    if backend is None:
+        cursor.execute("INSERT INTO chunks (hash, data, size, refcount, codec) VALUES (?, ?, ?, 1, ?)",
+                       (chunk.hash, stored, chunk.size, codec))
+    else:
+        # The row goes in first, taking the write lock before the blob is written (see api/blob_store.py)
+        cursor.execute('''INSERT INTO chunks (hash, data, size, refcount, codec, location, stored_size)
+                          VALUES (?, X'', ?, 1, ?, ?, ?)''',
+                       (chunk.hash, chunk.size, codec, backend.name, len(stored)))
+        backend.put(chunk.hash, stored)
+    return chunk.hash
+
+
+def append_chunk(cursor, file_id, seq, data, codec=None):
+    """Store one chunk (bytes or a PreparedChunk) and put it at position `seq` of a file's manifest"""
+    chunk_hash = put_chunk(cursor, data, codec)
+    cursor.execute("INSERT INTO file_chunks (file_id, seq, chunk_hash) VALUES (?, ?, ?)",
+                   (file_id, seq, chunk_hash))
+
+
+def finish_file_data(cursor, file_id, content_hash):
+    """Record the whole-file hash once every chunk of a file has been appended"""
+    # Chunked rows never keep an inline copy of the data
+    cursor.execute("UPDATE files SET file_data = NULL, content_hash = ? WHERE id = ?",
+                   (content_hash, file_id))
+
+
+def store_file_data(cursor, file_id, chunks, codec=None):
+    """Write an iterable of chunks as the manifest of a file and return the total size"""
+    digest = hashlib.sha256()
+    total_size = 0
+    seq = 0
+    for data in chunks:
+        if not data:
+            continue
+        digest.update(data)
+        append_chunk(cursor, file_id, seq, data, codec)
+        total_size += len(data)
+        seq += 1
+    finish_file_data(cursor, file_id, digest.hexdigest())
+    return total_size
+
+
+def find_duplicate(cursor, content_hash, user_id=None):
+    """Return the id of a stored file with exactly these contents, or None
+
+    With `user_id`, only that user's files are considered.
+    """
+    query = "SELECT id FROM files WHERE content_hash = ?"
+    params = (content_hash,)
+    if user_id is not None:
+        query += " AND user_id = ?"
+        params += (user_id,)
+    cursor.execute(query + " LIMIT 1", params)
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def link_file_data(cursor, file_id, source_id):
+    """Make a file share the chunks of another file with the same contents
+
+    Only the manifest is copied and refcounts bumped; no chunk data is
+    read or written. Returns the size of the contents.
+    """
+    cursor.execute('''INSERT INTO file_chunks (file_id, seq, chunk_hash)
+                      SELECT ?, seq, chunk_hash FROM file_chunks WHERE file_id = ?''', (file_id, source_id))
+    cursor.execute('''UPDATE chunks SET refcount = refcount +
+                        (SELECT count(*) FROM file_chunks WHERE file_id = ? AND chunk_hash = chunks.hash)
+                      WHERE hash IN (SELECT chunk_hash FROM file_chunks WHERE file_id = ?)''', (file_id, file_id))
+    cursor.execute('''UPDATE files SET file_data = NULL,
+                        content_hash = (SELECT content_hash FROM files WHERE id = ?) WHERE id = ?''',
+                   (source_id, file_id))
+    return stored_size(cursor, file_id)
+
+
+def dedup_stats(cursor, user_id=None):
+    """Report how much space deduplication saves, overall or for one user's files
+
+    `logical_bytes` is what the files would take stored separately,
+    `unique_bytes` the size of their distinct chunks and `stored_bytes`
+    what those take after compression. `ratio` is the dedup ratio
+    (logical / unique) and `compression_ratio` is stored / unique.
+    """
+    where = ""
+    params = ()
+    if user_id is not None:
+        where = "WHERE file_chunks.file_id IN (SELECT id FROM files WHERE user_id = ?)"
+        params = (user_id,)
+    cursor.execute(f'''SELECT count(DISTINCT file_chunks.file_id), COALESCE(SUM(chunks.size), 0)
+                       FROM file_chunks JOIN chunks ON chunks.hash = file_chunks.chunk_hash {where}''', params)
+    files, logical_bytes = cursor.fetchone()
+    cursor.execute(f'''SELECT count(*), COALESCE(SUM(size), 0), COALESCE(SUM(COALESCE(stored_size, length(data))), 0)
+                       FROM chunks
+                       WHERE hash IN (SELECT chunk_hash FROM file_chunks {where})''', params)
+    chunks, unique_bytes, stored_bytes = cursor.fetchone()
+    return {'files': files, 'chunks': chunks, 'logical_bytes': logical_bytes, 'unique_bytes': unique_bytes,
+            'stored_bytes': stored_bytes, 'saved_bytes': logical_bytes - stored_bytes,
+            'ratio': logical_bytes / unique_bytes if unique_bytes else 1.0,
+            'compression_ratio': stored_bytes / unique_bytes if unique_bytes else 1.0}
+
+
+def release_chunks(cursor, hashes):
+    """Drop one reference to each chunk and delete the ones nobody uses any more"""
+    for chunk_hash in hashes:
+        cursor.execute("UPDATE chunks SET refcount = refcount - 1 WHERE hash = ?", (chunk_hash,))
+    if hashes:
+        # Blobs outlive their rows until this transaction has surely committed
+        cursor.execute('''INSERT OR REPLACE INTO blob_garbage (hash, location, released)
+                          SELECT hash, location, ? FROM chunks WHERE refcount <= 0 AND location IS NOT NULL''',
+                       (time.time(),))
+        cursor.execute("DELETE FROM chunks WHERE refcount <= 0")
+
+
+def delete_file_data(cursor, file_id):
+    """Drop a file's manifest and release the chunks it referenced"""
+    cursor.execute("SELECT chunk_hash FROM file_chunks WHERE file_id = ?", (file_id,))
+    hashes = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
+    release_chunks(cursor, hashes)
+
+
+def new_stage_id():
+    return secrets.token_hex(8)
+
+
+def stage_chunk(cursor, stage_id, seq, data, codec=None):
+    """Store one chunk (bytes or a PreparedChunk) of new contents for a file, to be swapped in by swap_staged
+
+    Until then the staged row holds the chunk's reference, as a manifest would.
+    """
+    chunk_hash = put_chunk(cursor, data, codec)
+    cursor.execute("INSERT INTO staged_chunks (stage_id, seq, chunk_hash, staged) VALUES (?, ?, ?, ?)",
+                   (stage_id, seq, chunk_hash, time.time()))
+
+
+def swap_staged(cursor, file_id, stage_id, chunks, content_hash, expected):
+    """Make `chunks` staged chunks the contents of a file, releasing the chunks it had
+
+    `expected` is the file's list of chunk hashes when the staged contents
+    were made from it. If the file has changed since, or is gone, nothing
+    is swapped and ValueError or LookupError raised.
+    """
+    cursor.execute("SELECT 1 FROM files WHERE id = ?", (file_id,))
+    if cursor.fetchone() is None:
+        raise LookupError("File not found")
+    cursor.execute("SELECT chunk_hash FROM file_chunks WHERE file_id = ? ORDER BY seq", (file_id,))
+    old_hashes = [row[0] for row in cursor.fetchall()]
+    if old_hashes != list(expected):
+        raise ValueError("The file was changed while this was in progress; try again")
+    cursor.execute("SELECT COUNT(*) FROM staged_chunks WHERE stage_id = ?", (stage_id,))
+    if cursor.fetchone()[0] != chunks:
+        raise ValueError("The new contents were not all stored")
+    cursor.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
+    # The staged references move to the manifest
+    cursor.execute('''INSERT INTO file_chunks (file_id, seq, chunk_hash)
+                      SELECT ?, seq, chunk_hash FROM staged_chunks WHERE stage_id = ?''', (file_id, stage_id))
+    cursor.execute("DELETE FROM staged_chunks WHERE stage_id = ?", (stage_id,))
+    finish_file_data(cursor, file_id, content_hash)
+    release_chunks(cursor, old_hashes)
+
+
+def discard_stage(cursor, stage_id):
+    """Release the chunks of staged contents that won't be swapped in"""
+    cursor.execute("SELECT chunk_hash FROM staged_chunks WHERE stage_id = ?", (stage_id,))
+    hashes = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM staged_chunks WHERE stage_id = ?", (stage_id,))
+    release_chunks(cursor, hashes)
+
+
+def _release_stale_stages(cursor, before, limit):
+    cursor.execute("SELECT stage_id FROM staged_chunks GROUP BY stage_id HAVING MAX(staged) < ? LIMIT ?",
+                   (before, limit))
+    stale = [row[0] for row in cursor.fetchall()]
+    for stage_id in stale:
+        discard_stage(cursor, stage_id)
+    return len(stale)
+
+
+def sweep_stages(run_write, expiry=STAGE_EXPIRY):
+    """Release staged contents nothing was added to for `expiry` seconds, a batch per transaction; returns how many"""
+    removed = 0
+    while True:
+        batch = run_write(_release_stale_stages, time.time() - expiry, STAGE_SWEEP_BATCH)
+        removed += batch
+        if batch < STAGE_SWEEP_BATCH:
+            return removed
+
+
+def get_manifest(cursor, file_id):
+    """Return the ordered (chunk_hash, size) pairs making up a file"""
+    cursor.execute('''SELECT file_chunks.chunk_hash, chunks.size FROM file_chunks
+                      JOIN chunks ON chunks.hash = file_chunks.chunk_hash
+                      WHERE file_chunks.file_id = ? ORDER BY file_chunks.seq''', (file_id,))
+    return cursor.fetchall()
+
+
+def stored_size(cursor, file_id):
+    """Return the number of bytes stored for a file"""
+    manifest = get_manifest(cursor, file_id)
+    if manifest:
+        return sum(size for _, size in manifest)
+    # Rows written before the chunk store existed keep their bytes inline
+    cursor.execute("SELECT length(file_data) FROM files WHERE id = ?", (file_id,))
+    row = cursor.fetchone()
+    return (row[0] or 0) if row else 0
+
+
+def iter_file_range(cursor, file_id, start=0, end=None):
+    """Yield bytes [start, end) of a file, reading only the chunks that overlap
+
+    The manifest is looked up immediately rather than on first iteration,
+    so the returned iterator keeps reading the contents as they were when
+    it was created.
+    """
+    manifest = get_manifest(cursor, file_id)
+    if not manifest:
+        length = stored_size(cursor, file_id)
+        end = length if end is None else min(end, length)
+        return _iter_inline_range(cursor, file_id, start, end)
+    return iter_manifest_range(cursor, manifest, start, end)
+
+
+def _iter_inline_range(cursor, file_id, start, end):
+    """Slice a legacy inline blob in SQL a chunk at a time"""
+    for offset in range(start, end, CHUNK_SIZE):
+        cursor.execute("SELECT substr(file_data, ?, ?) FROM files WHERE id = ?",
+                       (offset + 1, min(CHUNK_SIZE, end - offset), file_id))
+        yield bytes(cursor.fetchone()[0])
+
+
+def iter_manifest_range(cursor, manifest, start=0, end=None):
+    """Yield bytes [start, end) of the chunks listed in a manifest (from get_manifest)"""
+    chunk_start = 0
+    for chunk_hash, size in manifest:
+        chunk_end = chunk_start + size
+        if end is not None and chunk_start >= end:
+            break
+        if chunk_end > start:
+            offset = max(start - chunk_start, 0)
+            stop = size if end is None else min(end - chunk_start, size)
+            if offset == 0 and stop == size:
+                cursor.execute("SELECT data, codec, location FROM chunks WHERE hash = ?", (chunk_hash,))
+            else:
+                # Raw chunks are sliced in SQL; compressed ones have to be inflated whole
+                cursor.execute('''SELECT CASE WHEN codec IS NULL THEN substr(data, ?, ?) ELSE data END, codec, location
+                                  FROM chunks WHERE hash = ?''', (offset + 1, stop - offset, chunk_hash))
+            row = cursor.fetchone()
+            if row is None:
+                raise LookupError("The file was changed or deleted while it was being read")
+            data, codec, location = row
+            if location is not None:
+                # Only the part needed is read from a raw blob
+                data = (get_backend(location).get(chunk_hash) if codec is not None
+                        else get_backend(location).get(chunk_hash, offset, stop))
+            if codec is not None:
+                data = decompress_chunk(data, codec)[offset:stop]
+            yield data
+        chunk_start = chunk_end
+
+
+def file_regions(cursor, file_id, start=0, end=None):
+    """Where bytes [start, end) of a file lie on disk, as [(path, offset, length)], or None
+
+    Only contents whose chunks are all kept uncompressed as files by their
+    storage backend (see api/blob_store.py) can be read this way, letting
+    the bytes go from those files to a socket or another file without
+    passing through Python.
+    """
+    cursor.execute('''SELECT file_chunks.chunk_hash, chunks.size, chunks.codec, chunks.location FROM file_chunks
+                      JOIN chunks ON chunks.hash = file_chunks.chunk_hash
+                      WHERE file_chunks.file_id = ? ORDER BY file_chunks.seq''', (file_id,))
+    regions = []
+    chunk_start = 0
+    for chunk_hash, size, codec, location in cursor.fetchall():
+        chunk_end = chunk_start + size
+        if end is not None and chunk_start >= end:
+            break
+        if chunk_end > start:
+            backend = get_backend(location) if location else None
+            if codec is not None or not hasattr(backend, 'path'):
+                return None
+            offset = max(start - chunk_start, 0)
+            stop = size if end is None else min(end - chunk_start, size)
+            regions.append((backend.path(chunk_hash), offset, stop - offset))
+        chunk_start = chunk_end
+    # Legacy inline rows have no manifest
+    return regions or None
+
+
+def iter_regions(regions):
+    """Yield the bytes of file regions (from file_regions) one region at a time"""
+    for path, offset, length in regions:
+        with open(path, 'rb') as blob:
+            blob.seek(offset)
+            data = blob.read(length)
+        if len(data) != length:
+            raise OSError(f"{path} is shorter than its chunk")
+        yield data
+
+
+def _copy_region(path, offset, length, destination):
+    with open(path, 'rb') as source:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while length:
+                    copied = os.copy_file_range(source.fileno(), destination.fileno(), length, offset)
+                    if not copied:
+                        raise OSError(f"{path} is shorter than its chunk")
+                    offset += copied
+                    length -= copied
+                return
+            except OSError as e:
+                # Not possible between these two files; copy the rest the ordinary way
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        source.seek(offset)
+        while length:
+            data = source.read(min(length, CHUNK_SIZE))
+            if not data:
+                raise OSError(f"{path} is shorter than its chunk")
+            destination.write(data)
+            length -= len(data)
+
+
+def copy_file_data(cursor, file_id, destination, progress=None):
+    """Write the contents of a file to an open binary file; returns the number of bytes written
+
+    Chunks kept as plain files are copied by the kernel (copy_file_range,
+    which some filesystems turn into a shared extent), so the bytes never
+    pass through Python; other contents are written chunk by chunk.
+    `progress(written)` is called with the bytes written so far after each
+    chunk.
+    """
+    regions = file_regions(cursor, file_id)
+    written = 0
+    if regions is None:
+        for piece in iter_file_data(cursor, file_id):
+            destination.write(piece)
+            written += len(piece)
+            if progress is not None:
+                progress(written)
+        return written
+    for path, offset, length in regions:
+        # Buffered writes have to land before the kernel writes after them
+        destination.flush()
+        _copy_region(path, offset, length, destination)
+        written += length
+        if progress is not None:
+            progress(written)
+    destination.flush()
+    return written
+
+
+def iter_file_data(cursor, file_id):
+    """Yield the contents of a file chunk by chunk"""
+    return iter_file_range(cursor, file_id)
+
+
+def read_file_data(cursor, file_id):
+    """Return the whole contents of a file as bytes"""
+    return b"".join(iter_file_data(cursor, file_id))
@@ -0,0 +1,314 @@
+import os
+import zlib
+import lzma
+import itertools
+import collections
+import mimetypes
+from api.stream_cipher import MAGIC, is_stream_encrypted
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional compression of stored data.
+#
+# Chunks are compressed one by one as they go into the chunk store; their
+# hashes and sizes stay those of the uncompressed bytes, so dedup and range
+# reads work as before. Ciphertext doesn't compress, so plaintext is also
+# compressed as one stream just before it is encrypted and decompressed
+# right after it is decrypted. The codec is picked per file from its MIME
+# type at upload and recorded in `files.codec`.
+Codec = collections.namedtuple("Codec", "compress decompress compressobj decompress_stream")
+
+# Most output a streaming decompressor returns at once, so a small, highly
+# compressed input can't blow up into a huge buffer
+OUTPUT_LIMIT = 1024 * 1024
+
+# Types that are compressed already; compressing them again only costs CPU
+INCOMPRESSIBLE_PREFIXES = ("image/", "video/", "audio/", "application/vnd.openxmlformats-officedocument.")
+COMPRESSIBLE_EXCEPTIONS = {"image/svg+xml", "image/bmp", "image/x-ms-bmp", "image/tiff", "audio/wav", "audio/x-wav"}
+INCOMPRESSIBLE_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2", "application/x-xz",
+    "application/x-7z-compressed", "application/x-rar-compressed", "application/vnd.rar", "application/zstd",
+    "application/x-zstd", "application/java-archive", "application/epub+zip", "application/pdf",
+    "application/vnd.android.package-archive", "application/x-compress", "application/x-lzma",
+}
+
+
+def _zlib_decompress_stream(pieces):
+    decompressor = zlib.decompressobj()
+    for piece in pieces:
+        while piece:
+            output = decompressor.decompress(piece, OUTPUT_LIMIT)
+            if output:
+                yield output
+            piece = decompressor.unconsumed_tail
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("Compressed stream is truncated")
+
+
+def _lzma_decompress_stream(pieces):
+    decompressor = lzma.LZMADecompressor()
+    for piece in pieces:
+        output = decompressor.decompress(piece, OUTPUT_LIMIT)
+        while True:
+            if output:
+                yield output
+            if decompressor.eof or decompressor.needs_input:
+                break
+            output = decompressor.decompress(b"", OUTPUT_LIMIT)
+    if not decompressor.eof:
+        raise ValueError("Compressed stream is truncated")
+    yield b""
+
+
+class _PieceReader:
+    """Minimal file-like view of an iterator of bytes, for zstandard's stream API"""
+
+    def __init__(self, pieces, frames=None):
+        self.pieces = iter(pieces)
+        self.buffer = b""
+        # Told about every byte read
+        self.frames = frames
+
+    def read(self, size=-1):
+        while not self.buffer:
+            self.buffer = next(self.pieces, None)
+            if self.buffer is None:
+                self.buffer = b""
+                return b""
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        if self.frames is not None:
+            self.frames.feed(data)
+        return data
+
+
+_ZSTD_MAGIC = 0xFD2FB528
+_ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+
+class _ZstdFrames:
+    """Follows the frame and block headers of a zstd stream as it is read, to tell whether it ends mid-frame
+
+    zstandard's streaming decompressor just stops where its input does, so
+    without this a truncated stream would pass for a shorter file.
+    """
+
+    def __init__(self):
+        self._header = b""
+        # Header bytes the next step needs, and content bytes to pass over first
+        self._needed = 4
+        self._skip = 0
+        self._step = self._magic
+        self._checksum = False
+
+    @property
+    def complete(self):
+        return self._step == self._magic and not self._header and not self._skip
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view:
+            if self._skip:
+                count = min(self._skip, len(view))
+                self._skip -= count
+                view = view[count:]
+                continue
+            count = self._needed - len(self._header)
+            self._header += bytes(view[:count])
+            view = view[count:]
+            if len(self._header) == self._needed:
+                header, self._header = self._header, b""
+                self._step(header)
+
+    def _expect(self, size, step):
+        self._needed, self._step = size, step
+
+    def _magic(self, header):
+        magic = int.from_bytes(header, "little")
+        if magic == _ZSTD_MAGIC:
+            self._expect(1, self._descriptor)
+        elif magic & 0xFFFFFFF0 == _ZSTD_SKIPPABLE_MAGIC:
+            self._expect(4, self._skippable)
+        else:
+            raise ValueError("Compressed stream is corrupt")
+
+    def _skippable(self, header):
+        self._skip = int.from_bytes(header, "little")
+        self._expect(4, self._magic)
+
+    def _descriptor(self, header):
+        descriptor = header[0]
+        single_segment = descriptor >> 5 & 1
+        self._checksum = bool(descriptor >> 2 & 1)
+        # Window descriptor, dictionary id and content size, none of which matter here
+        rest = (1 - single_segment) + (0, 1, 2, 4)[descriptor & 3] + (single_segment, 2, 4, 8)[descriptor >> 6]
+        if rest:
+            self._expect(rest, self._frame_rest)
+        else:
+            self._expect(3, self._block)
+
+    def _frame_rest(self, header):
+        self._expect(3, self._block)
+
+    def _block(self, header):
+        block = int.from_bytes(header, "little")
+        block_type = block >> 1 & 3
+        if block_type == 3:
+            raise ValueError("Compressed stream is corrupt")
+        # An RLE block holds one byte, whatever its size
+        self._skip = 1 if block_type == 1 else block >> 3
+        if not block & 1:
+            self._expect(3, self._block)
+        elif self._checksum:
+            self._expect(4, self._frame_checksum)
+        else:
+            self._expect(4, self._magic)
+
+    def _frame_checksum(self, header):
+        self._expect(4, self._magic)
+
+
+def _zstd_decompress_stream(pieces):
+    frames = _ZstdFrames()
+    reader = zstandard.ZstdDecompressor().stream_reader(_PieceReader(pieces, frames), read_across_frames=True)
+    while True:
+        output = reader.read(OUTPUT_LIMIT)
+        if not output:
+            break
+        yield output
+    if not frames.complete:
+        raise ValueError("Compressed stream is truncated")
+    yield b""
+
+
+CODECS = {
+    "zlib": Codec(lambda data: zlib.compress(data, 6), zlib.decompress,
+                  lambda: zlib.compressobj(6), _zlib_decompress_stream),
+    "lzma": Codec(lzma.compress, lzma.decompress, lzma.LZMACompressor, _lzma_decompress_stream),
+}
+if zstandard is not None:
+    CODECS["zstd"] = Codec(lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                           lambda data: zstandard.ZstdDecompressor().decompress(data),
+                           lambda: zstandard.ZstdCompressor(level=3).compressobj(),
+                           _zstd_decompress_stream)
+
+# Codec for new uploads; "none" turns compression off. zstd is faster but
+# needs the optional zstandard package wherever the data is read again, so
+# it is only used when asked for
+DEFAULT_CODEC = os.environ.get("SFMS_COMPRESSION", "zlib")
+
+
+def _get_codec(name):
+    if name not in CODECS:
+        raise ValueError(f"Compression codec {name} is not available")
+    return CODECS[name]
+
+
+def choose_codec(file_type, filename=None, default=None):
+    """Pick the codec for a new file from its MIME type, or None to store it as is"""
+    default = DEFAULT_CODEC if default is None else default
+    if default == "none":
+        return None
+    if (not file_type or file_type in ("Unknown", "application/octet-stream")) and filename:
+        file_type = mimetypes.guess_type(filename)[0]
+    file_type = (file_type or "").split(";")[0].strip().lower()
+    if file_type in COMPRESSIBLE_EXCEPTIONS:
+        return default
+    if file_type in INCOMPRESSIBLE_TYPES or file_type.startswith(INCOMPRESSIBLE_PREFIXES):
+        return None
+    return default
+
+
+def compress_chunk(data, codec):
+    """Compress one chunk; returns None if that doesn't make it smaller"""
+    packed = _get_codec(codec).compress(data)
+    return packed if len(packed) < len(data) else None
+
+
+def decompress_chunk(data, codec):
+    """Undo compress_chunk"""
+    return _get_codec(codec).decompress(bytes(data))
+
+
+def compress_stream(pieces, codec):
+    """Compress an iterable of bytes as one stream"""
+    compressor = _get_codec(codec).compressobj()
+    for piece in pieces:
+        output = compressor.compress(piece)
+        if output:
+            yield output
+    yield compressor.flush()
+
+
+def decompress_stream(pieces, codec):
+    """Decompress a stream written by compress_stream, a bounded piece at a time"""
+    return _get_codec(codec).decompress_stream(pieces)
+
+
+def _peek(pieces, size):
+    """Return (first `size` bytes, iterator still yielding everything)"""
+    pieces = iter(pieces)
+    head = b""
+    consumed = []
+    while len(head) < size:
+        piece = next(pieces, None)
+        if piece is None:
+            break
+        consumed.append(piece)
+        head += piece
+    return head[:size], itertools.chain(consumed, pieces)
+
+
+def compress_for_encryption(pieces, codec):
+    """Compress plaintext that is about to be encrypted
+
+    Data that is already an encrypted stream (the next layer of a file
+    encrypted twice) is passed through, which is how
+    decompress_after_decryption knows to leave it alone.
+    """
+    if codec is None:
+        for piece in pieces:
+            yield piece
+        return
+    head, pieces = _peek(pieces, len(MAGIC))
+    if is_stream_encrypted(head):
+        for piece in pieces:
+            yield piece
+        return
+    for piece in compress_stream(pieces, codec):
+        yield piece
+
+
+def decompress_after_decryption(pieces, codec):
+    """Undo compress_for_encryption on freshly decrypted data"""
+    if codec is None:
+        for piece in pieces:
+            yield piece
+        return
+    head, pieces = _peek(pieces, len(MAGIC))
+    # Compressed streams never start with the encryption header magic
+    if is_stream_encrypted(head):
+        for piece in pieces:
+            yield piece
+        return
+    for piece in decompress_stream(pieces, codec):
+        yield piece
+
+
+def file_codec(cursor, file_id):
+    """Return the codec recorded for a file, or None"""
+    cursor.execute("SELECT codec FROM files WHERE id = ?", (file_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def update_compression_ratio(cursor, file_id):
+    """Record stored bytes / original size for a file after its contents change"""
+    cursor.execute('''UPDATE files SET compression_ratio =
+                        (SELECT COALESCE(SUM(COALESCE(chunks.stored_size, length(chunks.data))), 0) FROM file_chunks
+                         JOIN chunks ON chunks.hash = file_chunks.chunk_hash WHERE file_chunks.file_id = ?)
+                        * 1.0 / file_size
+                      WHERE id = ? AND file_size > 0''', (file_id, file_id))
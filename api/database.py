@@ -1,11 +1,303 @@
 import sqlite3
 import os
+import time
+import queue
 import logging
-import bcrypt
+import threading
+import concurrent.futures
 import datetime
+from api.schema import init_schema
+from api.auth import hash_password
 
 logger = logging.getLogger(__name__)
 
+DB_PATH = "file_manager.db"
+
+# Connection pool.
+#
+# Opening a connection per query means every request pays for the open and
+# starts from a cold page cache. Connections are instead kept open and
+# handed out one caller at a time; close() on a pooled connection gives it
+# back. Up to POOL_SIZE idle connections are kept. When they are all busy,
+# up to POOL_OVERFLOW more are opened and closed again after use. After
+# that, callers wait up to POOL_TIMEOUT seconds for one to come back.
+POOL_SIZE = int(os.environ.get("SFMS_DB_POOL_SIZE", 8))
+POOL_OVERFLOW = int(os.environ.get("SFMS_DB_POOL_OVERFLOW", 32))
+POOL_TIMEOUT = float(os.environ.get("SFMS_DB_POOL_TIMEOUT", 30))
+# Connections idle for longer than this are checked with a trivial query before reuse
+HEALTH_CHECK_AFTER = 5
+# In WAL mode readers work from a snapshot and never wait for the writer
+JOURNAL_MODE = os.environ.get("SFMS_DB_JOURNAL_MODE", "WAL")
+# Applied once to every new connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA cache_size = -16384",  # 16 MiB page cache
+    "PRAGMA mmap_size = 268435456",  # read pages straight from a 256 MiB mapping
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {int(POOL_TIMEOUT * 1000)}",
+)
+# Most queued writes committed in one transaction
+WRITE_BATCH_SIZE = int(os.environ.get("SFMS_DB_WRITE_BATCH", 64))
+
+
+def configure_connection(connection):
+    """Apply the journal mode and tuning PRAGMAs to a new connection"""
+    mode = connection.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}").fetchone()[0]
+    # With WAL, NORMAL can lose the last commits on power loss but never corrupts
+    # the database; rollback journals need FULL for that
+    connection.execute("PRAGMA synchronous = NORMAL" if mode.lower() == "wal" else "PRAGMA synchronous = FULL")
+    for pragma in CONNECTION_PRAGMAS:
+        connection.execute(pragma)
+    return connection
+
+
+class PooledConnection:
+    """A connection borrowed from a ConnectionPool
+
+    Behaves like the sqlite3.Connection it wraps, except that close()
+    returns it to the pool (rolling back anything left uncommitted).
+    """
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        if self._connection is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._connection, name)
+
+    def __enter__(self):
+        self._connection.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._connection.__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool.release(connection)
+
+    def __del__(self):
+        # A connection that is dropped without close() still goes back
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections to one database file"""
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, overflow=POOL_OVERFLOW, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.overflow = overflow
+        self.timeout = timeout
+        self._idle = []  # (connection, time returned), most recently used last
+        self._open = 0
+        self._condition = threading.Condition()
+
+    def _connect(self):
+        return configure_connection(sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False))
+
+    def _healthy(self, connection, idle_since):
+        if time.monotonic() - idle_since < HEALTH_CHECK_AFTER:
+            return True
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def connection(self):
+        """Borrow a connection; close() it to give it back"""
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            while True:
+                while self._idle:
+                    # Reuse the warmest connection first
+                    connection, idle_since = self._idle.pop()
+                    if self._healthy(connection, idle_since):
+                        return PooledConnection(self, connection)
+                    self._discard(connection)
+                if self._open < self.size + self.overflow:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError("Timed out waiting for a database connection")
+                self._condition.wait(remaining)
+        try:
+            return PooledConnection(self, self._connect())
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection):
+        """Take back a connection, keeping it if there's room in the pool"""
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+            keep = True
+        except sqlite3.Error:
+            keep = False
+        with self._condition:
+            if keep and len(self._idle) < self.size:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                self._discard(connection)
+            self._condition.notify()
+
+    def _discard(self, connection):
+        self._open -= 1
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        """Close every idle connection, e.g. before the database file is moved"""
+        with self._condition:
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {'open': self._open, 'idle': len(self._idle), 'size': self.size, 'overflow': self.overflow}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=DB_PATH):
+    """Return the process-wide pool for a database file"""
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+
+def get_connection(path=DB_PATH):
+    """Borrow a pooled connection to a database file; close() gives it back"""
+    return get_pool(path).connection()
+
+
+class WriteQueue:
+    """Runs write transactions one after another on a dedicated connection and thread
+
+    SQLite allows a single writer at a time; funnelling every write
+    through one thread means requests queue up here instead of spinning
+    on the database lock. Jobs waiting in the queue are committed together
+    (up to WRITE_BATCH_SIZE per transaction), each inside its own savepoint
+    so a failing job is undone without affecting the rest of the batch.
+    """
+
+    def __init__(self, path=DB_PATH, batch_size=WRITE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        """Queue `fn(cursor, *args)`; returns a Future resolved once its transaction commits"""
+        future = concurrent.futures.Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def run(self, fn, *args):
+        """Queue a write and wait for its result"""
+        return self.submit(fn, *args).result()
+
+    def _run(self):
+        # Transactions are managed explicitly, hence no implicit BEGINs
+        connection = configure_connection(sqlite3.connect(self.path, timeout=POOL_TIMEOUT, isolation_level=None,
+                                                          check_same_thread=False))
+        cursor = connection.cursor()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._run_batch(connection, cursor, batch)
+            except Exception as e:
+                # Only reached if the transaction itself broke; nothing in the batch was committed
+                logger.error(f"Write batch failed: {e}")
+                if connection.in_transaction:
+                    connection.rollback()
+                for future, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run_batch(self, connection, cursor, batch):
+        done = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            for future, _, _ in batch:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+        for future, fn, args in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            cursor.execute("SAVEPOINT write_job")
+            try:
+                result = fn(cursor, *args)
+            except BaseException as e:
+                cursor.execute("ROLLBACK TO write_job")
+                cursor.execute("RELEASE write_job")
+                future.set_exception(e)
+                continue
+            cursor.execute("RELEASE write_job")
+            done.append((future, result))
+        try:
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.rollback()
+            for future, _ in done:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.jobs += len(done)
+        for future, result in done:
+            future.set_result(result)
+
+    def stats(self):
+        return {'batches': self.batches, 'jobs': self.jobs, 'queued': self._queue.qsize(),
+                'jobs_per_batch': self.jobs / self.batches if self.batches else 0.0}
+
+
+_writers = {}
+
+
+def get_writer(path=DB_PATH):
+    """Return the process-wide write queue for a database file"""
+    with _pools_lock:
+        if path not in _writers:
+            _writers[path] = WriteQueue(path)
+        return _writers[path]
+
+
+def close_pools():
+    """Close the idle connections of every pool"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
 class Database:
     _instance = None
     _connection = None
@@ -28,29 +320,12 @@ class Database:
                 self._connection = sqlite3.connect(":memory:", check_same_thread=False)
             else:
                 # For local development, use file-based database
-                self._connection = sqlite3.connect("file_manager.db", check_same_thread=False)
+                self._connection = get_connection()
             
             cursor = self._connection.cursor()
             
-            # Create users table
-            cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                username TEXT UNIQUE,
-                                password TEXT
-                            )''')
-            
-            # Create files table
-            cursor.execute('''CREATE TABLE IF NOT EXISTS files (
-                            id INTEGER PRIMARY KEY,
-                            user_id INTEGER,
-                            file_name TEXT,
-                            file_data BLOB,
-                            file_size INTEGER,
-                            file_type TEXT,
-                            action TEXT,
-                            timestamp TEXT,
-                            FOREIGN KEY(user_id) REFERENCES users(id)
-                        )''')
+            # Create tables and apply schema migrations
+            init_schema(cursor)
             
             self._connection.commit()
             logger.info("Database initialized successfully")
@@ -60,13 +335,16 @@ class Database:
                 try:
                     cursor.execute("SELECT id FROM users WHERE username = ?", ("testuser",))
                     if not cursor.fetchone():
-                        hashed_password = bcrypt.hashpw("testuser123".encode('utf-8'), bcrypt.gensalt())
+                        hashed_password = hash_password("testuser123")
                         cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", 
                                     ("testuser", hashed_password))
                         self._connection.commit()
                         logger.info("Created test user for Vercel environment")
                 except Exception as e:
                     logger.error(f"Error creating test user: {e}")
+            else:
+                self._connection.close()
+                self._connection = None
         
         except Exception as e:
             logger.error(f"Database initialization error: {e}")
@@ -76,8 +354,8 @@ class Database:
         if 'VERCEL' in os.environ:
             return self._connection
         else:
-            # For local development, return a new connection each time
-            return sqlite3.connect("file_manager.db")
+            # For local development, borrow one from the pool; close() returns it
+            return get_connection()
     
     def execute_query(self, query, params=(), fetch_all=False, commit=False):
         """
@@ -88,7 +366,7 @@ class Database:
                 conn = self._connection
                 close_after = False
             else:
-                conn = sqlite3.connect("file_manager.db")
+                conn = get_connection()
                 close_after = True
                 
             cursor = conn.cursor()
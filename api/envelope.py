@@ -0,0 +1,141 @@
+import os
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from api.kdf import DEFAULT_KDF, SALT_SIZE, master_key, file_key, pack_kdf_block, unpack_kdf_block
+from api.chunk_store import iter_file_range
+from api.stream_cipher import (ENVELOPE_VERSION, KEY_ID_SIZE, MAX_HEADER_SIZE, encrypt_stream, password_key,
+                               parse_header, is_stream_encrypted)
+
+# Envelope encryption: every encrypted file gets a random data key that is
+# used for its contents exactly once. Only the data key, wrapped under a
+# key derived from the user's passphrase, is stored (in `file_keys`), so
+# changing a passphrase re-wraps a few dozen bytes per file instead of
+# re-encrypting the data.
+DATA_KEY_SIZE = 32
+WRAP_NONCE_SIZE = 12
+
+
+def init_key_table(cursor):
+    """Create the wrapped data key table if it doesn't exist"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS file_keys (
+                        key_id BLOB PRIMARY KEY,
+                        file_id INTEGER NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        wrapped_key BLOB NOT NULL,
+                        wrap_info BLOB NOT NULL,
+                        FOREIGN KEY(file_id) REFERENCES files(id),
+                        FOREIGN KEY(user_id) REFERENCES users(id)
+                    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_keys_user ON file_keys (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_keys_file ON file_keys (file_id)")
+
+
+def wrap_data_key(data_key, key_id, password, kdf_salt, scope=None, params=DEFAULT_KDF):
+    """Encrypt a data key under a passphrase; returns (wrapped_key, wrap_info)"""
+    wrap_salt = os.urandom(SALT_SIZE)
+    kek = file_key(master_key(password, kdf_salt, params, scope), wrap_salt)
+    nonce = os.urandom(WRAP_NONCE_SIZE)
+    wrapped = nonce + AESGCM(kek).encrypt(nonce, data_key, key_id)
+    return wrapped, pack_kdf_block(params, kdf_salt, wrap_salt)
+
+
+def unwrap_data_key(wrapped, wrap_info, key_id, password, scope=None):
+    """Recover a data key; raises cryptography.exceptions.InvalidTag for the wrong passphrase"""
+    params, kdf_salt, wrap_salt = unpack_kdf_block(bytes(wrap_info))
+    kek = file_key(master_key(password, kdf_salt, params, scope), wrap_salt)
+    wrapped = bytes(wrapped)
+    return AESGCM(kek).decrypt(wrapped[:WRAP_NONCE_SIZE], wrapped[WRAP_NONCE_SIZE:], bytes(key_id))
+
+
+def new_data_key(file_id, user_id, password, kdf_salt):
+    """A fresh data key for a file, wrapped by the password; returns (data key, key row for store_data_key)
+
+    Needs no database, so the key derivation can run off the writer.
+    """
+    key_id = os.urandom(KEY_ID_SIZE)
+    data_key = AESGCM.generate_key(bit_length=DATA_KEY_SIZE * 8)
+    wrapped, wrap_info = wrap_data_key(data_key, key_id, password, kdf_salt, scope=user_id)
+    return data_key, (key_id, file_id, user_id, wrapped, wrap_info)
+
+
+def store_data_key(cursor, key_row):
+    cursor.execute("INSERT INTO file_keys (key_id, file_id, user_id, wrapped_key, wrap_info) VALUES (?, ?, ?, ?, ?)",
+                   key_row)
+
+
+def encrypt_with_data_key(pieces, data_key, key_row):
+    """Encrypt a file's contents under a key from new_data_key; returns the ciphertext iterator"""
+    return encrypt_stream(pieces, data_key, key_row[0], version=ENVELOPE_VERSION)
+
+
+def key_resolver(cursor, password, scope=None):
+    """Return a function mapping a stream header to its key, for decrypt_stream/decrypt_pieces"""
+    def resolve(header):
+        if header.version != ENVELOPE_VERSION:
+            return password_key(header, password, scope)
+        cursor.execute("SELECT wrapped_key, wrap_info FROM file_keys WHERE key_id = ?", (header.key_info,))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError("Data key for this file is missing")
+        return unwrap_data_key(row[0], row[1], header.key_info, password, scope)
+    return resolve
+
+
+def stream_header(cursor, file_id):
+    """Return the StreamHeader of a stored file, or None if it isn't segment-encrypted"""
+    data = b"".join(iter_file_range(cursor, file_id, 0, MAX_HEADER_SIZE))
+    if not is_stream_encrypted(data):
+        return None
+    return parse_header(data)
+
+
+def forget_key(cursor, header):
+    """Drop the data key of an encryption layer that has just been removed"""
+    if header is not None and header.version == ENVELOPE_VERSION:
+        cursor.execute("DELETE FROM file_keys WHERE key_id = ?", (header.key_info,))
+
+
+def delete_file_keys(cursor, file_id):
+    """Drop every data key belonging to a deleted file"""
+    cursor.execute("DELETE FROM file_keys WHERE file_id = ?", (file_id,))
+
+
+def rewrap_keys(cursor, user_id, old_password, new_password, kdf_salt, file_id=None):
+    """Work out a user's data keys (or one file's) re-wrapped from the old passphrase to the new one
+
+    Only reads, so the key derivations can run off the writer. Returns
+    (updates for store_rewrapped_keys, skipped); keys that don't open with
+    the old passphrase (files encrypted under a different one) are skipped.
+    """
+    query = "SELECT key_id, wrapped_key, wrap_info FROM file_keys WHERE user_id = ?"
+    params = (user_id,)
+    if file_id is not None:
+        query += " AND file_id = ?"
+        params += (file_id,)
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+
+    updates = []
+    skipped = 0
+    for key_id, wrapped, wrap_info in rows:
+        try:
+            data_key = unwrap_data_key(wrapped, wrap_info, key_id, old_password, scope=user_id)
+        except Exception:
+            skipped += 1
+            continue
+        new_wrapped, new_info = wrap_data_key(data_key, bytes(key_id), new_password, kdf_salt, scope=user_id)
+        updates.append((new_wrapped, new_info, key_id, wrapped))
+    return updates, skipped
+
+
+def store_rewrapped_keys(cursor, updates):
+    """Write job storing keys from rewrap_keys; returns how many were stored
+
+    A key re-wrapped by someone else in the meantime is left as they left it.
+    """
+    stored = 0
+    for update in updates:
+        cursor.execute("UPDATE file_keys SET wrapped_key = ?, wrap_info = ? WHERE key_id = ? AND wrapped_key = ?",
+                       update)
+        stored += cursor.rowcount
+    return stored
+
@@ -0,0 +1,68 @@
+import datetime
+from api.chunk_store import finish_file_data, delete_file_data, find_duplicate, link_file_data
+from api.compression import update_compression_ratio
+from api.envelope import delete_file_keys
+from api.search import unindex_file
+
+# Write jobs on users' files, used by both the web API (api/index.py,
+# api/asgi.py) and the desktop app. Those swapping in encrypted or
+# decrypted contents are in api/rewrite.py.
+#
+# An upload's row is created first with the action "Uploading", its chunks
+# are appended by their own short writes (see write_chunks in
+# api/chunk_store.py), and finish_file then records its size and hash; if
+# anything fails, discard_file removes the row and releases the chunks
+# again. Indexing for search is left to the caller, which extracts the text
+# off the writer once the upload has committed.
+
+
+def add_file(cursor, user_id, file_name, file_type, codec):
+    """Create the row of a file being uploaded and return its id; raises sqlite3.IntegrityError if the name is taken"""
+    cursor.execute(
+        "INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp, codec) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, file_name, 0, file_type, "Uploading",
+         datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), codec)
+    )
+    return cursor.lastrowid
+
+
+def finish_file(cursor, file_id, content_hash, file_size):
+    finish_file_data(cursor, file_id, content_hash)
+    cursor.execute("UPDATE files SET file_size = ?, action = 'Uploaded' WHERE id = ?", (file_size, file_id))
+    update_compression_ratio(cursor, file_id)
+
+
+def link_duplicate(cursor, user_id, file_name, file_type, codec, content_hash):
+    """Store a new file sharing the chunks of the user's file with this hash; returns (id, size), or None"""
+    # Looked up inside the write so the source can't be deleted in between
+    source_id = find_duplicate(cursor, content_hash, user_id=user_id)
+    if source_id is None:
+        return None
+    file_id = add_file(cursor, user_id, file_name, file_type, codec)
+    file_size = link_file_data(cursor, file_id, source_id)
+    cursor.execute("UPDATE files SET file_size = ?, action = 'Uploaded' WHERE id = ?", (file_size, file_id))
+    update_compression_ratio(cursor, file_id)
+    return file_id, file_size
+
+
+def discard_file(cursor, file_id):
+    delete_file_data(cursor, file_id)
+    cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+
+def log_action(cursor, file_id, action):
+    """Record the last thing done to a file, and when"""
+    cursor.execute(
+        "UPDATE files SET action = ?, timestamp = ? WHERE id = ?",
+        (action, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), file_id)
+    )
+
+
+def delete_job(cursor, user_id, file_name):
+    """Write job deleting one of a user's files with its chunks, keys and search entry"""
+    cursor.execute("SELECT id FROM files WHERE file_name = ? AND user_id = ?", (file_name, user_id))
+    for (file_id,) in cursor.fetchall():
+        delete_file_data(cursor, file_id)
+        delete_file_keys(cursor, file_id)
+        unindex_file(cursor, file_id)
+    cursor.execute("DELETE FROM files WHERE file_name = ? AND user_id = ?", (file_name, user_id))
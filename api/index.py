@@ -1,16 +1,38 @@
-from flask import Flask, request, jsonify, render_template, send_file, abort
+from flask import Flask, Response, request, jsonify, render_template, abort
 import sqlite3
 import os
-import bcrypt
-import base64
-import hashlib
-import io
-import datetime
+import sys
+import json
+import mimetypes
 import logging
-from cryptography.fernet import Fernet
+import threading
+import concurrent.futures
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 from flask_cors import CORS
 
+# Make the project root importable when run as `python api/index.py`
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api.chunk_store import (append_chunk, prepare_chunk, discard_stage, iter_file_data, stored_size, iter_file_range,
+                             dedup_stats, file_regions, iter_regions, CHUNK_SIZE, write_chunks)
+from api.stream_cipher import decrypt_pieces, plaintext_size, is_stream_encrypted
+from api.compression import choose_codec, decompress_after_decryption, file_codec
+from api.database import get_connection, get_writer
+from api.schema import init_schema, migrate_in_background
+from api.listing import DEFAULT_PAGE_SIZE, list_files, count_files
+from api.sessions import create_session_store, start_session_sweeper
+from api.auth import AuthBusy, auth_stats, check_password, hash_new_password, hash_password
+from api.search import DEFAULT_RESULTS, extract_text, index_file, search_files
+from api.batch import ARCHIVE_TYPES, batch_items, find_file, run_batch, archive_entries, iter_archive
+from api.resumable import (PART_SIZE, MAX_PARTS, new_attempt_id, create_upload, get_upload, list_uploads, list_parts,
+                           append_part_chunk, finish_part, discard_part, assemble_upload, abort_upload,
+                           start_upload_sweeper)
+from api.blob_store import start_blob_sweeper
+from api.files import add_file, finish_file, link_duplicate, discard_file, log_action, delete_job
+from api.rewrite import encrypt_contents, decrypt_contents, encrypted_job, decrypted_job, commit_rewrite
+from api.envelope import key_resolver, stream_header, rewrap_keys, store_rewrapped_keys
+from api.kdf import user_kdf_salt
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -71,24 +93,9 @@ def init_db():
             conn = sqlite3.connect(":memory:")
         else:
             # For local development, use file-based database
-            conn = sqlite3.connect("file_manager.db")
+            conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            username TEXT UNIQUE,
-                            password TEXT
-                        )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS files (
-                        id INTEGER PRIMARY KEY,
-                        user_id INTEGER,
-                        file_name TEXT,
-                        file_data BLOB,
-                        file_size INTEGER,
-                        file_type TEXT,
-                        action TEXT,
-                        timestamp TEXT,
-                        FOREIGN KEY(user_id) REFERENCES users(id)
-                    )''')
+        init_schema(cursor)
         conn.commit()
         logger.info("Database initialized successfully")
         
@@ -96,7 +103,7 @@ def init_db():
         if 'VERCEL' in os.environ:
             try:
                 # Use the same connection
-                hashed_password = bcrypt.hashpw("testuser123".encode('utf-8'), bcrypt.gensalt())
+                hashed_password = hash_password("testuser123")
                 cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", 
                             ("testuser", hashed_password))
                 conn.commit()
@@ -107,6 +114,8 @@ def init_db():
         # Only close connection if not on Vercel
         if 'VERCEL' not in os.environ:
             conn.close()
+            # Online migrations (moving old inline data) run while requests are served
+            migrate_in_background()
             return None
         return conn  # Return connection for Vercel environment
     except Exception as e:
@@ -130,10 +139,89 @@ def get_db_connection():
             db_connection = init_db()
         return db_connection
     else:
-        return sqlite3.connect("file_manager.db")
+        # Pooled; conn.close() hands the connection back for the next request
+        return get_connection()
+
+def submit_write(fn, *args):
+    """Queue `fn(cursor, *args)` as a write; returns a Future resolved once it has committed
+
+    Locally every write goes through the single writer thread (see
+    api/database.py) so concurrent requests queue instead of contending for
+    the database lock. On Vercel the one in-memory connection is written
+    directly.
+    """
+    if 'VERCEL' not in os.environ:
+        return get_writer().submit(fn, *args)
+    future = concurrent.futures.Future()
+    conn = get_db_connection()
+    try:
+        result = fn(conn.cursor(), *args)
+        conn.commit()
+        future.set_result(result)
+    except Exception as e:
+        conn.rollback()
+        future.set_exception(e)
+    return future
+
+def run_write(fn, *args):
+    """Run a write and return its result once it has committed"""
+    return submit_write(fn, *args).result()
+
+def log_write_failure(future):
+    """Done-callback for queued writes that nobody waits on"""
+    if future.exception() is not None:
+        logger.error(f"Background write failed: {future.exception()}")
+
+def auth_busy_response():
+    """503 for a password check refused because the auth pool's queue is full"""
+    response = jsonify({'success': False, 'message': 'Too many logins in progress, try again shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def find_user(username):
+    """(id, password hash) of a user, or None"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, password FROM users WHERE username = ?", (username,))
+    result = cursor.fetchone()
+    if 'VERCEL' not in os.environ:
+        conn.close()
+    return result
+
+def insert_user(cursor, username, hashed_password):
+    cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
+
+def update_password_hash(cursor, user_id, hashed_password):
+    cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed_password, user_id))
+
+def reindex_file(file_id):
+    """Refresh a file's search entry after its contents changed
+
+    The text is extracted on a read connection, so only the index update
+    itself is queued for the writer, which the response doesn't wait for.
+    """
+    try:
+        conn = get_db_connection()
+        try:
+            text = extract_text(conn.cursor(), file_id)
+        finally:
+            if 'VERCEL' not in os.environ:
+                conn.close()
+        submit_write(index_file, file_id, text).add_done_callback(log_write_failure)
+    except Exception as e:
+        logger.error(f"Indexing file {file_id} for search failed: {e}")
 
-# Session management (simple implementation for demonstration)
-sessions = {}
+# Logins, shared with the other worker processes through the database (see api/sessions.py)
+sessions = create_session_store()
+start_session_sweeper(sessions)
+# Resumable uploads nobody finished (see api/resumable.py)
+start_upload_sweeper(run_write)
+# Blobs of chunks no file uses any more (see api/blob_store.py)
+start_blob_sweeper(run_write)
+
+def current_session():
+    """The session named by the request's cookie, or None without a valid one"""
+    return sessions.get(request.cookies.get('session_id'))
 
 @app.route('/')
 def index():
@@ -152,16 +240,13 @@ def register():
     if not username or not password:
         return jsonify({'success': False, 'message': 'Username and password are required'})
     
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    try:
+        hashed_password = hash_new_password(password).result()
+    except AuthBusy:
+        return auth_busy_response()
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", 
-                     (username, hashed_password))
-        conn.commit()
-        if 'VERCEL' not in os.environ:
-            conn.close()
+        run_write(insert_user, username, hashed_password)
         
         response = jsonify({'success': True, 'message': f'User {username} registered successfully'})
         # Add CORS headers
@@ -181,31 +266,33 @@ def login():
         return jsonify({'success': False, 'message': 'Username and password are required'})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, password FROM users WHERE username = ?", (username,))
-        result = cursor.fetchone()
-        if 'VERCEL' not in os.environ:
-            conn.close()
+        result = find_user(username)
+        if result is None:
+            return jsonify({'success': False, 'message': 'Invalid username or password'})
         
-        if result and bcrypt.checkpw(password.encode('utf-8'), result[1]):
+        ok, new_hash = check_password(username, password, result[1]).result()
+        if ok:
             user_id = result[0]
-            session_id = base64.b64encode(os.urandom(24)).decode('utf-8')
-            sessions[session_id] = {'user_id': user_id, 'username': username}
+            if new_hash:
+                # Stored with an old cost factor; nobody needs to wait for the upgrade
+                submit_write(update_password_hash, user_id, new_hash).add_done_callback(log_write_failure)
+            session_id = sessions.create(user_id, username)
             response = jsonify({'success': True, 'message': 'Login successful', 'session_id': session_id})
             # Set SameSite=None for cross-site requests
             response.set_cookie('session_id', session_id, httponly=True, secure=True, samesite='None')
             return response
         else:
             return jsonify({'success': False, 'message': 'Invalid username or password'})
+    except AuthBusy:
+        return auth_busy_response()
     except Exception as e:
         return jsonify({'success': False, 'message': f'Login failed: {str(e)}'})
 
 @app.route('/api/logout', methods=['POST'])
 def logout():
     session_id = request.cookies.get('session_id')
-    if session_id and session_id in sessions:
-        del sessions[session_id]
+    if sessions.get(session_id) is not None:
+        sessions.delete(session_id)
         response = jsonify({'success': True, 'message': 'Logout successful'})
         response.delete_cookie('session_id', httponly=True, secure=True, samesite='None')
         return response
@@ -218,74 +305,294 @@ def status():
         "environment": "Vercel"
     })
 
-@app.route('/api/upload', methods=['POST'])
+def save_upload(user_id, filename, file_type, stream, expected_hash=None):
+    """Write an upload stream into the chunk store one chunk at a time
+
+    Returns (file_id, file_size, deduplicated). With `expected_hash`, a file
+    of the user's with that SHA-256 is linked to without reading the stream
+    at all; otherwise the upload is rejected if the received bytes don't
+    have that hash. Each chunk is hashed, compressed and stored on this
+    thread (prepare_chunk) and then inserted by its own queued write, so a
+    large upload doesn't hold the write lock for its whole duration.
+    """
+    codec = choose_codec(file_type, filename)
+    if expected_hash:
+        linked = run_write(link_duplicate, user_id, filename, file_type, codec, expected_hash)
+        if linked is not None:
+            return linked + (True,)
+    
+    file_id = run_write(add_file, user_id, filename, file_type, codec)
+    try:
+        file_size, content_hash = write_chunks(
+            stream, lambda seq, data: submit_write(append_chunk, file_id, seq, prepare_chunk(data, codec, run_write)))
+        if expected_hash and content_hash != expected_hash:
+            raise ValueError("Content does not match X-Content-SHA256")
+        run_write(finish_file, file_id, content_hash, file_size)
+        return file_id, file_size, False
+    except Exception:
+        run_write(discard_file, file_id)
+        raise
+
+@app.route('/api/upload', methods=['POST', 'PUT'])
 def upload_file():
-    session_id = request.cookies.get('session_id')
-    if not (session_id and session_id in sessions):
+    session = current_session()
+    if session is None:
         return jsonify({'success': False, 'message': 'Please login first'})
     
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'message': 'No file part'})
+    user_id = session['user_id']
+    content_hash = None
+    if request.mimetype != 'multipart/form-data':
+        # Raw upload: the request body is the file and the name comes from the
+        # query string. The body is read straight off the socket in bounded
+        # chunks, so memory use doesn't grow with the file size.
+        filename = secure_filename(request.args.get('filename', ''))
+        if not filename:
+            return jsonify({'success': False, 'message': 'Filename is required'})
+        file_type = request.mimetype
+        if not file_type or file_type == 'application/octet-stream':
+            file_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        stream = request.stream
+        # If the client sends the SHA-256 of the body and this user already
+        # stored those exact bytes, link to them without reading the body.
+        # Other users' files are not considered, so the check can't be used
+        # to learn what anyone else has uploaded (they still dedup by chunk).
+        content_hash = request.headers.get('X-Content-SHA256', '').strip().lower()
+    else:
+        if 'file' not in request.files:
+            return jsonify({'success': False, 'message': 'No file part'})
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'success': False, 'message': 'No selected file'})
+        
+        filename = secure_filename(file.filename)
+        file_type = file.content_type or 'application/octet-stream'
+        stream = file.stream
     
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'success': False, 'message': 'No selected file'})
+    try:
+        file_id, file_size, deduplicated = save_upload(user_id, filename, file_type, stream, content_hash)
+        reindex_file(file_id)
+        return jsonify({'success': True, 'message': 'File uploaded successfully', 'id': file_id, 'size': file_size,
+                        'deduplicated': deduplicated})
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'message': 'A file with this name already exists'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Upload failed: {str(e)}'})
+
+def find_upload(user_id, upload_id):
+    """The user's open resumable upload, or None"""
+    conn = get_db_connection()
+    upload = get_upload(conn.cursor(), upload_id, user_id)
+    if 'VERCEL' not in os.environ:
+        conn.close()
+    return upload
+
+def save_part(upload, part_number, stream, expected_hash=None):
+    """Write one part of a resumable upload into the chunk store as it arrives
+
+    Returns (size, SHA-256). The part only replaces an earlier copy once
+    all of it has been stored and, with `expected_hash`, has that hash.
+    """
+    upload_id = upload['upload_id']
+    attempt = new_attempt_id()
+    try:
+        size, content_hash = write_chunks(stream, lambda seq, data: submit_write(
+            append_part_chunk, upload_id, part_number, attempt, seq, prepare_chunk(data, upload['codec'], run_write)))
+        if expected_hash and content_hash != expected_hash:
+            raise ValueError("Content does not match X-Content-SHA256")
+        run_write(finish_part, upload_id, part_number, attempt, size, content_hash)
+        return size, content_hash
+    except Exception:
+        run_write(discard_part, upload_id, part_number, attempt)
+        raise
+
+def _complete_upload(cursor, user_id, upload_id, expected_parts):
+    upload = get_upload(cursor, upload_id, user_id)
+    if upload is None:
+        return None
+    file_id = add_file(cursor, user_id, upload['filename'], upload['file_type'], upload['codec'])
+    file_size, content_hash = assemble_upload(cursor, upload_id, file_id, expected_parts)
+    finish_file(cursor, file_id, content_hash, file_size)
+    return file_id, file_size
+
+def _abort_upload(cursor, user_id, upload_id):
+    return get_upload(cursor, upload_id, user_id) is not None and abort_upload(cursor, upload_id)
+
+# Resumable uploads: POST /api/uploads opens one, each part is PUT to
+# /api/uploads/<id>/parts/<n> (n from 1, in any order, retried as needed),
+# and POST /api/uploads/<id>/complete turns them into the file.
+@app.route('/api/uploads', methods=['POST'])
+def start_upload():
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    data = request.json or {}
+    filename = secure_filename(data.get('filename', ''))
+    if not filename:
+        return jsonify({'success': False, 'message': 'Filename is required'})
+    file_type = data.get('file_type') or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
     
     try:
-        filename = secure_filename(file.filename)
-        file_data = file.read()
-        file_size = len(file_data)
-        file_type = file.content_type or 'application/octet-stream'
-        
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO files (user_id, file_name, file_data, file_size, file_type, action, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (sessions[session_id]['user_id'], filename, file_data, file_size, file_type, "Uploaded", 
-             datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        )
-        conn.commit()
+        cursor.execute("SELECT 1 FROM files WHERE file_name = ? AND user_id = ?", (filename, session['user_id']))
+        exists = cursor.fetchone() is not None
         if 'VERCEL' not in os.environ:
             conn.close()
-        
-        return jsonify({'success': True, 'message': 'File uploaded successfully'})
+        if exists:
+            # Checked again on completion; this just saves sending the parts for nothing
+            return jsonify({'success': False, 'message': 'A file with this name already exists'})
+        upload_id = run_write(create_upload, session['user_id'], filename, file_type, choose_codec(file_type, filename))
+        return jsonify({'success': True, 'upload_id': upload_id, 'part_size': PART_SIZE, 'max_parts': MAX_PARTS})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Failed to start upload: {str(e)}'})
+
+@app.route('/api/uploads', methods=['GET'])
+def get_uploads():
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    conn = get_db_connection()
+    uploads = list_uploads(conn.cursor(), session['user_id'])
+    if 'VERCEL' not in os.environ:
+        conn.close()
+    return jsonify({'success': True, 'uploads': uploads})
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload_parts(upload_id):
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    upload = find_upload(session['user_id'], upload_id)
+    if upload is None:
+        return jsonify({'success': False, 'message': 'Upload not found'})
+    conn = get_db_connection()
+    upload['parts'] = list_parts(conn.cursor(), upload_id)
+    if 'VERCEL' not in os.environ:
+        conn.close()
+    return jsonify({'success': True, **upload})
+
+@app.route('/api/uploads/<upload_id>/parts/<int:part_number>', methods=['PUT'])
+def upload_part(upload_id, part_number):
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    if not 1 <= part_number <= MAX_PARTS:
+        return jsonify({'success': False, 'message': f'Part numbers go from 1 to {MAX_PARTS}'})
+    upload = find_upload(session['user_id'], upload_id)
+    if upload is None:
+        return jsonify({'success': False, 'message': 'Upload not found'})
+    
+    try:
+        size, content_hash = save_part(upload, part_number, request.stream,
+                                       request.headers.get('X-Content-SHA256', '').strip().lower())
+        return jsonify({'success': True, 'part_number': part_number, 'size': size, 'sha256': content_hash})
+    except LookupError:
+        return jsonify({'success': False, 'message': 'Upload not found'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Part upload failed: {str(e)}'})
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    # Optionally the parts the client sent, [{part_number, sha256}], to check against
+    expected_parts = (request.get_json(silent=True) or {}).get('parts')
+    try:
+        completed = run_write(_complete_upload, session['user_id'], upload_id, expected_parts)
+        if completed is None:
+            return jsonify({'success': False, 'message': 'Upload not found'})
+        file_id, file_size = completed
+        reindex_file(file_id)
+        return jsonify({'success': True, 'message': 'File uploaded successfully', 'id': file_id, 'size': file_size})
+    except sqlite3.IntegrityError:
+        return jsonify({'success': False, 'message': 'A file with this name already exists'})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Upload failed: {str(e)}'})
 
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    try:
+        if not run_write(_abort_upload, session['user_id'], upload_id):
+            return jsonify({'success': False, 'message': 'Upload not found'})
+        return jsonify({'success': True, 'message': 'Upload cancelled'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Failed to cancel upload: {str(e)}'})
+
 @app.route('/api/files')
 def get_files():
-    session_id = request.cookies.get('session_id')
-    if not (session_id and session_id in sessions):
+    session = current_session()
+    if session is None:
         return jsonify({'success': False, 'message': 'Please login first'})
     
+    # Paged: pass the returned next_after_id back as after_id for the next page
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT id, file_name, file_size, file_type, action, timestamp FROM files WHERE user_id = ?", 
-            (sessions[session_id]['user_id'],)
-        )
-        rows = cursor.fetchall()
-        if 'VERCEL' not in os.environ:
-            conn.close()
-        
-        files = [{
-            'id': row[0],
-            'name': row[1],
-            'size': row[2],
-            'type': row[3],
-            'action': row[4],
-            'timestamp': row[5]
-        } for row in rows]
-        
-        return jsonify({'success': True, 'files': files})
+        return jsonify(files_page(session['user_id'], request.args))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Failed to get files: {str(e)}'})
 
+def files_page(user_id, args):
+    """Body of an /api/files response for the query arguments `args` (a MultiDict)
+
+    Raises ValueError for invalid arguments.
+    """
+    order = args.get('order')
+    if order not in (None, 'asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    filters = {
+        'file_type': args.get('type'),
+        'action': args.get('action'),
+        'min_size': args.get('min_size', type=int),
+        'max_size': args.get('max_size', type=int),
+    }
+    sort = args.get('sort', 'timestamp')
+    descending = None if order is None else order == 'desc'
+    after_id = args.get('after_id', type=int)
+    limit = args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        rows, next_after_id = list_files(cursor, user_id, sort, descending, after_id, limit, **filters)
+        total = count_files(cursor, user_id, **filters) if args.get('count') in ('1', 'true') else None
+    finally:
+        if 'VERCEL' not in os.environ:
+            conn.close()
+    
+    files = [{
+        'id': row[0],
+        'name': row[1],
+        'size': row[2],
+        'type': row[3],
+        'action': row[4],
+        'timestamp': row[5],
+        'codec': row[6],
+        'compression_ratio': row[7]
+    } for row in rows]
+    
+    response = {'success': True, 'files': files, 'next_after_id': next_after_id}
+    if total is not None:
+        response['total'] = total
+    return response
+
 @app.route('/api/download')
 def download_file():
-    session_id = request.cookies.get('session_id')
-    if not (session_id and session_id in sessions):
+    session = current_session()
+    if session is None:
         return jsonify({'success': False, 'message': 'Please login first'})
     
     filename = request.args.get('filename')
@@ -296,8 +603,8 @@ def download_file():
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute(
-            "SELECT file_data, file_type FROM files WHERE file_name = ? AND user_id = ?", 
-            (filename, sessions[session_id]['user_id'])
+            "SELECT id, file_type, content_hash FROM files WHERE file_name = ? AND user_id = ?", 
+            (filename, session['user_id'])
         )
         result = cursor.fetchone()
         
@@ -306,31 +613,134 @@ def download_file():
                 conn.close()
             return jsonify({'success': False, 'message': 'File not found'})
         
-        file_data, file_type = result
+        file_id, file_type, content_hash = result
+        length = stored_size(cursor, file_id)
+        etag = content_hash or f"legacy-{file_id}-{length}"
         
-        # Log the download
-        cursor.execute(
-            "UPDATE files SET action = 'Downloaded', timestamp = ? WHERE file_name = ? AND user_id = ?", 
-            (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), filename, sessions[session_id]['user_id'])
-        )
-        conn.commit()
-        if 'VERCEL' not in os.environ:
-            conn.close()
+        # Encrypted files can be decrypted on the fly when the password is supplied
+        password = request.headers.get('X-File-Password')
+        if password:
+            return decrypted_download(conn, file_id, file_type, filename, etag, length, password,
+                                      session['user_id'])
         
-        response = send_file(
-            io.BytesIO(file_data),
-            mimetype=file_type,
-            as_attachment=True,
-            download_name=filename
-        )
+        if request.if_none_match.contains(etag):
+            if 'VERCEL' not in os.environ:
+                conn.close()
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        # Honour a single byte range unless If-Range says the file has changed
+        start, stop = 0, length
+        partial = False
+        if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+            if_range = request.if_range
+            if not (if_range.etag or if_range.date) or if_range.etag == etag:
+                byte_range = request.range.range_for_length(length)
+                if byte_range is None:
+                    if 'VERCEL' not in os.environ:
+                        conn.close()
+                    response = Response(status=416)
+                    response.headers['Content-Range'] = f'bytes */{length}'
+                    return response
+                start, stop = byte_range
+                partial = True
+        
+        # Log the download once, not for every follow-up range request; the
+        # response doesn't wait for the write
+        if start == 0:
+            submit_write(log_action, file_id, 'Downloaded').add_done_callback(log_write_failure)
+        
+        regions = file_regions(cursor, file_id, start, stop) if stop > start else None
+        if regions is not None:
+            # Read straight from the storage backend's files; the connection isn't needed any more
+            if 'VERCEL' not in os.environ:
+                conn.close()
+            body = region_body(regions)
+        else:
+            def generate():
+                try:
+                    for piece in iter_file_range(conn.cursor(), file_id, start, stop):
+                        yield piece
+                finally:
+                    if 'VERCEL' not in os.environ:
+                        conn.close()
+            body = generate()
+        
+        response = Response(body, status=206 if partial else 200, mimetype=file_type, direct_passthrough=True)
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Accept-Ranges'] = 'bytes'
+        if partial:
+            response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+        response.set_etag(etag)
         return response
     except Exception as e:
         return jsonify({'success': False, 'message': f'Download failed: {str(e)}'})
 
+def region_body(regions):
+    """Response body of file regions (from file_regions)
+
+    A body that is the rest of a single file goes through the server's
+    wsgi.file_wrapper, which gunicorn sends with sendfile: the bytes go from
+    the page cache to the socket without being copied into Python.
+    """
+    if len(regions) == 1:
+        path, offset, length = regions[0]
+        blob = open(path, 'rb')
+        if os.fstat(blob.fileno()).st_size == offset + length:
+            blob.seek(offset)
+            return wrap_file(request.environ, blob, CHUNK_SIZE)
+        blob.close()
+    return iter_regions(regions)
+
+def decrypted_download(conn, file_id, file_type, filename, etag, length, password, user_id):
+    """Stream the plaintext of a segment-encrypted file without storing it"""
+    cursor = conn.cursor()
+    header = stream_header(cursor, file_id)
+    if header is None:
+        if 'VERCEL' not in os.environ:
+            conn.close()
+        return jsonify({'success': False, 'message': 'File is not encrypted'})
+    
+    codec = file_codec(cursor, file_id)
+    plaintext = decompress_after_decryption(
+        decrypt_pieces(iter_file_data(cursor, file_id), password, key=key_resolver(cursor, password, scope=user_id)),
+        codec)
+    try:
+        # Authenticate the first segment before committing to a response
+        first = next(plaintext)
+    except Exception:
+        if 'VERCEL' not in os.environ:
+            conn.close()
+        return jsonify({'success': False, 'message': 'Decryption failed. Incorrect password!'})
+    
+    def generate():
+        try:
+            yield first
+            for piece in plaintext:
+                yield piece
+        finally:
+            if 'VERCEL' not in os.environ:
+                conn.close()
+    
+    if codec and not is_stream_encrypted(first):
+        # Decompressed back to the original upload
+        cursor.execute("SELECT file_size FROM files WHERE id = ?", (file_id,))
+        content_length = cursor.fetchone()[0]
+    else:
+        content_length = plaintext_size(length, header)
+    
+    response = Response(generate(), mimetype=file_type, direct_passthrough=True)
+    response.headers['Content-Length'] = str(content_length)
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.set_etag(f"{etag}-plain", weak=True)
+    return response
+
 @app.route('/api/delete', methods=['DELETE'])
 def delete_file():
-    session_id = request.cookies.get('session_id')
-    if not (session_id and session_id in sessions):
+    session = current_session()
+    if session is None:
         return jsonify({'success': False, 'message': 'Please login first'})
     
     filename = request.args.get('filename')
@@ -338,24 +748,44 @@ def delete_file():
         return jsonify({'success': False, 'message': 'Filename is required'})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "DELETE FROM files WHERE file_name = ? AND user_id = ?", 
-            (filename, sessions[session_id]['user_id'])
-        )
-        conn.commit()
-        if 'VERCEL' not in os.environ:
-            conn.close()
+        run_write(delete_job, session['user_id'], filename)
         
         return jsonify({'success': True, 'message': 'File deleted successfully'})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Delete failed: {str(e)}'})
 
+def rewrite_file(user_id, filename, password, stage, job):
+    """Encrypt or decrypt one of a user's files in place; returns its id, or None if there is no such file
+
+    `stage` (encrypt_contents or decrypt_contents) reads and transforms the
+    contents on this thread, storing them as staged chunks; only those
+    chunk writes and the short `job` swapping them in go to the writer
+    (see api/rewrite.py).
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM files WHERE file_name = ? AND user_id = ?", (filename, user_id))
+        result = cursor.fetchone()
+        if not result:
+            return None
+        rewrite = stage(cursor, submit_write, result[0], user_id, password)
+    finally:
+        if 'VERCEL' not in os.environ:
+            conn.close()
+    commit_rewrite(submit_write, rewrite, job)
+    return rewrite.file_id
+
+def encrypt_user_file(user_id, filename, password):
+    return rewrite_file(user_id, filename, password, encrypt_contents, encrypted_job)
+
+def decrypt_user_file(user_id, filename, password):
+    return rewrite_file(user_id, filename, password, decrypt_contents, decrypted_job)
+
 @app.route('/api/encrypt', methods=['POST'])
 def encrypt_file():
-    session_id = request.cookies.get('session_id')
-    if not (session_id and session_id in sessions):
+    session = current_session()
+    if session is None:
         return jsonify({'success': False, 'message': 'Please login first'})
     
     data = request.json
@@ -366,44 +796,17 @@ def encrypt_file():
         return jsonify({'success': False, 'message': 'Filename and password are required'})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT file_data FROM files WHERE file_name = ? AND user_id = ?", 
-            (filename, sessions[session_id]['user_id'])
-        )
-        result = cursor.fetchone()
-        
-        if not result:
-            if 'VERCEL' not in os.environ:
-                conn.close()
+        if not encrypt_user_file(session['user_id'], filename, password):
             return jsonify({'success': False, 'message': 'File not found'})
         
-        # Generate key from password
-        key = base64.urlsafe_b64encode(hashlib.sha256(password.encode()).digest())
-        cipher = Fernet(key)
-        
-        # Encrypt file data
-        encrypted_data = cipher.encrypt(result[0])
-        
-        # Update database
-        cursor.execute(
-            "UPDATE files SET file_data = ?, action = 'Encrypted', timestamp = ? WHERE file_name = ? AND user_id = ?", 
-            (encrypted_data, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 
-             filename, sessions[session_id]['user_id'])
-        )
-        conn.commit()
-        if 'VERCEL' not in os.environ:
-            conn.close()
-        
         return jsonify({'success': True, 'message': 'File encrypted successfully'})
     except Exception as e:
         return jsonify({'success': False, 'message': f'Encryption failed: {str(e)}'})
 
 @app.route('/api/decrypt', methods=['POST'])
 def decrypt_file():
-    session_id = request.cookies.get('session_id')
-    if not (session_id and session_id in sessions):
+    session = current_session()
+    if session is None:
         return jsonify({'success': False, 'message': 'Please login first'})
     
     data = request.json
@@ -414,44 +817,252 @@ def decrypt_file():
         return jsonify({'success': False, 'message': 'Filename and password are required'})
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT file_data FROM files WHERE file_name = ? AND user_id = ?", 
-            (filename, sessions[session_id]['user_id'])
-        )
-        result = cursor.fetchone()
+        user_id = session['user_id']
         
-        if not result:
+        try:
+            file_id = decrypt_user_file(user_id, filename, password)
+            if not file_id:
+                return jsonify({'success': False, 'message': 'File not found'})
+            reindex_file(file_id)
+            return jsonify({'success': True, 'message': 'File decrypted successfully'})
+        except:
+            # A bad segment can surface after some plaintext was staged; the
+            # file keeps its contents and the staged chunks are released
+            return jsonify({'success': False, 'message': 'Decryption failed. Incorrect password!'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Decryption failed: {str(e)}'})
+
+def _batch_delete_job(user_id):
+    """Write job deleting one file of a batch, given by id or name"""
+    done = set()
+    
+    def job(cursor, item):
+        found = find_file(cursor, user_id, item)
+        if found is None:
+            raise LookupError("File not found")
+        file_id, filename = found
+        if file_id in done:
+            # Listed again under its other identifier
+            return file_id
+        delete_job(cursor, user_id, filename)
+        done.add(file_id)
+        return file_id
+    return job
+
+def _batch_rewrite(operation, user_id, password):
+    """(prepare, job, discard) encrypting or decrypting the files of a batch, for run_batch
+
+    prepare stages a file's new contents on the batch pool; the group's
+    write job only swaps them in.
+    """
+    stage, swap = ((encrypt_contents, encrypted_job) if operation == 'encrypt'
+                   else (decrypt_contents, decrypted_job))
+    claimed = set()
+    lock = threading.Lock()
+    
+    def prepare(item):
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            found = find_file(cursor, user_id, item)
+            if found is None:
+                raise LookupError("File not found")
+            file_id = found[0]
+            with lock:
+                if file_id in claimed:
+                    # Listed again under its other identifier
+                    return file_id
+                claimed.add(file_id)
+            try:
+                return stage(cursor, submit_write, file_id, user_id, password)
+            except Exception:
+                if operation == 'decrypt':
+                    raise ValueError("Decryption failed. Incorrect password!")
+                raise
+        finally:
             if 'VERCEL' not in os.environ:
                 conn.close()
-            return jsonify({'success': False, 'message': 'File not found'})
-        
-        # Generate key from password
-        key = base64.urlsafe_b64encode(hashlib.sha256(password.encode()).digest())
-        cipher = Fernet(key)
-        
+    
+    def job(cursor, rewrite):
+        if isinstance(rewrite, int):
+            return rewrite
+        swap(cursor, rewrite)
+        return rewrite.file_id
+    
+    def discard(cursor, rewrite):
+        if not isinstance(rewrite, int):
+            discard_stage(cursor, rewrite.stage_id)
+    return prepare, job, discard
+
+BATCH_OPERATIONS = ('encrypt', 'decrypt', 'delete')
+
+def batch_stream(user_id, operation, items, password=None):
+    """Run a batch operation, yielding a JSON line per file as its group commits, then a summary line"""
+    succeeded = failed = 0
+    if operation == 'delete':
+        results = run_batch(submit_write, _batch_delete_job(user_id), items)
+    else:
+        prepare, job, discard = _batch_rewrite(operation, user_id, password)
+        results = run_batch(submit_write, job, items, prepare, discard)
+    for item, ok, result in results:
+        if ok:
+            succeeded += 1
+            if operation == 'decrypt':
+                reindex_file(result)
+            line = {'file': item, 'success': True, 'id': result}
+        else:
+            failed += 1
+            line = {'file': item, 'success': False, 'message': result}
+        yield (json.dumps(line) + '\n').encode('utf-8')
+    yield (json.dumps({'done': True, 'succeeded': succeeded, 'failed': failed}) + '\n').encode('utf-8')
+
+def _log_downloads(cursor, file_ids):
+    for file_id in file_ids:
+        log_action(cursor, file_id, 'Downloaded')
+
+def open_archive(user_id, items, archive_format):
+    """Start a streamed archive of a user's files; returns (iterator of bytes, None) or (None, error message)"""
+    if archive_format not in ARCHIVE_TYPES:
+        return None, f"format must be one of {', '.join(ARCHIVE_TYPES)}"
+    conn = get_db_connection()
+    entries, missing = archive_entries(conn.cursor(), user_id, items)
+    if missing:
+        if 'VERCEL' not in os.environ:
+            conn.close()
+        return None, f"Files not found: {', '.join(map(str, missing[:10]))}"
+    submit_write(_log_downloads, [entry[0] for entry in entries]).add_done_callback(log_write_failure)
+    
+    def generate():
         try:
-            # Decrypt file data
-            decrypted_data = cipher.decrypt(result[0])
-            
-            # Update database
-            cursor.execute(
-                "UPDATE files SET file_data = ?, action = 'Decrypted', timestamp = ? WHERE file_name = ? AND user_id = ?", 
-                (decrypted_data, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 
-                 filename, sessions[session_id]['user_id'])
-            )
-            conn.commit()
+            for piece in iter_archive(conn.cursor(), entries, archive_format):
+                yield piece
+        finally:
             if 'VERCEL' not in os.environ:
                 conn.close()
-            
-            return jsonify({'success': True, 'message': 'File decrypted successfully'})
-        except:
+    return generate(), None
+
+# Batch operations: POST {"files": [ids or names], "password": ...} to
+# /api/batch/encrypt, /decrypt or /delete for a line of JSON per file as it
+# is done, or {"files": [...], "format": "zip" or "tar"} to /api/batch/archive
+# to download them in one archive.
+@app.route('/api/batch/<operation>', methods=['POST'])
+def batch(operation):
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    if operation not in BATCH_OPERATIONS and operation != 'archive':
+        return jsonify({'success': False, 'message': f'Unknown batch operation {operation}'})
+    data = request.get_json(silent=True) or {}
+    try:
+        items = batch_items(data.get('files'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)})
+    
+    if operation == 'archive':
+        archive_format = data.get('format', 'zip')
+        try:
+            pieces, error = open_archive(session['user_id'], items, archive_format)
+        except Exception as e:
+            return jsonify({'success': False, 'message': f'Archive failed: {str(e)}'})
+        if error:
+            return jsonify({'success': False, 'message': error})
+        response = Response(pieces, mimetype=ARCHIVE_TYPES[archive_format], direct_passthrough=True)
+        response.headers.set('Content-Disposition', 'attachment', filename=f'files.{archive_format}')
+        return response
+    
+    password = data.get('password')
+    if operation != 'delete' and not password:
+        return jsonify({'success': False, 'message': 'Password is required'})
+    return Response(batch_stream(session['user_id'], operation, items, password), mimetype='application/x-ndjson')
+
+@app.route('/api/rotate-passphrase', methods=['POST'])
+def rotate_file_passphrase():
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    data = request.json
+    old_password = data.get('old_password')
+    new_password = data.get('new_password')
+    filename = data.get('filename')
+    
+    if not old_password or not new_password:
+        return jsonify({'success': False, 'message': 'Old and new password are required'})
+    
+    try:
+        user_id = session['user_id']
+        kdf_salt = run_write(user_kdf_salt, user_id)
+        
+        # Only the wrapped data keys change; file contents are never touched. The
+        # key derivations run on a read connection, and only the new rows go to the writer
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            file_id = None
+            if filename:
+                cursor.execute("SELECT id FROM files WHERE file_name = ? AND user_id = ?", (filename, user_id))
+                result = cursor.fetchone()
+                if not result:
+                    return jsonify({'success': False, 'message': 'File not found'})
+                file_id = result[0]
+            updates, skipped = rewrap_keys(cursor, user_id, old_password, new_password, kdf_salt, file_id)
+        finally:
             if 'VERCEL' not in os.environ:
                 conn.close()
-            return jsonify({'success': False, 'message': 'Decryption failed. Incorrect password!'})
+        rotated = run_write(store_rewrapped_keys, updates)
+        
+        return jsonify({'success': True, 'message': f'Password changed for {rotated} file key(s)',
+                        'rotated': rotated, 'skipped': skipped})
     except Exception as e:
-        return jsonify({'success': False, 'message': f'Decryption failed: {str(e)}'})
+        return jsonify({'success': False, 'message': f'Password change failed: {str(e)}'})
+
+@app.route('/api/search')
+def search():
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'success': False, 'message': 'Search query is required'})
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        rows = search_files(cursor, session['user_id'], query,
+                            request.args.get('limit', DEFAULT_RESULTS, type=int))
+        if 'VERCEL' not in os.environ:
+            conn.close()
+        
+        results = [{
+            'id': row[0],
+            'name': row[1],
+            'type': row[2],
+            'size': row[3],
+            'timestamp': row[4],
+            'snippet': row[5]
+        } for row in rows]
+        
+        return jsonify({'success': True, 'results': results})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Search failed: {str(e)}'})
+
+@app.route('/api/storage-stats')
+def storage_stats():
+    session = current_session()
+    if session is None:
+        return jsonify({'success': False, 'message': 'Please login first'})
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        stats = dedup_stats(cursor, session['user_id'])
+        if 'VERCEL' not in os.environ:
+            conn.close()
+        return jsonify({'success': True, 'stats': stats})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error getting storage stats: {str(e)}'})
 
 # Add a health check endpoint for Vercel
 @app.route('/api/health')
@@ -461,9 +1072,13 @@ def health_check():
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT 1")
+        body = {'status': 'healthy', 'environment': 'Vercel' if 'VERCEL' in os.environ else 'Local',
+                'sessions': sessions.stats(), 'auth': auth_stats()}
         if 'VERCEL' not in os.environ:
             conn.close()
-        return jsonify({'status': 'healthy', 'environment': 'Vercel' if 'VERCEL' in os.environ else 'Local'})
+            # Transactions committed by this process's writer, and the jobs in them
+            body['writes'] = get_writer().stats()
+        return jsonify(body)
     except Exception as e:
         return jsonify({'status': 'unhealthy', 'error': str(e)}), 500
 
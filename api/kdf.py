@@ -0,0 +1,139 @@
+import os
+import hmac
+import time
+import struct
+import hashlib
+import threading
+import collections
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# Password-based key derivation.
+#
+# An expensive KDF (scrypt by default, PBKDF2 as a fallback) turns a
+# password and a per-user salt into a master key; every file then gets its
+# own key via HKDF over the master key and a random per-file salt. The
+# expensive step is cached, so decrypting many files encrypted with the
+# same passphrase costs one KDF run rather than one per file.
+KdfParams = collections.namedtuple("KdfParams", "name log2_n r p iterations")
+
+KDF_SCRYPT = 1
+KDF_PBKDF2 = 2
+KDF_IDS = {"scrypt": KDF_SCRYPT, "pbkdf2": KDF_PBKDF2}
+KDF_NAMES = {value: key for key, value in KDF_IDS.items()}
+
+DEFAULT_KDF = KdfParams("scrypt", int(os.environ.get("SFMS_SCRYPT_LOG2N", 15)), 8, 1, 0)
+PBKDF2_KDF = KdfParams("pbkdf2", 0, 0, 0, int(os.environ.get("SFMS_PBKDF2_ITERATIONS", 600000)))
+
+SALT_SIZE = 16
+KEY_SIZE = 32
+# kdf id | log2 N | r | p | iterations | kdf salt | file salt
+KDF_BLOCK_FORMAT = ">BBBBI16s16s"
+KDF_BLOCK_SIZE = struct.calcsize(KDF_BLOCK_FORMAT)
+
+
+def user_kdf_salt(cursor, user_id):
+    """Return the user's KDF salt, creating one on first use"""
+    if user_id is None:
+        return os.urandom(SALT_SIZE)
+    cursor.execute("SELECT kdf_salt FROM users WHERE id = ?", (user_id,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        return bytes(row[0])
+    salt = os.urandom(SALT_SIZE)
+    cursor.execute("UPDATE users SET kdf_salt = ? WHERE id = ?", (salt, user_id))
+    return salt
+
+
+def pack_kdf_block(params, kdf_salt, file_salt):
+    """Serialize KDF parameters and salts for a stream header"""
+    return struct.pack(KDF_BLOCK_FORMAT, KDF_IDS[params.name], params.log2_n, params.r, params.p,
+                       params.iterations, kdf_salt, file_salt)
+
+
+def unpack_kdf_block(block):
+    """Return (params, kdf_salt, file_salt) from a stream header's KDF block"""
+    kdf_id, log2_n, r, p, iterations, kdf_salt, file_salt = struct.unpack(KDF_BLOCK_FORMAT, block)
+    if kdf_id not in KDF_NAMES:
+        raise ValueError(f"Unknown key derivation function {kdf_id}")
+    return KdfParams(KDF_NAMES[kdf_id], log2_n, r, p, iterations), kdf_salt, file_salt
+
+
+def run_kdf(password, salt, params):
+    """Run the expensive password KDF and return a master key"""
+    if params.name == "scrypt":
+        n = 1 << params.log2_n
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=params.r, p=params.p,
+                              maxmem=256 * n * params.r + 1024 * 1024, dklen=KEY_SIZE)
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, params.iterations, dklen=KEY_SIZE)
+
+
+class KeyCache:
+    """Bounded LRU of derived master keys that expire after `ttl` seconds"""
+
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Passwords are only ever kept as an HMAC under a per-process secret
+        self._secret = os.urandom(32)
+
+    def _fingerprint(self, password):
+        return hmac.new(self._secret, password.encode(), hashlib.sha256).digest()
+
+    def get(self, scope, salt, params, password):
+        cache_key = (scope, salt, params, self._fingerprint(password))
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[cache_key]
+            self.misses += 1
+        return None
+
+    def put(self, scope, salt, params, password, key):
+        if self.max_entries <= 0:
+            return
+        cache_key = (scope, salt, params, self._fingerprint(password))
+        with self._lock:
+            self._entries[cache_key] = (key, time.monotonic() + self.ttl)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {'entries': size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+key_cache = KeyCache(int(os.environ.get("SFMS_KDF_CACHE_SIZE", 256)),
+                     int(os.environ.get("SFMS_KDF_CACHE_TTL", 300)))
+
+
+def master_key(password, salt, params, scope=None, cache=None):
+    """Derive (or fetch from the cache) the master key for a password, salt and parameters"""
+    cache = key_cache if cache is None else cache
+    key = cache.get(scope, salt, params, password)
+    if key is None:
+        key = run_kdf(password, salt, params)
+        cache.put(scope, salt, params, password, key)
+    return key
+
+
+def file_key(master, file_salt):
+    """Derive the per-file encryption key from a master key"""
+    return HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE, salt=file_salt,
+                info=b"sfms file key").derive(master)
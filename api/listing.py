@@ -0,0 +1,83 @@
+# Paged listing of a user's files.
+#
+# Pages are keyset-paginated: the next page starts after the (sort value,
+# id) of the last row of the previous one, which the client passes back as
+# `after_id`. Every sort key has a (user_id, column) index, so fetching a
+# page is an index range scan of `limit` rows wherever it starts, however
+# many files the user owns. OFFSET would instead walk every skipped row.
+
+# Sort key -> (column, descending by default)
+SORT_KEYS = {
+    "name": ("file_name", False),
+    "size": ("file_size", True),
+    "timestamp": ("timestamp", True),
+}
+LISTING_COLUMNS = "id, file_name, file_size, file_type, action, timestamp, codec, compression_ratio"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def _filter_clauses(user_id, file_type=None, action=None, min_size=None, max_size=None):
+    """WHERE clauses and parameters for the listing filters
+
+    `file_type` is a MIME type, or a major type such as "image/*".
+    """
+    clauses = ["user_id = ?"]
+    params = [user_id]
+    if file_type:
+        if file_type.endswith("/*"):
+            major = file_type[:-1]
+            clauses.append("file_type >= ? AND file_type < ?")
+            params += [major, major[:-1] + chr(ord("/") + 1)]
+        else:
+            clauses.append("file_type = ?")
+            params.append(file_type)
+    if action:
+        clauses.append("action = ?")
+        params.append(action)
+    if min_size is not None:
+        clauses.append("file_size >= ?")
+        params.append(min_size)
+    if max_size is not None:
+        clauses.append("file_size <= ?")
+        params.append(max_size)
+    return clauses, params
+
+
+def list_files(cursor, user_id, sort="timestamp", descending=None, after_id=None, limit=DEFAULT_PAGE_SIZE,
+               columns=LISTING_COLUMNS, **filters):
+    """Return (rows, next_after_id) for one page of a user's files
+
+    Rows hold `columns`, which must start with id. `next_after_id` is None
+    on the last page. Filters are those of _filter_clauses. Raises
+    ValueError for an unknown sort key or an `after_id` that isn't one of
+    the user's files.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort key {sort}; use one of {', '.join(SORT_KEYS)}")
+    column, default_descending = SORT_KEYS[sort]
+    descending = default_descending if descending is None else descending
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    clauses, params = _filter_clauses(user_id, **filters)
+    if after_id is not None:
+        cursor.execute(f"SELECT {column} FROM files WHERE id = ? AND user_id = ?", (after_id, user_id))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError("after_id is not one of your files")
+        # Row values compare column by column, matching the index order
+        clauses.append(f"({column}, id) {'<' if descending else '>'} (?, ?)")
+        params += [row[0], after_id]
+    order = "DESC" if descending else "ASC"
+    # One extra row tells whether there is a next page
+    cursor.execute(f'''SELECT {columns} FROM files WHERE {" AND ".join(clauses)}
+                       ORDER BY {column} {order}, id {order} LIMIT ?''', params + [limit + 1])
+    rows = cursor.fetchall()
+    next_after_id = rows[limit - 1][0] if len(rows) > limit else None
+    return rows[:limit], next_after_id
+
+
+def count_files(cursor, user_id, **filters):
+    """Number of a user's files matching the listing filters"""
+    clauses, params = _filter_clauses(user_id, **filters)
+    cursor.execute(f"SELECT COUNT(*) FROM files WHERE {' AND '.join(clauses)}", params)
+    return cursor.fetchone()[0]
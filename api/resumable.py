@@ -0,0 +1,246 @@
+import os
+import time
+import logging
+import hashlib
+import secrets
+import threading
+from api.chunk_store import CHUNK_SIZE, put_chunk, release_chunks
+
+logger = logging.getLogger(__name__)
+
+# Resumable uploads.
+#
+# A client opens an upload, sends the file as numbered parts in any order
+# and over as many connections as it likes, then completes it. Each part's
+# chunks go into the chunk store as they arrive and are listed in
+# `upload_chunks`, which holds a reference to them just as a file manifest
+# does, so after a dropped connection only the unfinished part is sent
+# again. Completing an upload copies the part manifests into a new file's
+# manifest and hands over their chunk references; no file bytes are read.
+#
+# Every PUT of a part is an "attempt" with its own chunk rows. An attempt
+# becomes the part's contents once all of it has arrived (and matched the
+# client's SHA-256, if one was sent), replacing any earlier attempt, so a
+# retried part never mixes with the remains of a failed one.
+#
+# The file's content hash is the SHA-256 of its bytes for a single part.
+# For several parts it is the SHA-256 of the part hashes with "-<parts>"
+# appended, as S3 does, since the whole-file hash would mean reading the
+# file back.
+#
+# Uploads left untouched for UPLOAD_EXPIRY seconds are aborted by a sweep
+# and their chunks released.
+UPLOAD_EXPIRY = int(os.environ.get("SFMS_UPLOAD_EXPIRY", 24 * 3600))
+UPLOAD_SWEEP_INTERVAL = int(os.environ.get("SFMS_UPLOAD_SWEEP_INTERVAL", 3600))
+# Suggested part size. Parts that are a whole number of chunks are chunked
+# exactly as a single-request upload would be, so they dedup against it.
+PART_SIZE = 8 * CHUNK_SIZE
+MAX_PARTS = 10000
+# Uploads aborted per write transaction by a sweep
+SWEEP_BATCH = 100
+
+
+def init_upload_tables(cursor):
+    """Create the resumable upload tables if they don't exist"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS uploads (
+                        id TEXT PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        file_name TEXT NOT NULL,
+                        file_type TEXT,
+                        codec TEXT,
+                        created REAL NOT NULL,
+                        updated REAL NOT NULL,
+                        FOREIGN KEY(user_id) REFERENCES users(id)
+                    ) WITHOUT ROWID''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads (user_id, created)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_uploads_updated ON uploads (updated)")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS upload_parts (
+                        upload_id TEXT NOT NULL,
+                        part_number INTEGER NOT NULL,
+                        attempt TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        sha256 TEXT NOT NULL,
+                        PRIMARY KEY (upload_id, part_number)
+                    ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS upload_chunks (
+                        upload_id TEXT NOT NULL,
+                        part_number INTEGER NOT NULL,
+                        attempt TEXT NOT NULL,
+                        seq INTEGER NOT NULL,
+                        chunk_hash TEXT NOT NULL,
+                        PRIMARY KEY (upload_id, part_number, attempt, seq),
+                        FOREIGN KEY(chunk_hash) REFERENCES chunks(hash)
+                    ) WITHOUT ROWID''')
+
+
+def new_attempt_id():
+    return secrets.token_hex(8)
+
+
+def create_upload(cursor, user_id, file_name, file_type, codec):
+    """Open an upload; returns its id"""
+    upload_id = secrets.token_urlsafe(16)
+    now = time.time()
+    cursor.execute('''INSERT INTO uploads (id, user_id, file_name, file_type, codec, created, updated)
+                      VALUES (?, ?, ?, ?, ?, ?, ?)''', (upload_id, user_id, file_name, file_type, codec, now, now))
+    return upload_id
+
+
+def get_upload(cursor, upload_id, user_id):
+    """The user's open upload as a dict, or None"""
+    cursor.execute('''SELECT file_name, file_type, codec, created, updated FROM uploads
+                      WHERE id = ? AND user_id = ?''', (upload_id, user_id))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return {'upload_id': upload_id, 'filename': row[0], 'file_type': row[1], 'codec': row[2],
+            'created': row[3], 'updated': row[4], 'expires': row[4] + UPLOAD_EXPIRY}
+
+
+def list_uploads(cursor, user_id):
+    """A user's open uploads, oldest first, with how many parts and bytes each has received"""
+    cursor.execute('''SELECT uploads.id, uploads.file_name, uploads.created, uploads.updated,
+                             COUNT(upload_parts.part_number), COALESCE(SUM(upload_parts.size), 0)
+                      FROM uploads LEFT JOIN upload_parts ON upload_parts.upload_id = uploads.id
+                      WHERE uploads.user_id = ? GROUP BY uploads.id ORDER BY uploads.created''', (user_id,))
+    return [{'upload_id': row[0], 'filename': row[1], 'created': row[2], 'expires': row[3] + UPLOAD_EXPIRY,
+             'parts': row[4], 'size': row[5]} for row in cursor.fetchall()]
+
+
+def list_parts(cursor, upload_id):
+    """The parts received so far: [{'part_number', 'size', 'sha256'}] by part number"""
+    cursor.execute("SELECT part_number, size, sha256 FROM upload_parts WHERE upload_id = ? ORDER BY part_number",
+                   (upload_id,))
+    return [{'part_number': row[0], 'size': row[1], 'sha256': row[2]} for row in cursor.fetchall()]
+
+
+def append_part_chunk(cursor, upload_id, part_number, attempt, seq, data, codec=None):
+    """Store one chunk of a part as it arrives; raises LookupError if the upload is gone"""
+    cursor.execute("UPDATE uploads SET updated = ? WHERE id = ?", (time.time(), upload_id))
+    if cursor.rowcount == 0:
+        raise LookupError("Upload not found")
+    chunk_hash = put_chunk(cursor, data, codec)
+    cursor.execute("INSERT INTO upload_chunks (upload_id, part_number, attempt, seq, chunk_hash) VALUES (?, ?, ?, ?, ?)",
+                   (upload_id, part_number, attempt, seq, chunk_hash))
+
+
+def _release_attempt(cursor, upload_id, part_number, attempt):
+    cursor.execute("SELECT chunk_hash FROM upload_chunks WHERE upload_id = ? AND part_number = ? AND attempt = ?",
+                   (upload_id, part_number, attempt))
+    hashes = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM upload_chunks WHERE upload_id = ? AND part_number = ? AND attempt = ?",
+                   (upload_id, part_number, attempt))
+    release_chunks(cursor, hashes)
+
+
+def finish_part(cursor, upload_id, part_number, attempt, size, sha256):
+    """Make a fully received attempt the contents of its part, releasing the one it replaces"""
+    cursor.execute("UPDATE uploads SET updated = ? WHERE id = ?", (time.time(), upload_id))
+    if cursor.rowcount == 0:
+        raise LookupError("Upload not found")
+    cursor.execute("SELECT attempt FROM upload_parts WHERE upload_id = ? AND part_number = ?", (upload_id, part_number))
+    previous = cursor.fetchone()
+    cursor.execute('''INSERT OR REPLACE INTO upload_parts (upload_id, part_number, attempt, size, sha256)
+                      VALUES (?, ?, ?, ?, ?)''', (upload_id, part_number, attempt, size, sha256))
+    if previous is not None:
+        _release_attempt(cursor, upload_id, part_number, previous[0])
+
+
+def discard_part(cursor, upload_id, part_number, attempt):
+    """Release the chunks of an attempt that failed or was cut off"""
+    _release_attempt(cursor, upload_id, part_number, attempt)
+
+
+def _check_parts(parts, expected_parts):
+    if not parts:
+        raise ValueError("No parts have been uploaded")
+    numbers = [part['part_number'] for part in parts]
+    if numbers != list(range(1, len(parts) + 1)):
+        missing = sorted(set(range(1, numbers[-1] + 1)) - set(numbers))
+        raise ValueError(f"Missing parts: {', '.join(map(str, missing[:10]))}")
+    if expected_parts is None:
+        return
+    try:
+        expected = [(int(part['part_number']), str(part['sha256']).lower()) for part in expected_parts]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Each part must have a part_number and a sha256")
+    received = [(part['part_number'], part['sha256']) for part in parts]
+    if sorted(expected) != received:
+        raise ValueError("The parts listed don't match the parts received")
+
+
+def assemble_upload(cursor, upload_id, file_id, expected_parts=None):
+    """Give a file the contents of an upload's parts, then close the upload
+
+    The parts' chunk references move to the file's manifest. With
+    `expected_parts` ([{'part_number', 'sha256'}], as returned when each
+    part was sent), the upload must have received exactly those parts.
+    Returns (size, content hash); raises ValueError if parts are missing.
+    """
+    parts = list_parts(cursor, upload_id)
+    _check_parts(parts, expected_parts)
+    cursor.execute('''SELECT upload_chunks.chunk_hash FROM upload_parts
+                      JOIN upload_chunks ON upload_chunks.upload_id = upload_parts.upload_id
+                       AND upload_chunks.part_number = upload_parts.part_number
+                       AND upload_chunks.attempt = upload_parts.attempt
+                      WHERE upload_parts.upload_id = ? ORDER BY upload_parts.part_number, upload_chunks.seq''',
+                   (upload_id,))
+    cursor.executemany("INSERT INTO file_chunks (file_id, seq, chunk_hash) VALUES (?, ?, ?)",
+                       ((file_id, seq, row[0]) for seq, row in enumerate(cursor.fetchall())))
+    # Those references now belong to the file; unfinished attempts' are dropped
+    cursor.execute('''DELETE FROM upload_chunks WHERE upload_id = ? AND (part_number, attempt) IN
+                        (SELECT part_number, attempt FROM upload_parts WHERE upload_id = ?)''', (upload_id, upload_id))
+    abort_upload(cursor, upload_id)
+
+    if len(parts) == 1:
+        content_hash = parts[0]['sha256']
+    else:
+        digests = b"".join(bytes.fromhex(part['sha256']) for part in parts)
+        content_hash = f"{hashlib.sha256(digests).hexdigest()}-{len(parts)}"
+    return sum(part['size'] for part in parts), content_hash
+
+
+def abort_upload(cursor, upload_id):
+    """Delete an upload and release every chunk its parts hold; returns whether it existed"""
+    cursor.execute("SELECT chunk_hash FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+    hashes = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+    release_chunks(cursor, hashes)
+    cursor.execute("DELETE FROM upload_parts WHERE upload_id = ?", (upload_id,))
+    cursor.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+    return cursor.rowcount > 0
+
+
+def _abort_expired(cursor, before, limit):
+    cursor.execute("SELECT id FROM uploads WHERE updated < ? LIMIT ?", (before, limit))
+    expired = [row[0] for row in cursor.fetchall()]
+    for upload_id in expired:
+        abort_upload(cursor, upload_id)
+    return len(expired)
+
+
+def sweep_uploads(run_write, expiry=UPLOAD_EXPIRY):
+    """Abort uploads idle for longer than `expiry` seconds, a batch per transaction; returns how many"""
+    removed = 0
+    while True:
+        batch = run_write(_abort_expired, time.time() - expiry, SWEEP_BATCH)
+        removed += batch
+        if batch < SWEEP_BATCH:
+            return removed
+
+
+def start_upload_sweeper(run_write, interval=UPLOAD_SWEEP_INTERVAL):
+    """Abort expired uploads every `interval` seconds on a daemon thread; `run_write(fn, *args)` commits a job"""
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = sweep_uploads(run_write)
+                if removed:
+                    logger.info(f"Aborted {removed} expired uploads")
+            except Exception as e:
+                logger.error(f"Upload sweep failed: {e}")
+
+    thread = threading.Thread(target=sweep_forever, name="upload-sweeper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,138 @@
+import collections
+from api.chunk_store import (get_manifest, iter_manifest_range, iter_file_range, prepare_chunk, write_chunks,
+                             new_stage_id, stage_chunk, swap_staged, discard_stage)
+from api.compression import compress_for_encryption, decompress_after_decryption, file_codec, update_compression_ratio
+from api.envelope import (new_data_key, store_data_key, encrypt_with_data_key, key_resolver, stream_header,
+                          forget_key)
+from api.files import log_action
+from api.kdf import user_kdf_salt
+from api.search import index_file
+from api.stream_cipher import decrypt_pieces
+
+# Encrypting and decrypting stored files in place, without holding up the writer.
+#
+# A rewrite reads all of a file, (de)compresses it and runs the cipher over
+# every byte, far longer than any other write takes, yet none of it needs
+# the write lock. So the contents are read on a read connection and
+# transformed on the calling thread, and each new chunk is prepared there
+# too (prepare_chunk) and stored by a short write job of its own into
+# `staged_chunks` (see api/chunk_store.py). The file keeps its old contents
+# meanwhile. Once all of it is staged, one short write job (apply_rewrite,
+# or a caller's job wrapping it) swaps the new chunks in along with the
+# key row, so other writes only ever queue behind single rows.
+#
+# The swap checks the file still has the manifest that was read. If a
+# delete or another rewrite got there first it fails with nothing changed,
+# and commit_rewrite releases the staged chunks. Stages left by a process
+# that died are released by the blob sweep.
+
+# A rewrite staged and ready to swap in; `manifest` is the chunk hashes it was made from,
+# `key_row` a key to store with it and `forget` the header of the encryption layer it removes
+Rewrite = collections.namedtuple("Rewrite", "file_id stage_id manifest chunks size content_hash key_row forget")
+
+
+def _read_contents(cursor, file_id, progress):
+    # The manifest is read once, so the contents match what the swap checks against
+    manifest = get_manifest(cursor, file_id)
+    if manifest:
+        hashes, pieces = [chunk_hash for chunk_hash, _ in manifest], iter_manifest_range(cursor, manifest)
+    else:
+        # Legacy contents kept inline in `files`
+        hashes, pieces = [], iter_file_range(cursor, file_id)
+    return hashes, pieces if progress is None else _tracked(pieces, progress)
+
+
+def _tracked(pieces, progress):
+    done = 0
+    for piece in pieces:
+        done += len(piece)
+        progress(done)
+        yield piece
+
+
+def _stage(submit_write, file_id, manifest, pieces, codec, key_row=None, forget=None):
+    """Store new contents for a file as staged chunks; returns the Rewrite"""
+    stage_id = new_stage_id()
+    staged = []
+
+    def run_write(fn, *args):
+        return submit_write(fn, *args).result()
+
+    def write_chunk(seq, data):
+        staged.append(seq)
+        return submit_write(stage_chunk, stage_id, seq, prepare_chunk(data, codec, run_write))
+
+    try:
+        size, content_hash = write_chunks(pieces, write_chunk)
+    except Exception:
+        run_write(discard_stage, stage_id)
+        raise
+    return Rewrite(file_id, stage_id, manifest, len(staged), size, content_hash, key_row, forget)
+
+
+def encrypt_contents(cursor, submit_write, file_id, user_id, password, progress=None):
+    """Stage a file's contents compressed and encrypted under a fresh data key; returns the Rewrite
+
+    `cursor` is a read cursor and `submit_write(fn, *args)` queues a write,
+    returning its Future. `progress(done)` is called with the bytes of the
+    stored contents read so far; if it raises, the staged chunks are
+    released and the error re-raised.
+    """
+    manifest, pieces = _read_contents(cursor, file_id, progress)
+    codec = file_codec(cursor, file_id)
+    data_key, key_row = new_data_key(file_id, user_id, password, submit_write(user_kdf_salt, user_id).result())
+    ciphertext = encrypt_with_data_key(compress_for_encryption(pieces, codec), data_key, key_row)
+    # Ciphertext doesn't compress, so its chunks are stored as they are
+    return _stage(submit_write, file_id, manifest, ciphertext, None, key_row=key_row)
+
+
+def decrypt_contents(cursor, submit_write, file_id, user_id, password, progress=None):
+    """Stage a file's contents decrypted (segmented format, or a legacy Fernet token); returns the Rewrite
+
+    As encrypt_contents. A wrong password raises before anything is swapped in.
+    """
+    manifest, pieces = _read_contents(cursor, file_id, progress)
+    header = stream_header(cursor, file_id)
+    codec = file_codec(cursor, file_id)
+    plaintext = decrypt_pieces(pieces, password, key=key_resolver(cursor, password, scope=user_id))
+    return _stage(submit_write, file_id, manifest, decompress_after_decryption(plaintext, codec), codec,
+                  forget=header)
+
+
+def apply_rewrite(cursor, rewrite):
+    """Write job swapping a staged rewrite in for its file's contents
+
+    Raises LookupError if the file is gone and ValueError if its contents
+    changed after they were read; nothing is changed then.
+    """
+    swap_staged(cursor, rewrite.file_id, rewrite.stage_id, rewrite.chunks, rewrite.content_hash, rewrite.manifest)
+    if rewrite.key_row is not None:
+        store_data_key(cursor, rewrite.key_row)
+    forget_key(cursor, rewrite.forget)
+    update_compression_ratio(cursor, rewrite.file_id)
+
+
+def encrypted_job(cursor, rewrite):
+    """Write job swapping in a file's encrypted contents"""
+    apply_rewrite(cursor, rewrite)
+    log_action(cursor, rewrite.file_id, 'Encrypted')
+    # Only the name and type stay searchable
+    index_file(cursor, rewrite.file_id)
+
+
+def decrypted_job(cursor, rewrite):
+    """Write job swapping in a file's decrypted contents; the caller reindexes its text afterwards"""
+    apply_rewrite(cursor, rewrite)
+    log_action(cursor, rewrite.file_id, 'Decrypted')
+
+
+def commit_rewrite(submit_write, rewrite, job=apply_rewrite, *args):
+    """Run `job(cursor, rewrite, *args)`, a write job that applies the rewrite, and return its result
+
+    If it fails, the staged chunks are released before the error is re-raised.
+    """
+    try:
+        return submit_write(job, rewrite, *args).result()
+    except Exception:
+        submit_write(discard_stage, rewrite.stage_id).result()
+        raise
@@ -0,0 +1,344 @@
+import sys
+import time
+import logging
+import threading
+import collections
+from api.chunk_store import init_chunk_tables, iter_file_data, store_file_data
+from api.blob_store import init_blob_tables
+from api.envelope import init_key_table
+from api.resumable import init_upload_tables
+from api.search import init_search_table, _index_pending, _extract_unindexed, _index_existing_files
+
+logger = logging.getLogger(__name__)
+
+# Database schema shared by the API, the desktop client and the repair tool.
+#
+# create_tables() gives a new database the current shape and adds any
+# missing columns to an older one; both are safe to repeat on every start.
+# Changes that aren't, such as unique indexes over existing data or moving
+# data around, are numbered migrations. The last one applied is recorded in
+# `PRAGMA user_version`, so each runs exactly once per database file.
+#
+# Online migrations work through the data a batch at a time, each batch its
+# own short write transaction, so the application keeps serving requests
+# while one runs. The code has to cope with both the old and the new layout
+# until it finishes.
+#
+#   python -m api.schema [database]            apply pending migrations, with progress
+#   python -m api.schema [database] --check    check the hot queries use their indexes
+Migration = collections.namedtuple("Migration", "version description apply pending prepare", defaults=(None,))
+MigrationProgress = collections.namedtuple("MigrationProgress", "version description rows done total elapsed")
+
+# Roughly how many bytes an online migration moves per transaction
+MIGRATION_BATCH_BYTES = 64 * 1024 * 1024
+
+# Columns added after the first release, for databases created before them
+ADDED_COLUMNS = [
+    ("users", "kdf_salt", "BLOB"),
+    # Whole-file SHA-256 of the stored bytes, kept current by store_file_data
+    ("files", "content_hash", "TEXT"),
+    # Compression codec chosen at upload, and stored bytes / original size
+    ("files", "codec", "TEXT"),
+    ("files", "compression_ratio", "REAL"),
+    ("chunks", "codec", "TEXT"),
+    # Storage backend holding a chunk's bytes (NULL: inline in `data`), and their size there
+    ("chunks", "location", "TEXT"),
+    ("chunks", "stored_size", "INTEGER"),
+]
+
+
+def create_tables(cursor):
+    """Create every table, column and plain index the code expects"""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT UNIQUE,
+                        password TEXT,
+                        kdf_salt BLOB
+                    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS files (
+                        id INTEGER PRIMARY KEY,
+                        user_id INTEGER,
+                        file_name TEXT,
+                        file_data BLOB,
+                        file_size INTEGER,
+                        file_type TEXT,
+                        action TEXT,
+                        timestamp TEXT,
+                        content_hash TEXT,
+                        codec TEXT,
+                        compression_ratio REAL,
+                        FOREIGN KEY(user_id) REFERENCES users(id)
+                    )''')
+    # Login sessions (api/sessions.py), keyed by a hash of the session id
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                        key TEXT PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        username TEXT,
+                        expires REAL NOT NULL,
+                        FOREIGN KEY(user_id) REFERENCES users(id)
+                    ) WITHOUT ROWID''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)")
+    init_chunk_tables(cursor)
+    init_blob_tables(cursor)
+    init_key_table(cursor)
+    init_search_table(cursor)
+    init_upload_tables(cursor)
+    for table, column, declaration in ADDED_COLUMNS:
+        _add_column(cursor, table, column, declaration)
+
+
+def _add_column(cursor, table, column, declaration):
+    """Add a column to an existing table unless it is already there"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+def init_schema(cursor):
+    """Bring a database up to date at startup; the caller commits
+
+    Online migrations with data left to move are left for run_migrations().
+    """
+    create_tables(cursor)
+    migrate_schema(cursor)
+
+
+def _unique_file_names(cursor):
+    """Index files by owner and name; existing duplicate names get a numbered suffix"""
+    cursor.execute('''SELECT id, user_id, file_name FROM files WHERE id NOT IN
+                        (SELECT MIN(id) FROM files GROUP BY user_id, file_name) ORDER BY id''')
+    for file_id, user_id, file_name in cursor.fetchall():
+        stem, dot, extension = file_name.rpartition(".")
+        if not stem:
+            stem, dot, extension = file_name, "", ""
+        copy = 2
+        while True:
+            candidate = f"{stem} ({copy}){dot}{extension}"
+            cursor.execute("SELECT 1 FROM files WHERE user_id = ? AND file_name = ?", (user_id, candidate))
+            if cursor.fetchone() is None:
+                break
+            copy += 1
+        logger.info(f"Renaming duplicate file {file_id} of user {user_id} to {candidate}")
+        cursor.execute("UPDATE files SET file_name = ? WHERE id = ?", (candidate, file_id))
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_user_name ON files (user_id, file_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_user_time ON files (user_id, timestamp)")
+
+
+def _listing_indexes(cursor):
+    """Index files by owner and size, and widen the content hash index to include the owner
+
+    Next to the size index the old single-column hash index no longer looks
+    more selective to the planner than the owner indexes.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_user_size ON files (user_id, file_size)")
+    cursor.execute("DROP INDEX IF EXISTS idx_files_content_hash")
+    cursor.execute("CREATE INDEX idx_files_content_hash ON files (content_hash, user_id)")
+
+
+def _inline_data_pending(cursor):
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(length(file_data)), 0) FROM files WHERE file_data IS NOT NULL")
+    return tuple(cursor.fetchone())
+
+
+def _move_inline_data(cursor, batch_bytes, after_id):
+    """Move up to about `batch_bytes` of inline file contents into the chunk store
+
+    Each blob is copied a chunk at a time, and readers handle both layouts,
+    so files stay readable throughout.
+    """
+    cursor.execute('''SELECT id, length(file_data) FROM files WHERE file_data IS NOT NULL AND id > ?
+                      ORDER BY id LIMIT 256''', (after_id,))
+    rows = moved = 0
+    for file_id, size in cursor.fetchall():
+        if rows and moved + size > batch_bytes:
+            break
+        store_file_data(cursor, file_id, iter_file_data(cursor, file_id))
+        rows += 1
+        moved += size
+        after_id = file_id
+    return rows, moved, after_id
+
+
+# Append only, never renumber. `pending` is None for migrations applied in
+# one go, and returns the (rows, bytes) left to do for online ones. Their
+# `apply(cursor, batch_bytes, after_id)` does one batch of the files with
+# ids above `after_id` (0 to start) and returns (rows, bytes, last id done).
+# One with a `prepare(cursor, batch_bytes, after_id)` step has it read the
+# batch on a read connection instead, and its `apply(cursor, batch)` only
+# writes what was read. Files added while one runs must be handled by the
+# regular code path.
+MIGRATIONS = [
+    Migration(1, "unique (user_id, file_name) and (user_id, timestamp) indexes", _unique_file_names, None),
+    Migration(2, "move inline file data into the chunk store", _move_inline_data, _inline_data_pending),
+    Migration(3, "(user_id, file_size) and (content_hash, user_id) indexes", _listing_indexes, None),
+    Migration(4, "index existing files for search", _index_existing_files, _index_pending, _extract_unindexed),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def schema_version(cursor):
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def _set_schema_version(cursor, version):
+    cursor.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def migrate_schema(cursor):
+    """Apply pending migrations that fit in the caller's transaction
+
+    Stops at the first online migration that still has data to move, since
+    later migrations may depend on it. Returns the number applied.
+    """
+    applied = 0
+    for migration in MIGRATIONS:
+        if migration.version <= schema_version(cursor):
+            continue
+        if migration.pending is not None:
+            if migration.pending(cursor)[0]:
+                break
+        else:
+            logger.info(f"Migrating database to version {migration.version}: {migration.description}")
+            migration.apply(cursor)
+        _set_schema_version(cursor, migration.version)
+        applied += 1
+    return applied
+
+
+def pending_migrations(cursor):
+    """Return the migrations not yet applied to a database"""
+    current = schema_version(cursor)
+    return [migration for migration in MIGRATIONS if migration.version > current]
+
+
+def run_migrations(path=None, batch_bytes=MIGRATION_BATCH_BYTES, progress=None):
+    """Apply every pending migration to a live database, online ones batch by batch
+
+    Each batch goes through the database's write queue, so it takes turns
+    with the application's own writes instead of locking them out.
+    `progress`, if given, is called with a MigrationProgress after every
+    batch. Returns the schema version reached.
+    """
+    # Imported here because api.database imports this module
+    from api.database import DB_PATH, get_connection, get_writer
+
+    path = path or DB_PATH
+    writer = get_writer(path)
+    writer.run(migrate_schema)
+    for migration in writer.run(pending_migrations):
+        if migration.pending is None:
+            writer.run(_apply_once, migration)
+            continue
+        total = writer.run(lambda cursor: migration.pending(cursor)[1])
+        logger.info(f"Migrating database to version {migration.version} online: {migration.description}")
+        started = time.monotonic()
+        rows = done = 0
+        position = 0
+        while True:
+            if migration.prepare is None:
+                batch_rows, batch_bytes_moved, position = writer.run(migration.apply, batch_bytes, position)
+            else:
+                conn = get_connection(path)
+                try:
+                    batch = migration.prepare(conn.cursor(), batch_bytes, position)
+                finally:
+                    conn.close()
+                batch_rows, batch_bytes_moved, position = writer.run(migration.apply, batch)
+            if not batch_rows:
+                break
+            rows += batch_rows
+            done += batch_bytes_moved
+            if progress is not None:
+                progress(MigrationProgress(migration.version, migration.description, rows, done, max(total, done),
+                                           time.monotonic() - started))
+        writer.run(_set_schema_version, migration.version)
+    return writer.run(schema_version)
+
+
+def _apply_once(cursor, migration):
+    if schema_version(cursor) < migration.version:
+        logger.info(f"Migrating database to version {migration.version}: {migration.description}")
+        migration.apply(cursor)
+        _set_schema_version(cursor, migration.version)
+
+
+def format_progress(progress):
+    """One-line summary of a MigrationProgress, with throughput and ETA"""
+    mb = 1024 * 1024
+    rate = progress.done / progress.elapsed if progress.elapsed else 0.0
+    remaining = progress.total - progress.done
+    eta = f"{remaining / rate:.0f} s" if rate else "unknown"
+    percent = progress.done / progress.total if progress.total else 1.0
+    return (f"v{progress.version} {progress.description}: {progress.rows} rows, "
+            f"{progress.done / mb:.1f} of {progress.total / mb:.1f} MB ({percent:.1%}), "
+            f"{rate / mb:.1f} MB/s, ETA {eta}")
+
+
+def migrate_in_background(path=None):
+    """Start run_migrations() on a daemon thread, logging progress; returns the thread"""
+    def run():
+        try:
+            version = run_migrations(path, progress=lambda progress: logger.info(format_progress(progress)))
+            logger.info(f"Database schema is at version {version}")
+        except Exception as e:
+            logger.error(f"Background migration failed: {e}")
+
+    thread = threading.Thread(target=run, name="schema-migration", daemon=True)
+    thread.start()
+    return thread
+
+
+# The lookups every request and the desktop client depend on, with the
+# index each must use; a full scan of `files` means an index went missing
+HOT_QUERIES = [
+    ("file by name", "SELECT id, file_type, content_hash FROM files WHERE file_name = ? AND user_id = ?",
+     "idx_files_user_name"),
+    ("file listing", '''SELECT id, file_name, file_size, file_type, action, timestamp, codec, compression_ratio
+                        FROM files WHERE user_id = ? ORDER BY timestamp DESC, id DESC''', "idx_files_user_time"),
+    ("file names", "SELECT id, file_name FROM files WHERE user_id = ? ORDER BY file_name, id", "COVERING INDEX idx_files_user_name"),
+    ("next page by name", '''SELECT id, file_name FROM files WHERE user_id = ? AND (file_name, id) > (?, ?)
+                             ORDER BY file_name, id LIMIT ?''', "idx_files_user_name"),
+    ("next page by size", '''SELECT id, file_name, file_size FROM files WHERE user_id = ? AND (file_size, id) < (?, ?)
+                             ORDER BY file_size DESC, id DESC LIMIT ?''', "idx_files_user_size"),
+    ("delete by name", "DELETE FROM files WHERE file_name = ? AND user_id = ?", "idx_files_user_name"),
+    ("duplicate by hash", "SELECT id FROM files WHERE content_hash = ? AND user_id = ? LIMIT 1",
+     "idx_files_content_hash"),
+    ("manifest", "SELECT chunk_hash FROM file_chunks WHERE file_id = ? ORDER BY seq", "PRIMARY KEY"),
+    ("session", "SELECT user_id, username, expires FROM sessions WHERE key = ? AND expires > ?", "PRIMARY KEY"),
+    ("expired sessions", "SELECT key FROM sessions WHERE expires <= ? LIMIT ?", "idx_sessions_expires"),
+    ("upload parts", "SELECT part_number, size, sha256 FROM upload_parts WHERE upload_id = ? ORDER BY part_number",
+     "PRIMARY KEY"),
+    ("expired uploads", "SELECT id FROM uploads WHERE updated < ? LIMIT ?", "idx_uploads_updated"),
+    ("released blobs", "SELECT hash, location FROM blob_garbage WHERE released < ? LIMIT ?",
+     "idx_blob_garbage_released"),
+]
+
+
+def check_query_plans(cursor):
+    """Run EXPLAIN QUERY PLAN on the hot queries; returns a list of problems, empty if all use their index"""
+    problems = []
+    for name, query, index in HOT_QUERIES:
+        cursor.execute(f"EXPLAIN QUERY PLAN {query}", (None,) * query.count("?"))
+        plan = " / ".join(row[3] for row in cursor.fetchall())
+        if index not in plan or "USE TEMP B-TREE" in plan:
+            problems.append(f"{name}: expected {index}, got {plan}")
+    return problems
+
+
+if __name__ == "__main__":
+    from api.database import DB_PATH, get_connection
+
+    arguments = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    db_path = arguments[0] if arguments else DB_PATH
+    if "--check" in sys.argv:
+        conn = get_connection(db_path)
+        issues = check_query_plans(conn.cursor())
+        conn.close()
+        print("\n".join(issues) or "All hot queries use their indexes.")
+        sys.exit(1 if issues else 0)
+    conn = get_connection(db_path)
+    init_schema(conn.cursor())
+    conn.commit()
+    conn.close()
+    print(f"Schema version {run_migrations(db_path, progress=lambda progress: print(format_progress(progress)))}")
@@ -0,0 +1,214 @@
+import re
+import logging
+import sqlite3
+from api.chunk_store import iter_file_range, read_file_data
+from api.stream_cipher import is_stream_encrypted
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+# Full-text search over file names, MIME types and the text inside files.
+#
+# `files_fts` is an FTS5 table keyed by files.id. The owner is indexed as a
+# token ("u<user id>") so restricting a search to one user is part of the
+# full-text match rather than a filter over every hit. Prefix indexes for 2
+# and 3 characters keep short prefix queries fast. Encrypted files are
+# indexed by name and type only. If this SQLite has no FTS5, searches fall
+# back to matching the start of file names.
+#
+# Results are files whose name matches, newest first, then files matching
+# in type or contents. Ranking every hit with bm25 would cost time
+# proportional to the number of hits, while FTS5 can stop walking its
+# doclists as soon as a page of rowid-ordered results is found.
+SEARCH_TEXT_LIMIT = 256 * 1024  # bytes of each file's text that are indexed
+PDF_SIZE_LIMIT = 64 * 1024 * 1024  # larger PDFs are indexed by name only
+DEFAULT_RESULTS = 20
+MAX_RESULTS = 100
+TEXT_TYPES = {"application/json", "application/xml", "application/javascript", "application/x-javascript",
+              "application/x-yaml", "application/yaml", "application/x-sh", "application/sql", "application/rtf",
+              "application/x-python", "image/svg+xml"}
+# Fernet tokens (the legacy whole-file encryption) start with a version byte of 0x80
+FERNET_PREFIX = b"gAAAAA"
+
+
+def fts5_available():
+    """Check whether the linked SQLite was built with FTS5"""
+    connection = sqlite3.connect(":memory:")
+    try:
+        connection.execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+FTS5_AVAILABLE = fts5_available()
+
+
+def init_search_table(cursor):
+    """Create the search index table if this SQLite supports it"""
+    if not FTS5_AVAILABLE or search_enabled(cursor):
+        return
+    cursor.execute('''CREATE VIRTUAL TABLE files_fts USING fts5(
+                        owner, file_name, file_type, content,
+                        tokenize = 'unicode61', prefix = '2 3'
+                    )''')
+
+
+def search_enabled(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'")
+    return cursor.fetchone() is not None
+
+
+def _is_text_type(file_type):
+    file_type = (file_type or "").split(";")[0].strip().lower()
+    return (file_type.startswith("text/") or file_type in TEXT_TYPES
+            or file_type.endswith("+xml") or file_type.endswith("+json"))
+
+
+def _looks_encrypted(head):
+    return is_stream_encrypted(head) or head.startswith(FERNET_PREFIX)
+
+
+def extract_text(cursor, file_id):
+    """Return the searchable text of a stored file, or "" for binary or encrypted files"""
+    cursor.execute("SELECT file_type, file_size FROM files WHERE id = ?", (file_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return ""
+    file_type, file_size = row
+    head = b"".join(iter_file_range(cursor, file_id, 0, 16))
+    if _looks_encrypted(head):
+        return ""
+    if _is_text_type(file_type):
+        data = b"".join(iter_file_range(cursor, file_id, 0, SEARCH_TEXT_LIMIT))
+        return data.decode("utf-8", errors="ignore")
+    if file_type == "application/pdf" and fitz is not None and (file_size or 0) <= PDF_SIZE_LIMIT:
+        try:
+            document = fitz.open(stream=read_file_data(cursor, file_id), filetype="pdf")
+        except Exception as e:
+            logger.warning(f"Could not read PDF {file_id} for indexing: {e}")
+            return ""
+        parts = []
+        length = 0
+        for page in document:
+            text = page.get_text()
+            parts.append(text)
+            length += len(text)
+            if length >= SEARCH_TEXT_LIMIT:
+                break
+        document.close()
+        return "".join(parts)[:SEARCH_TEXT_LIMIT]
+    return ""
+
+
+def index_file(cursor, file_id, text=""):
+    """Add or refresh a file's search entry with its current name and type and `text`"""
+    if not search_enabled(cursor):
+        return
+    cursor.execute("DELETE FROM files_fts WHERE rowid = ?", (file_id,))
+    cursor.execute('''INSERT INTO files_fts (rowid, owner, file_name, file_type, content)
+                      SELECT id, 'u' || user_id, file_name, COALESCE(file_type, ''), ? FROM files WHERE id = ?''',
+                   (text or "", file_id))
+
+
+def rename_indexed_file(cursor, file_id):
+    """Pick up a file's new name, keeping its indexed text"""
+    if search_enabled(cursor):
+        cursor.execute('''UPDATE files_fts SET file_name = (SELECT file_name FROM files WHERE id = ?)
+                          WHERE rowid = ?''', (file_id, file_id))
+
+
+def unindex_file(cursor, file_id):
+    """Drop a deleted file from the search index"""
+    if search_enabled(cursor):
+        cursor.execute("DELETE FROM files_fts WHERE rowid = ?", (file_id,))
+
+
+def _match_expression(user_id, terms, columns):
+    """FTS5 query for every term, as a prefix, in `columns` of the user's files"""
+    words = " ".join(f'"{term}"*' for term in terms)
+    return f'owner : "u{int(user_id)}" AND {{{columns}}} : ({words})'
+
+
+def _newest_matches(cursor, expression, limit):
+    cursor.execute('''SELECT files.id, files.file_name, files.file_type, files.file_size, files.timestamp,
+                             snippet(files_fts, 3, '[', ']', '...', 12)
+                      FROM files_fts JOIN files ON files.id = files_fts.rowid
+                      WHERE files_fts MATCH ? ORDER BY files_fts.rowid DESC LIMIT ?''', (expression, limit))
+    return cursor.fetchall()
+
+
+def search_files(cursor, user_id, query, limit=DEFAULT_RESULTS):
+    """Return a user's files matching every word of `query` as a prefix, name matches first
+
+    Each result is (id, name, type, size, timestamp, snippet); the snippet
+    shows the matching text inside the file with hits in [brackets].
+    """
+    limit = max(1, min(int(limit), MAX_RESULTS))
+    # Split the way the unicode61 tokenizer does, which also drops FTS5 syntax
+    terms = re.findall(r"[^\W_]+", query)
+    if not terms:
+        return []
+    if not search_enabled(cursor):
+        # Without FTS5: names starting with the first word, from the (user_id, file_name) index
+        cursor.execute('''SELECT id, file_name, file_type, file_size, timestamp, '' FROM files
+                          WHERE user_id = ? AND file_name >= ? AND file_name < ? ORDER BY file_name LIMIT ?''',
+                       (user_id, terms[0], terms[0] + "\U0010ffff", limit))
+        return cursor.fetchall()
+    results = _newest_matches(cursor, _match_expression(user_id, terms, "file_name"), limit)
+    if len(results) < limit:
+        # The second pass finds the name matches again, so ask for enough to skip them
+        found = {row[0] for row in results}
+        others = _newest_matches(cursor, _match_expression(user_id, terms, "file_name file_type content"),
+                                 limit + len(found))
+        results += [row for row in others if row[0] not in found][:limit - len(results)]
+    return results
+
+
+def _index_pending(cursor):
+    if not search_enabled(cursor):
+        return 0, 0
+    cursor.execute(f'''SELECT COUNT(*), COALESCE(SUM(MIN(COALESCE(file_size, 0), {SEARCH_TEXT_LIMIT})), 0)
+                       FROM files WHERE NOT EXISTS (SELECT 1 FROM files_fts WHERE files_fts.rowid = files.id)''')
+    return tuple(cursor.fetchone())
+
+
+def _extract_unindexed(cursor, batch_bytes, after_id):
+    """Read the text of the next batch of files not in the search index yet; returns (texts, bytes, last id)
+
+    The read half of the search migration, run on a read connection so
+    decoding text and parsing PDFs never holds up the writer.
+    """
+    if not search_enabled(cursor):
+        return [], 0, after_id
+    cursor.execute('''SELECT id, COALESCE(file_size, 0) FROM files WHERE id > ?
+                      AND NOT EXISTS (SELECT 1 FROM files_fts WHERE files_fts.rowid = files.id)
+                      ORDER BY id LIMIT 256''', (after_id,))
+    texts = []
+    done = 0
+    for file_id, size in cursor.fetchall():
+        if texts and done + min(size, SEARCH_TEXT_LIMIT) > batch_bytes:
+            break
+        texts.append((file_id, extract_text(cursor, file_id)))
+        done += min(size, SEARCH_TEXT_LIMIT)
+        after_id = file_id
+    return texts, done, after_id
+
+
+def _index_existing_files(cursor, batch):
+    """Index a batch read by _extract_unindexed (a schema migration); returns (rows, bytes, last id)
+
+    Files indexed by the regular code path in the meantime are left as they are.
+    """
+    texts, done, after_id = batch
+    for file_id, text in texts:
+        cursor.execute("SELECT 1 FROM files_fts WHERE rowid = ?", (file_id,))
+        if cursor.fetchone() is None:
+            index_file(cursor, file_id, text)
+    return len(texts), done, after_id
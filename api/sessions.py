@@ -0,0 +1,275 @@
+import os
+import time
+import hashlib
+import logging
+import secrets
+import threading
+import collections
+from api.database import DB_PATH, get_connection, get_writer
+
+logger = logging.getLogger(__name__)
+
+# Login sessions.
+#
+# The default "sqlite" backend keeps sessions in the `sessions` table, so
+# every worker process sees a login made on any other and a restart logs
+# nobody out. Rows are keyed by the SHA-256 of the session id, so a copy of
+# the database can't be used to take over a session. Validating a request
+# first looks in a per-process LRU of recently seen sessions, a dict lookup
+# with no query; an entry is trusted for SESSION_CACHE_TTL seconds, which is
+# also how long a logout on another worker can take to be noticed here.
+# The "memory" backend is that LRU alone: sessions live in one process and
+# are lost on restart, which suits the single in-memory Vercel instance.
+#
+# Sessions expire SESSION_LIFETIME seconds after they were last renewed,
+# which happens on use once half the lifetime has passed. Lookups check
+# the expiry themselves; a background sweep deletes expired rows.
+SESSION_BACKEND = os.environ.get("SFMS_SESSION_BACKEND", "memory" if 'VERCEL' in os.environ else "sqlite")
+SESSION_LIFETIME = int(os.environ.get("SFMS_SESSION_LIFETIME", 7 * 24 * 3600))
+SESSION_CACHE_SIZE = int(os.environ.get("SFMS_SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.environ.get("SFMS_SESSION_CACHE_TTL", 30))
+SESSION_SWEEP_INTERVAL = int(os.environ.get("SFMS_SESSION_SWEEP_INTERVAL", 300))
+# Expired rows deleted per write transaction by a sweep
+SWEEP_BATCH = 1000
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+def _session_key(session_id):
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+class SessionCache:
+    """Bounded LRU of sessions, each kept for at most `ttl` seconds and never past its expiry"""
+
+    def __init__(self, max_entries=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def put(self, key, session):
+        if self.max_entries <= 0:
+            return
+        until = min(time.time() + self.ttl, session['expires'])
+        with self._lock:
+            self._entries[key] = (session, until)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def sweep(self):
+        """Drop expired entries; returns how many"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, until) in self._entries.items() if until <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'cached': len(self), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class MemorySessionStore:
+    """Sessions held by this process only; the least recently used are dropped beyond `max_sessions`"""
+
+    backend = "memory"
+
+    def __init__(self, max_sessions=SESSION_CACHE_SIZE, lifetime=SESSION_LIFETIME):
+        self.lifetime = lifetime
+        self.swept = 0
+        self._sessions = SessionCache(max_sessions, lifetime)
+
+    def create(self, user_id, username):
+        """Start a session for a user; returns the session id for the cookie"""
+        session_id = new_session_id()
+        self._sessions.put(_session_key(session_id), {'user_id': user_id, 'username': username,
+                                                      'expires': time.time() + self.lifetime})
+        return session_id
+
+    def get(self, session_id):
+        """The session's {'user_id', 'username', 'expires'}, or None if it is unknown or expired"""
+        return self.get_cached(session_id)
+
+    def get_cached(self, session_id):
+        return self._sessions.get(_session_key(session_id)) if session_id else None
+
+    def load(self, session_id):
+        # There is nowhere else to look
+        return None
+
+    def delete(self, session_id):
+        if session_id:
+            self._sessions.discard(_session_key(session_id))
+
+    def sweep(self):
+        removed = self._sessions.sweep()
+        self.swept += removed
+        return removed
+
+    def stats(self):
+        stats = self._sessions.stats()
+        return {'backend': self.backend, 'sessions': stats.pop('cached'), 'swept': self.swept, **stats}
+
+
+def _insert_session(cursor, key, user_id, username, expires):
+    cursor.execute("INSERT INTO sessions (key, user_id, username, expires) VALUES (?, ?, ?, ?)",
+                   (key, user_id, username, expires))
+
+
+def _renew_session(cursor, key, expires):
+    cursor.execute("UPDATE sessions SET expires = ? WHERE key = ? AND expires < ?", (expires, key, expires))
+
+
+def _delete_session(cursor, key):
+    cursor.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+
+def _delete_expired(cursor, now, limit):
+    cursor.execute("DELETE FROM sessions WHERE key IN (SELECT key FROM sessions WHERE expires <= ? LIMIT ?)",
+                   (now, limit))
+    return cursor.rowcount
+
+
+def _log_renew_failure(future):
+    if future.exception() is not None:
+        logger.error(f"Renewing a session failed: {future.exception()}")
+
+
+class SQLiteSessionStore:
+    """Sessions in the database, shared by every process using it, with an LRU in front"""
+
+    backend = "sqlite"
+
+    def __init__(self, path=DB_PATH, lifetime=SESSION_LIFETIME, cache_size=SESSION_CACHE_SIZE,
+                 cache_ttl=SESSION_CACHE_TTL):
+        self.path = path
+        self.lifetime = lifetime
+        self.rejected = 0
+        self.swept = 0
+        self._cache = SessionCache(cache_size, cache_ttl)
+
+    def create(self, user_id, username):
+        """Start a session for a user; returns the session id for the cookie"""
+        session_id = new_session_id()
+        session = {'user_id': user_id, 'username': username, 'expires': time.time() + self.lifetime}
+        key = _session_key(session_id)
+        get_writer(self.path).run(_insert_session, key, user_id, username, session['expires'])
+        self._cache.put(key, session)
+        return session_id
+
+    def get_cached(self, session_id):
+        """The session if this process has seen it recently, without touching the database"""
+        return self._cache.get(_session_key(session_id)) if session_id else None
+
+    def get(self, session_id):
+        """The session's {'user_id', 'username', 'expires'}, or None if it is unknown or expired"""
+        return self.get_cached(session_id) or self.load(session_id)
+
+    def load(self, session_id):
+        """Look a session up in the database, bypassing (and then filling) the cache"""
+        if not session_id:
+            return None
+        key = _session_key(session_id)
+        now = time.time()
+        conn = get_connection(self.path)
+        try:
+            row = conn.execute("SELECT user_id, username, expires FROM sessions WHERE key = ? AND expires > ?",
+                               (key, now)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            self.rejected += 1
+            return None
+        session = {'user_id': row[0], 'username': row[1], 'expires': row[2]}
+        if session['expires'] - now < self.lifetime / 2:
+            # Nothing waits for the renewal; until it commits the old expiry stands
+            session['expires'] = now + self.lifetime
+            get_writer(self.path).submit(_renew_session, key, session['expires']).add_done_callback(_log_renew_failure)
+        self._cache.put(key, session)
+        return session
+
+    def delete(self, session_id):
+        if not session_id:
+            return
+        key = _session_key(session_id)
+        self._cache.discard(key)
+        get_writer(self.path).run(_delete_session, key)
+
+    def sweep(self):
+        """Delete expired sessions, a batch per transaction; returns how many"""
+        self._cache.sweep()
+        removed = 0
+        while True:
+            batch = get_writer(self.path).run(_delete_expired, time.time(), SWEEP_BATCH)
+            removed += batch
+            if batch < SWEEP_BATCH:
+                break
+        self.swept += removed
+        return removed
+
+    def stats(self):
+        conn = get_connection(self.path)
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM sessions WHERE expires > ?", (time.time(),)).fetchone()[0]
+        finally:
+            conn.close()
+        return {'backend': self.backend, 'sessions': count, 'rejected': self.rejected, 'swept': self.swept,
+                **self._cache.stats()}
+
+
+SESSION_BACKENDS = {
+    "sqlite": SQLiteSessionStore,
+    "memory": MemorySessionStore,
+}
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    """Return a new session store for the named backend"""
+    if backend not in SESSION_BACKENDS:
+        raise ValueError(f"Unknown session backend {backend}; use one of {', '.join(SESSION_BACKENDS)}")
+    return SESSION_BACKENDS[backend]()
+
+
+def start_session_sweeper(store, interval=SESSION_SWEEP_INTERVAL):
+    """Delete expired sessions every `interval` seconds on a daemon thread"""
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = store.sweep()
+                if removed:
+                    logger.info(f"Removed {removed} expired sessions")
+            except Exception as e:
+                logger.error(f"Session sweep failed: {e}")
+
+    thread = threading.Thread(target=sweep_forever, name="session-sweeper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,266 @@
+import os
+import base64
+import struct
+import hashlib
+import itertools
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from api.kdf import (DEFAULT_KDF, KDF_BLOCK_SIZE, SALT_SIZE, master_key, file_key,
+                     pack_kdf_block, unpack_kdf_block)
+
+# Segmented AES-256-GCM stream format (the STREAM construction):
+#
+#   header  = MAGIC | version (1) | segment size (4) | nonce prefix (7) | key info
+#   segment = AES-GCM(plaintext[i], nonce = prefix | i (4) | last (1), aad = header)
+#
+# Each plaintext segment is SEGMENT_SIZE bytes except the last one, which
+# carries the "last" flag so a truncated stream fails to authenticate.
+# Ciphertext is stored raw; there is no base64 step as with Fernet.
+#
+# Key info by version:
+#   1: none, key = SHA-256(password)
+#   2: KDF parameters, per-user KDF salt and per-file salt (see api/kdf.py)
+#   3: id of a random data key, stored wrapped in `file_keys` (see api/envelope.py)
+MAGIC = b"SFMS"
+VERSION = 2
+ENVELOPE_VERSION = 3
+KEY_ID_SIZE = 16
+KEY_INFO_SIZES = {1: 0, 2: KDF_BLOCK_SIZE, 3: KEY_ID_SIZE}
+SEGMENT_SIZE = 64 * 1024
+NONCE_PREFIX_SIZE = 7
+TAG_SIZE = 16
+BASE_HEADER_FORMAT = ">4sBI7s"
+BASE_HEADER_SIZE = struct.calcsize(BASE_HEADER_FORMAT)
+MAX_HEADER_SIZE = BASE_HEADER_SIZE + max(KEY_INFO_SIZES.values())
+
+StreamHeader = collections.namedtuple("StreamHeader", "version segment_size prefix key_info raw")
+
+# Segments are sealed and opened in batches of SEGMENTS_PER_TASK (1 MiB)
+# on a shared thread pool; OpenSSL releases the GIL, so this scales with
+# cores. Set SFMS_CRYPTO_WORKERS=1 to keep everything on the calling thread.
+CRYPTO_WORKERS = int(os.environ.get("SFMS_CRYPTO_WORKERS", os.cpu_count() or 1))
+SEGMENTS_PER_TASK = 16
+_executor = None
+_executor_size = 0
+_executor_lock = threading.Lock()
+
+
+def _nonce(prefix, index, last):
+    """Per-segment nonce: random prefix, segment counter and last-segment flag"""
+    return prefix + struct.pack(">IB", index, 1 if last else 0)
+
+
+def _iter_plain_segments(pieces, segment_size):
+    """Cut plaintext pieces into (index, last, segment) triples
+
+    More than a segment is kept buffered before one is released, so the
+    final segment is always known when it is emitted.
+    """
+    buffer = bytearray()
+    index = 0
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) > segment_size:
+            yield index, False, bytes(buffer[:segment_size])
+            del buffer[:segment_size]
+            index += 1
+    yield index, True, bytes(buffer)
+
+
+def _iter_sealed_segments(pieces, buffer, sealed_size):
+    """Cut ciphertext pieces into (index, last, segment) triples"""
+    index = 0
+    while True:
+        # Read one byte past the segment to learn whether it is the last one
+        _read_exactly(pieces, buffer, sealed_size + 1)
+        last = len(buffer) <= sealed_size
+        yield index, last, bytes(buffer[:sealed_size])
+        del buffer[:sealed_size]
+        if last:
+            return
+        index += 1
+
+
+def _read_exactly(pieces, buffer, size):
+    """Pull pieces into `buffer` until it holds `size` bytes or the input ends"""
+    while len(buffer) < size:
+        piece = next(pieces, None)
+        if piece is None:
+            break
+        buffer += piece
+
+
+def _get_executor(workers):
+    """Return the thread pool shared by all parallel crypto jobs, grown to at least `workers`"""
+    global _executor, _executor_size
+    with _executor_lock:
+        if _executor is None or _executor_size < workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor_size = max(workers, CRYPTO_WORKERS, 1)
+            _executor = ThreadPoolExecutor(max_workers=_executor_size, thread_name_prefix="crypto")
+        return _executor
+
+
+def _batched(segments, size):
+    """Group segments into lists of `size` so each pool task does a useful amount of work"""
+    iterator = iter(segments)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _ordered_map(func, batches, workers):
+    """Run `func` over batches on the crypto pool, yielding results in input order
+
+    At most two batches per worker are in flight, which bounds memory no
+    matter how large the stream is.
+    """
+    if workers <= 1:
+        for batch in batches:
+            yield func(batch)
+        return
+    executor = _get_executor(workers)
+    window = collections.deque()
+    try:
+        for batch in batches:
+            window.append(executor.submit(func, batch))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+    finally:
+        for future in window:
+            future.cancel()
+
+
+def encrypt_stream(pieces, key, key_info, segment_size=SEGMENT_SIZE, workers=None, version=VERSION):
+    """Encrypt an iterable of plaintext pieces, yielding the header and then ciphertext in order
+
+    `key_info` is stored (authenticated) in the header so the key can be
+    re-derived on decryption. Segments are independent, so with `workers`
+    > 1 (default CRYPTO_WORKERS) batches of them are sealed concurrently
+    on the crypto thread pool.
+    """
+    if len(key_info) != KEY_INFO_SIZES[version]:
+        raise ValueError(f"Key info for format version {version} must be {KEY_INFO_SIZES[version]} bytes")
+    prefix = os.urandom(NONCE_PREFIX_SIZE)
+    header = struct.pack(BASE_HEADER_FORMAT, MAGIC, version, segment_size, prefix) + key_info
+    aead = AESGCM(key)
+    yield header
+
+    def seal(batch):
+        return b"".join(aead.encrypt(_nonce(prefix, index, last), segment, header)
+                        for index, last, segment in batch)
+
+    batches = _batched(_iter_plain_segments(pieces, segment_size), SEGMENTS_PER_TASK)
+    for sealed in _ordered_map(seal, batches, CRYPTO_WORKERS if workers is None else workers):
+        yield sealed
+
+
+def decrypt_stream(pieces, key, workers=None):
+    """Decrypt an iterable of ciphertext pieces, yielding plaintext in order
+
+    `key` is either the raw key or a function taking the parsed
+    StreamHeader and returning it. Raises cryptography.exceptions.InvalidTag
+    for a wrong key or tampered or truncated data, and ValueError if the
+    input isn't in this format.
+    """
+    pieces = iter(pieces)
+    buffer = bytearray()
+    _read_exactly(pieces, buffer, BASE_HEADER_SIZE)
+    header = parse_header(bytes(buffer[:BASE_HEADER_SIZE]), partial=True)
+    header_size = BASE_HEADER_SIZE + KEY_INFO_SIZES[header.version]
+    _read_exactly(pieces, buffer, header_size)
+    header = parse_header(bytes(buffer[:header_size]))
+    del buffer[:header_size]
+    aead = AESGCM(key(header) if callable(key) else key)
+
+    def open_batch(batch):
+        return b"".join(aead.decrypt(_nonce(header.prefix, index, last), segment, header.raw)
+                        for index, last, segment in batch)
+
+    batches = _batched(_iter_sealed_segments(pieces, buffer, header.segment_size + TAG_SIZE), SEGMENTS_PER_TASK)
+    for plaintext in _ordered_map(open_batch, batches, CRYPTO_WORKERS if workers is None else workers):
+        yield plaintext
+
+
+def parse_header(data, partial=False):
+    """Parse the StreamHeader at the start of `data`
+
+    With `partial`, only the fixed-size part is required and key_info is
+    left empty.
+    """
+    if len(data) < BASE_HEADER_SIZE or not is_stream_encrypted(data):
+        raise ValueError("Not a segmented encryption stream")
+    _, version, segment_size, prefix = struct.unpack(BASE_HEADER_FORMAT, data[:BASE_HEADER_SIZE])
+    if version not in KEY_INFO_SIZES:
+        raise ValueError(f"Unsupported encryption format version {version}")
+    if partial:
+        return StreamHeader(version, segment_size, prefix, b"", bytes(data[:BASE_HEADER_SIZE]))
+    header_size = BASE_HEADER_SIZE + KEY_INFO_SIZES[version]
+    if len(data) < header_size:
+        raise ValueError("Truncated encryption header")
+    return StreamHeader(version, segment_size, prefix, bytes(data[BASE_HEADER_SIZE:header_size]),
+                        bytes(data[:header_size]))
+
+
+def is_stream_encrypted(data):
+    """Check whether stored bytes start with the segmented format header"""
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def plaintext_size(stored_size, header):
+    """Length of the plaintext behind a stream of `stored_size` bytes"""
+    body = stored_size - len(header.raw)
+    segments = max(1, -(-body // (header.segment_size + TAG_SIZE)))
+    return body - segments * TAG_SIZE
+
+
+def password_key(header, password, scope=None):
+    """Re-derive the key for a stream header from a password
+
+    `scope` (usually the user id) partitions the derived-key cache.
+    """
+    if header.version == 1:
+        return hashlib.sha256(password.encode()).digest()
+    if header.version == ENVELOPE_VERSION:
+        raise ValueError("Envelope-encrypted data needs its wrapped data key")
+    params, kdf_salt, file_salt = unpack_kdf_block(header.key_info)
+    return file_key(master_key(password, kdf_salt, params, scope), file_salt)
+
+
+def encrypt_with_password(pieces, password, kdf_salt, scope=None, params=DEFAULT_KDF, workers=None):
+    """Encrypt plaintext pieces under a password with a fresh per-file salt"""
+    file_salt = os.urandom(SALT_SIZE)
+    key = file_key(master_key(password, kdf_salt, params, scope), file_salt)
+    return encrypt_stream(pieces, key, pack_kdf_block(params, kdf_salt, file_salt), workers=workers)
+
+
+def decrypt_pieces(pieces, password, scope=None, workers=None, key=None):
+    """Decrypt stored bytes in either the segmented format or as a legacy Fernet token
+
+    Segmented data is decrypted lazily as the returned iterator is consumed;
+    legacy tokens have to be decrypted whole, up front. `key` overrides how
+    the segment key is found (see decrypt_stream); by default it is derived
+    from the password.
+    """
+    pieces = iter(pieces)
+    first = next(pieces, b"")
+    if is_stream_encrypted(first):
+        if key is None:
+            def key(header):
+                return password_key(header, password, scope)
+        return decrypt_stream(itertools.chain([first], pieces), key, workers=workers)
+    return iter([decrypt_legacy(first + b"".join(pieces), password)])
+
+
+def decrypt_legacy(data, password):
+    """Decrypt a whole-file Fernet token written before the segmented format"""
+    key = base64.urlsafe_b64encode(hashlib.sha256(password.encode()).digest())
+    return Fernet(key).decrypt(data)
@@ -0,0 +1,194 @@
+"""
+Upload and download throughput and latency of the sync and async servers
+with 10, 100 and 1000 concurrent clients.
+
+Each client logs in once, then repeatedly uploads a file of `size_kb` KiB
+as a raw PUT, sending it in 16 KiB pieces with a short pause between them
+the way a client on a slow link would, and downloads it again. Two
+servers, each started in a fresh process against its own throwaway
+database:
+
+    sync    gunicorn with 2 x cores + 1 sync workers (api/index.py)
+    async   uvicorn running api/asgi.py, one process
+
+Usage:
+
+    python benchmarks/async_load.py [seconds] [size_kb] [clients ...]    (default: 10 256 10 100 1000)
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SERVERS = {
+    "sync": [sys.executable, "-m", "gunicorn", "--workers", str(2 * (os.cpu_count() or 1) + 1), "--timeout", "300",
+             "--bind", "127.0.0.1:{port}", "api.index:app"],
+    "async": [sys.executable, "-m", "uvicorn", "--host", "127.0.0.1", "--port", "{port}", "--log-level", "warning",
+              "--backlog", "4096", "api.asgi:app"],
+}
+PIECE_SIZE = 16 * 1024
+PIECE_DELAY = 0.005  # seconds between upload pieces
+REQUEST_TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def http_request(port, method, path, body=b"", headers=None, piece_delay=0):
+    """Make one HTTP/1.1 request on a new connection; returns (status, headers, body)"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        head = [f"{method} {path} HTTP/1.1", f"Host: 127.0.0.1:{port}", "Connection: close",
+                f"Content-Length: {len(body)}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        for offset in range(0, len(body), PIECE_SIZE):
+            writer.write(body[offset:offset + PIECE_SIZE])
+            await writer.drain()
+            if piece_delay:
+                await asyncio.sleep(piece_delay)
+        status = int((await reader.readline()).split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            response_headers[name.strip().lower()] = value.strip()
+        if "content-length" in response_headers:
+            data = await reader.readexactly(int(response_headers["content-length"]))
+        elif response_headers.get("transfer-encoding") == "chunked":
+            data = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                data += await reader.readexactly(size + 2)
+                del data[len(data) - 2:]
+                if size == 0:
+                    break
+            data = bytes(data)
+        else:
+            data = await reader.read()
+        return status, response_headers, data
+    finally:
+        writer.close()
+
+
+async def login(port):
+    credentials = json.dumps({"username": "loadtest", "password": "loadtest"}).encode()
+    json_headers = {"Content-Type": "application/json"}
+    await http_request(port, "POST", "/api/register", credentials, json_headers)
+    _, _, body = await http_request(port, "POST", "/api/login", credentials, json_headers)
+    return json.loads(body)["session_id"]
+
+
+async def client(port, session_id, prefix, size, deadline, results):
+    cookie = {"Cookie": f"session_id={session_id}"}
+    payload = os.urandom(size)
+    iteration = 0
+    while time.monotonic() < deadline:
+        name = f"{prefix}_{iteration}.bin"
+        iteration += 1
+        try:
+            start = time.monotonic()
+            status, _, body = await asyncio.wait_for(
+                http_request(port, "PUT", f"/api/upload?filename={name}", payload,
+                             dict(cookie, **{"Content-Type": "application/octet-stream"}), PIECE_DELAY),
+                REQUEST_TIMEOUT)
+            if status != 200 or not json.loads(body)["success"]:
+                raise ValueError(body[:200])
+            results["upload"].append(time.monotonic() - start)
+
+            start = time.monotonic()
+            status, _, body = await asyncio.wait_for(
+                http_request(port, "GET", f"/api/download?filename={name}", headers=cookie), REQUEST_TIMEOUT)
+            if status != 200 or len(body) != size:
+                raise ValueError(f"download returned {status}, {len(body)} bytes")
+            results["download"].append(time.monotonic() - start)
+        except (OSError, ValueError, KeyError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            results["errors"].append(type(e).__name__)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+async def run_level(port, session_id, clients, seconds, size):
+    results = {"upload": [], "download": [], "errors": []}
+    deadline = time.monotonic() + seconds
+    started = time.monotonic()
+    await asyncio.gather(*(client(port, session_id, f"{clients}c{number}", size, deadline, results)
+                           for number in range(clients)))
+    elapsed = time.monotonic() - started
+    transfers = len(results["upload"]) + len(results["download"])
+    return {
+        "transfers_per_s": transfers / elapsed,
+        "mb_per_s": transfers * size / elapsed / 1e6,
+        "upload_p50": percentile(results["upload"], 0.5),
+        "upload_p99": percentile(results["upload"], 0.99),
+        "download_p50": percentile(results["download"], 0.5),
+        "download_p99": percentile(results["download"], 0.99),
+        "errors": len(results["errors"]),
+    }
+
+
+def wait_until_up(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def run_mode(mode, levels, seconds, size):
+    port = free_port()
+    command = [part.format(port=port) for part in SERVERS[mode]]
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    with tempfile.TemporaryDirectory() as workdir:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(port, process)
+            session_id = asyncio.run(login(port))
+            for clients in levels:
+                result = asyncio.run(run_level(port, session_id, clients, seconds, size))
+                print(f"{mode:>6} {clients:>7} {result['transfers_per_s']:>10.1f} {result['mb_per_s']:>7.1f} "
+                      f"{result['upload_p50']:>9.0f} {result['upload_p99']:>9.0f} "
+                      f"{result['download_p50']:>9.0f} {result['download_p99']:>9.0f} {result['errors']:>7}",
+                      flush=True)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main(seconds, size_kb, levels):
+    # One socket per client, plus the server's own in the same session
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, 4 * max(levels) + 256)), hard))
+    print(f"{seconds:.0f} s per level, {size_kb} KiB files, latencies in ms")
+    print(f"{'server':>6} {'clients':>7} {'transfers/s':>10} {'MB/s':>7} "
+          f"{'up p50':>9} {'up p99':>9} {'down p50':>9} {'down p99':>9} {'errors':>7}")
+    for mode in SERVERS:
+        run_mode(mode, levels, seconds, size_kb * 1024)
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    size_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    levels = [int(arg) for arg in sys.argv[3:]] or [10, 100, 1000]
+    main(seconds, size_kb, levels)
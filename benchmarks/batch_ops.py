@@ -0,0 +1,116 @@
+"""
+Encrypting, decrypting and deleting many files one request at a time
+versus with the batch endpoints, and exporting them as a streamed archive.
+
+Uploads `files` files of `size_kb` KiB (defaults: 2000 and 4) to the async
+server (api/asgi.py under uvicorn, fresh process and throwaway database),
+then times each operation both ways from a single client, counting the
+write transactions the server committed from its /api/health report.
+
+Usage:
+
+    python benchmarks/batch_ops.py [files] [size_kb]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import subprocess
+
+from async_load import ROOT, SERVERS, free_port, http_request, wait_until_up
+
+PASSWORD = "batch-benchmark"
+
+
+async def post_json(port, path, body, cookie):
+    return await http_request(port, "POST", path, json.dumps(body).encode(),
+                              dict(cookie, **{"Content-Type": "application/json"}))
+
+
+async def commits(port):
+    _, _, body = await http_request(port, "GET", "/api/health")
+    return json.loads(body)["writes"]["batches"]
+
+
+async def one_by_one(port, cookie, names, operation):
+    for name in names:
+        if operation == "delete":
+            status, _, body = await http_request(port, "DELETE", f"/api/delete?filename={name}", headers=cookie)
+        else:
+            status, _, body = await post_json(port, f"/api/{operation}", {"filename": name, "password": PASSWORD},
+                                              cookie)
+        if status != 200 or not json.loads(body)["success"]:
+            raise RuntimeError(f"{operation} {name} failed: {body[:200]}")
+
+
+async def batched(port, cookie, names, operation):
+    status, _, body = await post_json(port, f"/api/batch/{operation}", {"files": names, "password": PASSWORD}, cookie)
+    summary = json.loads(body.splitlines()[-1])
+    if status != 200 or summary.get("failed") or summary.get("succeeded") != len(names):
+        raise RuntimeError(f"batch {operation} failed: {body[-200:]}")
+
+
+async def run(port, file_count, size):
+    credentials = json.dumps({"username": "batch", "password": "batch"}).encode()
+    json_headers = {"Content-Type": "application/json"}
+    await http_request(port, "POST", "/api/register", credentials, json_headers)
+    _, _, body = await http_request(port, "POST", "/api/login", credentials, json_headers)
+    cookie = {"Cookie": f"session_id={json.loads(body)['session_id']}"}
+
+    async def upload(names):
+        for name in names:
+            await http_request(port, "PUT", f"/api/upload?filename={name}", os.urandom(size),
+                               dict(cookie, **{"Content-Type": "application/octet-stream"}))
+
+    print(f"{'operation':>9} {'mode':>10} {'seconds':>8} {'files/s':>8} {'requests':>8} {'commits':>8}")
+    for mode, names in (("one by one", [f"single_{i}.bin" for i in range(file_count)]),
+                        ("batch", [f"batch_{i}.bin" for i in range(file_count)])):
+        await upload(names)
+        for operation in ("encrypt", "decrypt", "delete"):
+            before = await commits(port)
+            start = time.monotonic()
+            if mode == "batch":
+                await batched(port, cookie, names, operation)
+            else:
+                await one_by_one(port, cookie, names, operation)
+            elapsed = time.monotonic() - start
+            # Less the commits made while the session or the report were read
+            committed = await commits(port) - before
+            requests = 1 if mode == "batch" else file_count
+            print(f"{operation:>9} {mode:>10} {elapsed:>8.2f} {file_count / elapsed:>8.0f} {requests:>8} "
+                  f"{committed:>8}", flush=True)
+
+    names = [f"export_{i}.bin" for i in range(file_count)]
+    await upload(names)
+    for archive_format in ("zip", "tar"):
+        start = time.monotonic()
+        status, _, body = await post_json(port, "/api/batch/archive", {"files": names, "format": archive_format},
+                                          cookie)
+        elapsed = time.monotonic() - start
+        if status != 200:
+            raise RuntimeError(f"{archive_format} export failed: {body[:200]}")
+        print(f"{archive_format + ' export':>20} {elapsed:>8.2f} {file_count / elapsed:>8.0f} "
+              f"{len(body) / elapsed / 1e6:>6.1f} MB/s", flush=True)
+
+
+def main(file_count, size_kb):
+    port = free_port()
+    command = [part.format(port=port) for part in SERVERS["async"]]
+    print(f"{file_count} files of {size_kb} KiB")
+    with tempfile.TemporaryDirectory() as workdir:
+        process = subprocess.Popen(command, cwd=workdir, env=dict(os.environ, PYTHONPATH=ROOT),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(port, process)
+            asyncio.run(run(port, file_count, size_kb * 1024))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    main(file_count, size_kb)
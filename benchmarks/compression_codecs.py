@@ -0,0 +1,97 @@
+"""
+Bytes stored and CPU cost of each compression codec on a mixed corpus.
+
+Usage:
+
+    python benchmarks/compression_codecs.py [directory]
+
+Without a directory, the corpus is generated: logs, JSON, CSV and source
+code (compressible) next to random data named like JPEG, ZIP and MP4 files
+(already compressed). Files are cut into chunk store chunks and compressed
+one chunk at a time, as uploads are. Each codec is run twice: with MIME
+type skipping, as uploads do, and compressing everything. Throughput is
+over the whole corpus, so skipped files count as free.
+"""
+import os
+import sys
+import json
+import time
+import random
+import mimetypes
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api.chunk_store import iter_chunks  # noqa: E402
+from api.compression import CODECS, choose_codec, compress_chunk, decompress_chunk  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def generated_corpus(scale_mb=8):
+    """Return [(name, data)] with roughly `scale_mb` MiB per kind of file"""
+    rng = random.Random(1234)
+    words = ["upload", "download", "encrypt", "user", "file", "chunk", "error", "session", "ok", "denied"]
+    size = scale_mb * MB
+    log = bytearray()
+    while len(log) < size:
+        log += (f"2024-05-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d} INFO "
+                f"{' '.join(rng.choice(words) for _ in range(8))} id={rng.randint(0, 10**6)}\n").encode()
+    records = [{"id": i, "name": rng.choice(words) * 2, "size": rng.randint(0, 10**9), "tags": rng.sample(words, 3)}
+               for i in range(size // 100)]
+    csv = "\n".join(f"{r['id']},{r['name']},{r['size']},{'|'.join(r['tags'])}" for r in records).encode()
+    root = os.path.join(os.path.dirname(__file__), '..')
+    source = b"".join(open(os.path.join(dirpath, name), 'rb').read()
+                      for dirpath, _, names in os.walk(root) if '.git' not in dirpath
+                      for name in names if name.endswith(('.py', '.css', '.html')))
+    return [("app.log", bytes(log)), ("records.json", json.dumps(records).encode()), ("table.csv", csv),
+            ("source.py", source), ("photo.jpg", os.urandom(size)), ("archive.zip", os.urandom(size)),
+            ("clip.mp4", os.urandom(size))]
+
+
+def directory_corpus(directory):
+    corpus = []
+    for dirpath, _, names in os.walk(directory):
+        for name in names:
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                corpus.append((name, f.read()))
+    return corpus
+
+
+def run(corpus, codec, skip):
+    """Return (stored bytes, compress CPU seconds, decompress CPU seconds)"""
+    stored = 0
+    compress_seconds = decompress_seconds = 0.0
+    for name, data in corpus:
+        file_codec = choose_codec(mimetypes.guess_type(name)[0], name, default=codec) if skip else codec
+        for chunk in iter_chunks(data):
+            if file_codec in (None, "none"):
+                stored += len(chunk)
+                continue
+            start = time.process_time()
+            packed = compress_chunk(chunk, file_codec)
+            compress_seconds += time.process_time() - start
+            if packed is None:
+                stored += len(chunk)
+                continue
+            stored += len(packed)
+            start = time.process_time()
+            decompress_chunk(packed, file_codec)
+            decompress_seconds += time.process_time() - start
+    return stored, compress_seconds, decompress_seconds
+
+
+def main(corpus):
+    total = sum(len(data) for _, data in corpus)
+    print(f"{len(corpus)} files, {total / MB:.1f} MiB")
+    print(f"{'codec':>16} {'stored MB':>10} {'ratio':>7} {'comp CPU s':>11} {'comp MB/s':>10} {'decomp MB/s':>12}")
+    for codec in ["none"] + list(CODECS):
+        for skip in ((True,) if codec == "none" else (True, False)):
+            stored, compress_seconds, decompress_seconds = run(corpus, codec, skip)
+            label = codec if skip else f"{codec} (no skip)"
+            comp_rate = total / MB / compress_seconds if compress_seconds else float('inf')
+            decomp_rate = total / MB / decompress_seconds if decompress_seconds else float('inf')
+            print(f"{label:>16} {stored / MB:>10.1f} {stored / total:>7.3f} {compress_seconds:>11.2f} "
+                  f"{comp_rate:>10.1f} {decomp_rate:>12.1f}")
+
+
+if __name__ == "__main__":
+    main(directory_corpus(sys.argv[1]) if len(sys.argv) > 1 else generated_corpus())
@@ -0,0 +1,54 @@
+"""
+Encrypt/decrypt throughput of the segmented cipher for different worker counts.
+
+Usage:
+
+    python benchmarks/crypto_throughput.py [size_mb] [workers ...]
+
+By default encrypts 256 MiB with 1, 2, 4, ... up to the number of cores.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api.stream_cipher import encrypt_stream, decrypt_stream  # noqa: E402
+
+PIECE_SIZE = 1024 * 1024
+
+
+def measure(func):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = func()
+    return result, time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def main(size_mb, worker_counts):
+    key = os.urandom(32)
+    # Reuse one random piece so generating input doesn't dominate the timing
+    piece = os.urandom(PIECE_SIZE)
+    pieces = [piece] * size_mb
+
+    print(f"{size_mb} MiB, {os.cpu_count()} cores")
+    print(f"{'workers':>8} {'enc MB/s':>10} {'dec MB/s':>10} {'CPU %':>8}")
+    for workers in worker_counts:
+        ciphertext, enc_seconds, enc_cpu = measure(lambda: list(encrypt_stream(pieces, key, b"", workers=workers, version=1)))
+        plain_size, dec_seconds, dec_cpu = measure(
+            lambda: sum(len(p) for p in decrypt_stream(ciphertext, key, workers=workers)))
+        assert plain_size == size_mb * PIECE_SIZE
+        cpu_percent = 100 * (enc_cpu + dec_cpu) / (enc_seconds + dec_seconds)
+        print(f"{workers:>8} {size_mb / enc_seconds:>10.1f} {size_mb / dec_seconds:>10.1f} {cpu_percent:>8.0f}")
+
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    worker_counts = [int(arg) for arg in sys.argv[2:]]
+    if not worker_counts:
+        cores = os.cpu_count() or 1
+        worker_counts = [1]
+        while worker_counts[-1] * 2 <= cores:
+            worker_counts.append(worker_counts[-1] * 2)
+        if worker_counts[-1] != cores:
+            worker_counts.append(cores)
+    main(size_mb, worker_counts)
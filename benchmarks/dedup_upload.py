@@ -0,0 +1,73 @@
+"""
+Upload latency and storage when the same file is uploaded over and over.
+
+Usage:
+
+    python benchmarks/dedup_upload.py [size_mb] [copies]
+
+Uploads `copies` copies (default 20) of one `size_mb` MiB file (default 32)
+three ways against a throwaway database: a fresh random file each time (no
+duplicates), the same bytes each time (chunks dedup on the server), and the
+same bytes with an X-Content-SHA256 header (hash match short-circuits the
+upload).
+"""
+import os
+import sys
+import time
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+MB = 1024 * 1024
+
+
+def main(size_mb, copies):
+    os.chdir(tempfile.mkdtemp(prefix="dedup_bench_"))
+    from api.index import app, get_db_connection  # noqa: E402
+    from api.chunk_store import dedup_stats  # noqa: E402
+
+    client = app.test_client()
+    client.post('/api/register', json={'username': 'bench', 'password': 'bench'})
+    client.post('/api/login', json={'username': 'bench', 'password': 'bench'})
+    data = os.urandom(size_mb * MB)
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    def upload(name, body, headers=None):
+        start = time.perf_counter()
+        response = client.post(f'/api/upload?filename={name}', data=body, headers=headers or {},
+                               content_type='application/octet-stream')
+        assert response.json['success'], response.json
+        return time.perf_counter() - start
+
+    print(f"{copies} uploads of {size_mb} MiB")
+    print(f"{'mode':>12} {'first (ms)':>11} {'repeat (ms)':>12} {'stored MB':>10} {'ratio':>7}")
+    for mode in ("unique", "same bytes", "hash header"):
+        conn = get_db_connection()
+        before = dedup_stats(conn.cursor())
+        timings = []
+        for i in range(copies):
+            name = f"{mode.replace(' ', '_')}_{i}.bin"
+            if mode == "unique":
+                timings.append(upload(name, os.urandom(size_mb * MB)))
+            elif mode == "same bytes" or i == 0:
+                timings.append(upload(name, data))
+            else:
+                timings.append(upload(name, b"", {'X-Content-SHA256': content_hash}))
+        after = dedup_stats(conn.cursor())
+        conn.close()
+        stored = (after['stored_bytes'] - before['stored_bytes']) / MB
+        logical = (after['logical_bytes'] - before['logical_bytes']) / MB
+        repeat = sum(timings[1:]) / max(len(timings) - 1, 1)
+        print(f"{mode:>12} {timings[0] * 1000:>11.1f} {repeat * 1000:>12.1f} {stored:>10.1f} "
+              f"{logical / stored if stored else float('inf'):>7.1f}")
+        # Later modes reuse `data`, so drop it from the store between runs
+        if mode == "same bytes":
+            for i in range(copies):
+                client.delete(f'/api/delete?filename=same_bytes_{i}.bin')
+
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    copies = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(size_mb, copies)
@@ -0,0 +1,187 @@
+"""
+Download throughput and server CPU per gigabyte, with and without the
+kernel sending file contents straight to the socket.
+
+Starts gunicorn with one sync worker against a throwaway database (file
+contents in the local storage backend), uploads one file of `big_mb` MiB
+and `small` files of 1 MiB, then downloads each of them. The server's CPU
+time is read from /proc for it and its workers, so this needs Linux. Runs
+twice: as configured, and with --no-sendfile, where gunicorn reads each
+file into Python and writes it to the socket.
+
+Then times the desktop app's download (copying a file's contents to a file
+on disk) chunk by chunk through Python and with copy_file_data.
+
+Usage:
+
+    python benchmarks/download_zero_copy.py [big_mb] [small]    (default: 1024 200)
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from async_load import ROOT, free_port, wait_until_up
+
+MODES = {"sendfile": [], "no-sendfile": ["--no-sendfile"]}
+BLOCK = 1024 * 1024
+
+
+def server_cpu(pid):
+    """CPU seconds used by a process and its children, from /proc"""
+    total = 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            total += (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+
+def http_request(port, method, path, session_id=None, body=(), body_size=0, headers=()):
+    """Make one request; returns (status, body). GET bodies are read and counted, not kept"""
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        head = [f"{method} {path} HTTP/1.1", "Host: 127.0.0.1", "Connection: close",
+                f"Content-Length: {body_size}", *headers]
+        if session_id:
+            head.append(f"Cookie: session_id={session_id}")
+        sock.sendall(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        for piece in body:
+            sock.sendall(piece)
+        response = sock.makefile("rb")
+        status = int(response.readline().split()[1])
+        length = 0
+        while True:
+            line = response.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        if method != "GET":
+            return status, response.read(length)
+        buffer = memoryview(bytearray(BLOCK))
+        received = 0
+        while received < length:
+            count = response.readinto(buffer[:min(BLOCK, length - received)])
+            if not count:
+                break
+            received += count
+        return status, received
+
+
+def upload(port, session_id, name, pieces, size):
+    status, body = http_request(port, "PUT", f"/api/upload?filename={name}", session_id, pieces, size,
+                                ["Content-Type: application/octet-stream"])
+    if status != 200 or not json.loads(body)["success"]:
+        raise RuntimeError(f"Upload of {name} failed: {body[:200]}")
+
+
+def run_mode(mode, big_mb, small):
+    port = free_port()
+    command = [sys.executable, "-m", "gunicorn", "--workers", "1", "--timeout", "600",
+               "--bind", f"127.0.0.1:{port}", *MODES[mode], "api.index:app"]
+    env = dict(os.environ, PYTHONPATH=ROOT, SFMS_STORAGE="local")
+    with tempfile.TemporaryDirectory(prefix="download_bench_") as workdir:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(port, process)
+            credentials = json.dumps({"username": "bench", "password": "bench"}).encode()
+            json_headers = ["Content-Type: application/json"]
+            http_request(port, "POST", "/api/register", body=[credentials], body_size=len(credentials),
+                         headers=json_headers)
+            _, body = http_request(port, "POST", "/api/login", body=[credentials], body_size=len(credentials),
+                                   headers=json_headers)
+            session_id = json.loads(body)["session_id"]
+
+            # Blocks differ so none of them dedup against another
+            block = os.urandom(BLOCK)
+            upload(port, session_id, "big.bin",
+                   (block[:-8] + number.to_bytes(8, "big") for number in range(big_mb)), big_mb * BLOCK)
+            for number in range(small):
+                upload(port, session_id, f"small_{number}.bin", [os.urandom(BLOCK)], BLOCK)
+
+            for label, names in ((f"1 x {big_mb} MiB", ["big.bin"]),
+                                 (f"{small} x 1 MiB", [f"small_{number}.bin" for number in range(small)])):
+                cpu = server_cpu(process.pid)
+                start = time.perf_counter()
+                total = 0
+                for name in names:
+                    status, received = http_request(port, "GET", f"/api/download?filename={name}", session_id)
+                    if status != 200:
+                        raise RuntimeError(f"Download of {name} returned {status}")
+                    total += received
+                elapsed = time.perf_counter() - start
+                cpu = server_cpu(process.pid) - cpu
+                print(f"{mode:>11} {label:>14} {total / elapsed / 1e6:>8.1f} {cpu / total * 1e9:>9.2f}", flush=True)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def run_desktop(size_mb):
+    """Copy a stored file to disk chunk by chunk and with copy_file_data, in a throwaway directory"""
+    with tempfile.TemporaryDirectory(prefix="download_bench_") as workdir:
+        os.chdir(workdir)
+        os.environ["SFMS_STORAGE"] = "local"
+        sys.path.insert(0, ROOT)
+        from api.database import get_connection, get_writer
+        from api.schema import init_schema
+        from api.chunk_store import iter_chunks, store_file_data, iter_file_data, copy_file_data
+
+        conn = get_connection()
+        init_schema(conn.cursor())
+        conn.commit()
+
+        def store(cursor, data):
+            cursor.execute("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                           "VALUES (1, 'big.bin', ?, 'application/octet-stream', 'Uploaded', '')", (len(data),))
+            file_id = cursor.lastrowid
+            store_file_data(cursor, file_id, iter_chunks(data))
+            return file_id
+
+        file_id = get_writer().run(store, os.urandom(size_mb * BLOCK))
+
+        def chunk_by_chunk(cursor, destination):
+            for chunk in iter_file_data(cursor, file_id):
+                destination.write(chunk)
+
+        for label, copy in (("chunk by chunk", chunk_by_chunk),
+                            ("copy_file_data", lambda cursor, destination: copy_file_data(cursor, file_id, destination))):
+            times = os.times()
+            start = time.perf_counter()
+            with open("copy.bin", "wb") as destination:
+                copy(conn.cursor(), destination)
+            elapsed = time.perf_counter() - start
+            cpu = os.times()
+            print(f"{label:>14} {size_mb / elapsed:>8.1f} {(cpu.user - times.user) / size_mb * 1024:>9.2f} "
+                  f"{(cpu.system - times.system) / size_mb * 1024:>9.2f}")
+            os.remove("copy.bin")
+        conn.close()
+
+
+def main(big_mb, small):
+    print("Server downloads (gunicorn, 1 worker)")
+    print(f"{'mode':>11} {'files':>14} {'MB/s':>8} {'cpu s/GB':>9}")
+    for mode in MODES:
+        run_mode(mode, big_mb, small)
+    print()
+    print(f"Desktop download of a {big_mb} MiB file to disk")
+    print(f"{'copy':>14} {'MiB/s':>8} {'user s/GB':>9} {'sys s/GB':>9}")
+    run_desktop(big_mb)
+
+
+if __name__ == "__main__":
+    big_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    small = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    main(big_mb, small)
@@ -0,0 +1,96 @@
+"""
+Latency of GET /api/files with and without the connection pool.
+
+Reports the whole request ("api") and the database part alone: getting a
+connection, running the listing query and closing it ("query").
+
+Each mode runs in a fresh process against the same throwaway database.
+"no pool" sets SFMS_DB_POOL_SIZE=0, so every request opens and closes
+its own connection as before. Usage:
+
+    python benchmarks/files_latency.py [requests] [files]    (default: 2000 200)
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import datetime
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODES = [("no pool", "0"), ("pool", "8")]
+
+
+def prepare(workdir, file_count):
+    """Create a database with one user owning `file_count` small files"""
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from api.index import app
+
+    client = app.test_client()
+    client.post('/api/register', json={'username': 'bench', 'password': 'bench'})
+    conn = sqlite3.connect("file_manager.db")
+    user_id = conn.execute("SELECT id FROM users WHERE username = 'bench'").fetchone()[0]
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                     "VALUES (?, ?, ?, 'text/plain', 'Uploaded', ?)",
+                     [(user_id, f"file_{i}.txt", i * 100, now) for i in range(file_count)])
+    conn.commit()
+    conn.close()
+
+
+def run_single(workdir, requests):
+    """Time `requests` listings through the API and through the database alone; print both as JSON"""
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from api.index import app, get_db_connection
+
+    client = app.test_client()
+    client.post('/api/login', json={'username': 'bench', 'password': 'bench'})
+    for _ in range(20):
+        client.get('/api/files')
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get('/api/files')
+        latencies.append((time.perf_counter() - start) * 1000)
+        assert response.json['success']
+    query_latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        conn = get_db_connection()
+        conn.execute("SELECT id, file_name, file_size, file_type, action, timestamp FROM files WHERE user_id = 1").fetchall()
+        conn.close()
+        query_latencies.append((time.perf_counter() - start) * 1000)
+    print(json.dumps({'api': latencies, 'query': query_latencies}))
+
+
+def main(requests, file_count):
+    workdir = tempfile.mkdtemp(prefix="files_bench_")
+    subprocess.run([sys.executable, __file__, '--prepare', workdir, str(file_count)], check=True,
+                   capture_output=True)
+    print(f"{requests} requests, {file_count} files")
+    print(f"{'mode':>8} {'':>6} {'mean (ms)':>10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for label, pool_size in MODES:
+        env = dict(os.environ, SFMS_DB_POOL_SIZE=pool_size)
+        output = subprocess.run([sys.executable, __file__, '--single', workdir, str(requests)],
+                                capture_output=True, text=True, check=True, env=env).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+        for kind in ('api', 'query'):
+            latencies = sorted(results[kind])
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+            print(f"{label:>8} {kind:>6} {sum(latencies) / len(latencies):>10.3f} {percentile(0.5):>9.3f} "
+                  f"{percentile(0.95):>9.3f} {percentile(0.99):>9.3f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == '--prepare':
+        prepare(sys.argv[2], int(sys.argv[3]))
+    elif len(sys.argv) > 3 and sys.argv[1] == '--single':
+        run_single(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,68 @@
+"""
+Latency of one page of a file listing, near the start and deep into it,
+for a user with many files: keyset pagination (api/listing.py) against
+LIMIT/OFFSET, and the full unpaged listing /api/files used to return.
+
+Usage:
+
+    python benchmarks/files_pagination.py [files] [page_size]    (default: 50000 100)
+"""
+import os
+import sys
+import time
+import sqlite3
+import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api.schema import init_schema  # noqa: E402
+from api.listing import LISTING_COLUMNS, list_files  # noqa: E402
+
+REPEATS = 50
+
+
+def timed(func):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func()
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+
+def main(file_count, page_size):
+    conn = sqlite3.connect(":memory:")
+    cursor = conn.cursor()
+    init_schema(cursor)
+    now = datetime.datetime.now()
+    cursor.executemany("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                       "VALUES (?, ?, ?, 'text/plain', 'Uploaded', ?)",
+                       [(1, f"file_{i:07d}.txt", (i * 7919) % 100000,
+                         (now - datetime.timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S")) for i in range(file_count)])
+    # A second user so the listing isn't the whole table
+    cursor.executemany("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                       "VALUES (2, ?, 1, 'text/plain', 'Uploaded', '2024-01-01 00:00:00')",
+                       [(f"other_{i}",) for i in range(file_count)])
+    conn.commit()
+
+    print(f"{file_count} files, {page_size} per page, ms per page")
+    print(f"{'sort':>10} {'position':>9} {'keyset':>8} {'offset':>8}")
+    for sort, column, order in [("name", "file_name", "ASC"), ("size", "file_size", "DESC"),
+                                ("timestamp", "timestamp", "DESC")]:
+        for position in (0, file_count // 2, file_count - page_size):
+            # The id a client would hold after paging to `position`
+            after_id = None
+            if position:
+                cursor.execute(f"SELECT id FROM files WHERE user_id = 1 ORDER BY {column} {order}, id {order} "
+                               f"LIMIT 1 OFFSET ?", (position - 1,))
+                after_id = cursor.fetchone()[0]
+            keyset = timed(lambda: list_files(cursor, 1, sort, after_id=after_id, limit=page_size))
+            offset = timed(lambda: cursor.execute(
+                f"SELECT {LISTING_COLUMNS} FROM files WHERE user_id = 1 ORDER BY {column} {order}, id {order} "
+                f"LIMIT ? OFFSET ?", (page_size, position)).fetchall())
+            print(f"{sort:>10} {position:>9} {keyset:>8.3f} {offset:>8.3f}")
+    unpaged = timed(lambda: cursor.execute(f"SELECT {LISTING_COLUMNS} FROM files WHERE user_id = 1").fetchall())
+    print(f"unpaged listing of all {file_count} files: {unpaged:.2f} ms")
+
+
+if __name__ == "__main__":
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    page = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    main(files, page)
@@ -0,0 +1,61 @@
+"""
+Cost of bulk-decrypting many files encrypted with the same passphrase,
+with and without the derived-key cache.
+
+Usage:
+
+    python benchmarks/kdf_cache.py [files] [uncached_sample]
+
+Encrypts `files` small files (default 1000) and decrypts them all with
+the cache enabled. The uncached run decrypts `uncached_sample` of them
+(default 50) and extrapolates, since at ~100 ms per scrypt run the full
+uncached pass takes minutes.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api import kdf  # noqa: E402
+from api.stream_cipher import encrypt_with_password, decrypt_pieces  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+FILE_SIZE = 4096
+
+
+def bulk_decrypt(files, cache):
+    """Decrypt every file with the given cache and return (seconds, cache stats)"""
+    kdf.key_cache = cache
+    start = time.perf_counter()
+    for data in files:
+        b"".join(decrypt_pieces([data], PASSWORD, scope=1))
+    return time.perf_counter() - start, cache.stats()
+
+
+def main(count, uncached_sample):
+    kdf_salt = os.urandom(kdf.SALT_SIZE)
+    files = [b"".join(encrypt_with_password([os.urandom(FILE_SIZE)], PASSWORD, kdf_salt, scope=1))
+             for _ in range(count)]
+
+    start = time.perf_counter()
+    kdf.run_kdf(PASSWORD, kdf_salt, kdf.DEFAULT_KDF)
+    kdf_seconds = time.perf_counter() - start
+    print(f"{count} files, KDF {kdf.DEFAULT_KDF.name} (log2 N = {kdf.DEFAULT_KDF.log2_n}): "
+          f"{kdf_seconds * 1000:.1f} ms per run")
+
+    cached_seconds, stats = bulk_decrypt(files, kdf.KeyCache())
+    sample_seconds, _ = bulk_decrypt(files[:uncached_sample], kdf.KeyCache(max_entries=0))
+    uncached_seconds = sample_seconds / uncached_sample * count
+
+    print(f"{'mode':>10} {'total (s)':>10} {'per file (ms)':>14} {'hit rate':>9}")
+    print(f"{'uncached':>10} {uncached_seconds:>10.2f} {uncached_seconds / count * 1000:>14.2f} {0.0:>9.3f}"
+          f"   (extrapolated from {uncached_sample})")
+    print(f"{'cached':>10} {cached_seconds:>10.2f} {cached_seconds / count * 1000:>14.2f} "
+          f"{stats['hit_rate']:>9.3f}")
+    print(f"speedup: {uncached_seconds / cached_seconds:.0f}x")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    sample = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    main(count, min(sample, count))
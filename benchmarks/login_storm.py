@@ -0,0 +1,146 @@
+"""
+Login throughput during a login storm, and what the storm does to the
+latency of an unrelated endpoint.
+
+`clients` clients log in over and over as `users` different users (each
+login is a bcrypt check) while one more client, logged in beforehand,
+keeps listing its files. A client refused with 503 waits for its
+Retry-After before trying again. Each configuration runs api/asgi.py under
+uvicorn in a fresh process against its own throwaway database:
+
+    unbounded       as many auth threads as clients, no queue limit, no verify cache
+                    (every login hashing at once, as when bcrypt ran on the request thread)
+    bounded         default auth pool (one thread per core, queue limit), no verify cache
+    bounded+cache   default auth pool and verify cache
+
+Usage:
+
+    python benchmarks/login_storm.py [seconds] [clients] [users]    (default: 10 200 20)
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import resource
+import tempfile
+import subprocess
+
+from async_load import ROOT, SERVERS, free_port, http_request, percentile, wait_until_up
+
+REQUEST_TIMEOUT = 60
+
+
+def modes(clients):
+    return {
+        "unbounded": {"SFMS_AUTH_WORKERS": str(clients), "SFMS_AUTH_QUEUE_LIMIT": str(10 * clients),
+                      "SFMS_AUTH_CACHE_SIZE": "0"},
+        "bounded": {"SFMS_AUTH_CACHE_SIZE": "0"},
+        "bounded+cache": {},
+    }
+
+
+def credentials(user):
+    return json.dumps({"username": f"storm{user}", "password": f"storm-password-{user}"}).encode()
+
+
+async def post_json(port, path, body):
+    return await asyncio.wait_for(
+        http_request(port, "POST", path, body, {"Content-Type": "application/json"}), REQUEST_TIMEOUT)
+
+
+async def setup(port, users):
+    for user in range(users):
+        await post_json(port, "/api/register", credentials(user))
+    _, _, body = await post_json(port, "/api/login", credentials(0))
+    return json.loads(body)["session_id"]
+
+
+async def storm_client(port, user, deadline, results):
+    while time.monotonic() < deadline:
+        try:
+            start = time.monotonic()
+            status, headers, body = await post_json(port, "/api/login", credentials(user))
+            if status == 503:
+                results["busy"] += 1
+                await asyncio.sleep(float(headers.get("retry-after", 1)))
+                continue
+            if status != 200 or not json.loads(body)["success"]:
+                raise ValueError(body[:200])
+            results["login"].append(time.monotonic() - start)
+        except (OSError, ValueError, KeyError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            results["errors"].append(type(e).__name__)
+
+
+async def probe(port, session_id, deadline, latencies, errors):
+    cookie = {"Cookie": f"session_id={session_id}"}
+    while time.monotonic() < deadline:
+        try:
+            start = time.monotonic()
+            status, _, _ = await asyncio.wait_for(
+                http_request(port, "GET", "/api/files", headers=cookie), REQUEST_TIMEOUT)
+            if status != 200:
+                raise ValueError(status)
+            latencies.append(time.monotonic() - start)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            errors.append(type(e).__name__)
+        await asyncio.sleep(0.01)
+
+
+async def run_storm(port, session_id, clients, users, seconds):
+    # Unloaded probe latency first, for comparison
+    quiet = []
+    await probe(port, session_id, time.monotonic() + 1, quiet, [])
+
+    results = {"login": [], "busy": 0, "errors": []}
+    probe_latencies = []
+    deadline = time.monotonic() + seconds
+    started = time.monotonic()
+    await asyncio.gather(probe(port, session_id, deadline, probe_latencies, results["errors"]),
+                         *(storm_client(port, number % users, deadline, results) for number in range(clients)))
+    elapsed = time.monotonic() - started
+    return {
+        "logins_per_s": len(results["login"]) / elapsed,
+        "busy_per_s": results["busy"] / elapsed,
+        "login_p50": percentile(results["login"], 0.5),
+        "login_p99": percentile(results["login"], 0.99),
+        "quiet_p99": percentile(quiet, 0.99),
+        "probe_p50": percentile(probe_latencies, 0.5),
+        "probe_p99": percentile(probe_latencies, 0.99),
+        "errors": len(results["errors"]),
+    }
+
+
+def run_mode(mode, settings, clients, users, seconds):
+    port = free_port()
+    command = [part.format(port=port) for part in SERVERS["async"]]
+    env = dict(os.environ, PYTHONPATH=ROOT, **settings)
+    with tempfile.TemporaryDirectory() as workdir:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(port, process)
+            session_id = asyncio.run(setup(port, users))
+            result = asyncio.run(run_storm(port, session_id, clients, users, seconds))
+            print(f"{mode:>13} {result['logins_per_s']:>9.1f} {result['busy_per_s']:>7.1f} "
+                  f"{result['login_p50']:>9.0f} {result['login_p99']:>9.0f} {result['quiet_p99']:>9.1f} "
+                  f"{result['probe_p50']:>9.1f} {result['probe_p99']:>9.1f} {result['errors']:>7}", flush=True)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main(seconds, clients, users):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, 4 * clients + 256)), hard))
+    print(f"{seconds:.0f} s storm, {clients} clients, {users} users, {os.cpu_count()} cores, latencies in ms")
+    print(f"{'mode':>13} {'logins/s':>9} {'503/s':>7} {'login p50':>9} {'login p99':>9} {'idle p99':>9} "
+          f"{'files p50':>9} {'files p99':>9} {'errors':>7}")
+    for mode, settings in modes(clients).items():
+        run_mode(mode, settings, clients, users, seconds)
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    main(seconds, clients, users)
@@ -0,0 +1,62 @@
+"""
+Latency of /api/search-style prefix queries over a large search index.
+
+Fills the FTS5 index with `files` generated file names (default 1,000,000)
+spread over 100 users, then times searches for one user with prefixes of
+different lengths and selectivity, against a LIKE scan over the names.
+
+Usage:
+
+    python benchmarks/search_latency.py [files]
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api.schema import init_schema  # noqa: E402
+from api.search import search_files  # noqa: E402
+
+USERS = 100
+WORDS = ["report", "invoice", "photo", "backup", "notes", "draft", "contract", "budget", "scan", "presentation",
+         "summary", "meeting", "project", "design", "final", "archive", "receipt", "letter", "plan", "review"]
+QUERIES = ["re", "inv", "budget", "proj fin", "quarterly", "receipt 2023", "zzz"]
+REPEATS = 20
+
+
+def main(file_count):
+    random.seed(1)
+    conn = sqlite3.connect(":memory:")
+    cursor = conn.cursor()
+    init_schema(cursor)
+    start = time.perf_counter()
+    rows = []
+    for i in range(file_count):
+        name = f"{random.choice(WORDS)}_{random.choice(WORDS)}_{random.randint(2015, 2025)}_{i}.txt"
+        rows.append((i + 1, i % USERS + 1, name))
+    cursor.executemany("INSERT INTO files (id, user_id, file_name, file_size, file_type, action, timestamp) "
+                       "VALUES (?, ?, ?, 100, 'text/plain', 'Uploaded', '2024-01-01 00:00:00')", rows)
+    cursor.executemany("INSERT INTO files_fts (rowid, owner, file_name, file_type, content) "
+                       "VALUES (?, 'u' || ?, ?, 'text/plain', '')", rows)
+    conn.commit()
+    print(f"{file_count} files over {USERS} users indexed in {time.perf_counter() - start:.1f} s")
+
+    print(f"{'query':>14} {'hits':>6} {'fts (ms)':>9} {'LIKE (ms)':>10}")
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            results = search_files(cursor, 1, query)
+        fts_ms = (time.perf_counter() - start) / REPEATS * 1000
+        like = " AND ".join("file_name LIKE ?" for _ in query.split())
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            cursor.execute(f"SELECT id FROM files WHERE user_id = 1 AND {like} LIMIT 20",
+                           [f"%{word}%" for word in query.split()]).fetchall()
+        like_ms = (time.perf_counter() - start) / REPEATS * 1000
+        print(f"{query:>14} {len(results):>6} {fts_ms:>9.2f} {like_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,127 @@
+"""
+Read and write latency of the database under concurrent load.
+
+Reader threads run the /api/files listing query on pooled connections
+while writer threads insert file rows and log actions, the way uploads and
+downloads do. Two modes, each in a fresh process against its own
+throwaway database:
+
+    direct     rollback journal (SFMS_DB_JOURNAL_MODE=DELETE), every write
+               committed on its own pooled connection, as before
+    wal+queue  WAL journal, writes submitted to the single writer thread
+
+Usage:
+
+    python benchmarks/sqlite_concurrency.py [seconds] [readers] [writers]    (default: 10 8 4)
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import datetime
+import threading
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODES = [("direct", "DELETE"), ("wal+queue", "WAL")]
+SEED_FILES = 500
+
+
+def insert_file(cursor, user_id, name):
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                   "VALUES (?, ?, 100, 'text/plain', 'Uploaded', ?)", (user_id, name, now))
+    cursor.execute("UPDATE files SET action = 'Downloaded', timestamp = ? WHERE id = ?", (now, cursor.lastrowid))
+
+
+def run_single(workdir, mode, seconds, readers, writers):
+    """Load the database from several threads for `seconds`; print latencies and errors as JSON"""
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from api.database import Database, get_connection, get_writer
+
+    Database()
+    conn = get_connection()
+    for i in range(SEED_FILES):
+        insert_file(conn.cursor(), 1, f"seed_{i}.txt")
+    conn.commit()
+    conn.close()
+
+    read_latencies, write_latencies, errors = [], [], []
+    deadline = time.monotonic() + seconds
+
+    def read_loop():
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                conn = get_connection()
+                conn.execute("SELECT id, file_name, file_size, file_type, action, timestamp "
+                             "FROM files WHERE user_id = 1").fetchall()
+                conn.close()
+                read_latencies.append((time.perf_counter() - start) * 1000)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    def write_loop(worker):
+        count = 0
+        while time.monotonic() < deadline:
+            name = f"w{worker}_{count}.txt"
+            count += 1
+            start = time.perf_counter()
+            try:
+                if mode == "direct":
+                    conn = get_connection()
+                    insert_file(conn.cursor(), 1, name)
+                    conn.commit()
+                    conn.close()
+                else:
+                    get_writer().run(insert_file, 1, name)
+                write_latencies.append((time.perf_counter() - start) * 1000)
+            except sqlite3.OperationalError as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=read_loop) for _ in range(readers)]
+    threads += [threading.Thread(target=write_loop, args=(i,)) for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({'read': read_latencies, 'write': write_latencies, 'errors': errors}))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(seconds, readers, writers):
+    print(f"{seconds} s, {readers} readers, {writers} writers, {os.cpu_count()} cores")
+    print(f"{'mode':>10} {'reads/s':>8} {'read p50':>9} {'read p99':>9} "
+          f"{'writes/s':>9} {'write p50':>10} {'write p99':>10} {'locked':>7}")
+    for label, journal_mode in MODES:
+        workdir = tempfile.mkdtemp(prefix="sqlite_bench_")
+        env = dict(os.environ, SFMS_DB_JOURNAL_MODE=journal_mode)
+        output = subprocess.run([sys.executable, __file__, '--single', workdir, label,
+                                 str(seconds), str(readers), str(writers)],
+                                capture_output=True, text=True, check=True, env=env).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+        reads, writes = results['read'], results['write']
+        locked = sum(1 for error in results['errors'] if 'locked' in error)
+        print(f"{label:>10} {len(reads) / seconds:>8.0f} {percentile(reads, 0.5):>9.2f} "
+              f"{percentile(reads, 0.99):>9.2f} {len(writes) / seconds:>9.0f} "
+              f"{percentile(writes, 0.5):>10.2f} {percentile(writes, 0.99):>10.2f} {locked:>7}")
+    print("latencies in ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--single':
+        run_single(sys.argv[2], sys.argv[3], float(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6]))
+    else:
+        seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+        readers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+        writers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+        main(seconds, readers, writers)
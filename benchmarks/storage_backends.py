@@ -0,0 +1,133 @@
+"""
+What keeping file contents in the database costs, compared with keeping
+only metadata there and the bytes in a storage backend.
+
+Stores `files` files of `size_mb` MiB of random data through the chunk
+store and reads them back, then times the database chores that scale with
+its size: PRAGMA integrity_check, an online backup and VACUUM. Each
+backend runs in a fresh process against its own throwaway database:
+
+    sqlite  chunk bytes inline in the database, as before
+    local   chunk bytes as files in a sharded directory next to it
+    s3      chunk bytes in an S3-compatible bucket: the one named by
+            SFMS_S3_ENDPOINT and SFMS_S3_BUCKET if set, else the in-memory
+            stand-in of tests/s3_standin.py
+
+Files are stored as uploads are: each chunk is compressed and written to
+its backend first, then inserted by a queued write.
+
+Usage:
+
+    python benchmarks/storage_backends.py [files] [size_mb]    (default: 20 16)
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import datetime
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def create_file(cursor, name, size):
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    cursor.execute("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                   "VALUES (1, ?, ?, 'application/octet-stream', 'Uploaded', ?)", (name, size, now))
+    return cursor.lastrowid
+
+
+def store_file(writer, name, data):
+    from api.chunk_store import append_chunk, prepare_chunk, finish_file_data, write_chunks
+
+    file_id = writer.run(create_file, name, len(data))
+    _, content_hash = write_chunks(data, lambda seq, chunk: writer.submit(
+        append_chunk, file_id, seq, prepare_chunk(chunk, None, writer.run)))
+    writer.run(finish_file_data, file_id, content_hash)
+    return file_id
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run_single(workdir, files, size):
+    """Store and read back the files, then time the database chores; print the results as JSON"""
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from api.database import DB_PATH, get_connection, get_writer
+    from api.schema import init_schema
+    from api.chunk_store import iter_file_data
+
+    conn = get_connection()
+    init_schema(conn.cursor())
+    conn.commit()
+    writer = get_writer()
+
+    payloads = [os.urandom(size) for _ in range(files)]
+    start = time.perf_counter()
+    file_ids = [store_file(writer, f"file_{number}.bin", data) for number, data in enumerate(payloads)]
+    write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for file_id in file_ids:
+        for _ in iter_file_data(conn.cursor(), file_id):
+            pass
+    read_seconds = time.perf_counter() - start
+
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    database_bytes = os.path.getsize(DB_PATH)
+    integrity_seconds = timed(lambda: conn.execute("PRAGMA integrity_check").fetchall())
+
+    def backup():
+        target = sqlite3.connect("backup.db")
+        conn.backup(target)
+        target.close()
+
+    backup_seconds = timed(backup)
+    vacuum_seconds = timed(lambda: conn.execute("VACUUM"))
+    conn.close()
+    print(json.dumps({'write': write_seconds, 'read': read_seconds, 'database_bytes': database_bytes,
+                      'integrity': integrity_seconds, 'backup': backup_seconds, 'vacuum': vacuum_seconds}))
+
+
+def main(files, size_mb):
+    backends = ["sqlite", "local", "s3"]
+    s3_env = {}
+    standin = None
+    if not (os.environ.get("SFMS_S3_ENDPOINT") and os.environ.get("SFMS_S3_BUCKET")):
+        sys.path.insert(0, os.path.join(ROOT, 'tests'))
+        from s3_standin import S3StandIn
+
+        standin = S3StandIn().start()
+        s3_env = {'SFMS_S3_ENDPOINT': standin.endpoint, 'SFMS_S3_BUCKET': 'bench',
+                  'AWS_ACCESS_KEY_ID': standin.access_key, 'AWS_SECRET_ACCESS_KEY': standin.secret_key}
+    total_mb = files * size_mb
+    print(f"{files} files of {size_mb} MiB ({total_mb} MiB), times in seconds")
+    print(f"{'backend':>7} {'write MB/s':>10} {'read MB/s':>9} {'db MB':>7} "
+          f"{'integrity':>9} {'backup':>7} {'vacuum':>7}")
+    for backend in backends:
+        with tempfile.TemporaryDirectory(prefix="storage_bench_") as workdir:
+            env = dict(os.environ, SFMS_STORAGE=backend, **s3_env)
+            output = subprocess.run([sys.executable, __file__, '--single', workdir, str(files), str(size_mb)],
+                                    capture_output=True, text=True, check=True, env=env).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{backend:>7} {total_mb / result['write']:>10.1f} {total_mb / result['read']:>9.1f} "
+              f"{result['database_bytes'] / 1024 / 1024:>7.1f} {result['integrity']:>9.3f} "
+              f"{result['backup']:>7.3f} {result['vacuum']:>7.3f}")
+    if standin is not None:
+        print("(s3 against the local stand-in)")
+        standin.stop()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--single':
+        run_single(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]) * 1024 * 1024)
+    else:
+        files = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+        size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+        main(files, size_mb)
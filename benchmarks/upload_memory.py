@@ -0,0 +1,149 @@
+"""
+Peak RSS of a streaming upload through /api/upload for different file sizes,
+and of the desktop app's upload of a file on disk.
+
+The desktop upload is timed two ways: "read" copies the whole memory-mapped
+file into bytes before chunking it, as the app used to; "mmap" slices the
+mapping into chunks that are written as they are cut (main._stream_upload).
+
+Each run is a fresh process against a throwaway database so the numbers
+don't bleed into each other. Usage:
+
+    python benchmarks/upload_memory.py [size_mb ...]    (default: 10 1024)
+"""
+import os
+import sys
+import json
+import mmap
+import time
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+class RandomStream:
+    """File-like object producing `size` bytes without holding them in memory"""
+
+    def __init__(self, size, block_size=64 * 1024):
+        self.size = size
+        self.position = 0
+        self.block_size = block_size
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        self.position = offset if whence == 0 else self.size + offset
+        return self.position
+
+    def read(self, n=-1):
+        remaining = self.size - self.position
+        if remaining <= 0:
+            return b""
+        if n is None or n < 0 or n > self.block_size:
+            n = self.block_size
+        n = min(n, remaining)
+        self.position += n
+        return os.urandom(n)
+
+
+def run_single(size_mb):
+    """Upload one file of `size_mb` MiB and print timing and peak RSS as JSON"""
+    workdir = tempfile.mkdtemp(prefix="upload_bench_")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from api.index import app
+
+    client = app.test_client()
+    client.post('/api/register', json={'username': 'bench', 'password': 'bench'})
+    client.post('/api/login', json={'username': 'bench', 'password': 'bench'})
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    size = size_mb * 1024 * 1024
+    start = time.perf_counter()
+    response = client.post('/api/upload?filename=bench.bin',
+                           input_stream=RandomStream(size),
+                           content_type='application/octet-stream')
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({
+        'size_mb': size_mb,
+        'ok': response.json['success'],
+        'seconds': round(elapsed, 2),
+        'baseline_rss_mb': round(baseline_kb / 1024, 1),
+        'peak_rss_mb': round(peak_kb / 1024, 1),
+    }))
+
+
+def run_desktop(size_mb, mode):
+    """Store a file of `size_mb` MiB from disk the desktop app's way and print timing and peak RSS as JSON"""
+    workdir = tempfile.mkdtemp(prefix="upload_bench_")
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from api.database import get_connection, get_writer
+    from api.schema import init_schema
+    from api.chunk_store import (iter_chunks, store_file_data, append_chunk, prepare_chunk, finish_file_data,
+                                 write_chunks)
+
+    conn = get_connection()
+    init_schema(conn.cursor())
+    conn.commit()
+    conn.close()
+    with open("source.bin", "wb") as source:
+        stream = RandomStream(size_mb * 1024 * 1024, 1024 * 1024)
+        for block in iter(stream.read, b""):
+            source.write(block)
+    writer = get_writer()
+    file_id = writer.run(lambda cursor: cursor.execute(
+        "INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+        "VALUES (1, 'bench.bin', 0, 'application/octet-stream', 'Uploading', '')").lastrowid)
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    with open("source.bin", "rb") as source, mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mode == "read":
+            writer.run(store_file_data, file_id, iter_chunks(mm.read()))
+        else:
+            _, content_hash = write_chunks(mm, lambda seq, data: writer.submit(
+                append_chunk, file_id, seq, prepare_chunk(data, None, writer.run)))
+            writer.run(finish_file_data, file_id, content_hash)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({
+        'size_mb': size_mb,
+        'ok': True,
+        'seconds': round(elapsed, 2),
+        'baseline_rss_mb': round(baseline_kb / 1024, 1),
+        'peak_rss_mb': round(peak_kb / 1024, 1),
+    }))
+
+
+def print_result(label, size_mb, command):
+    output = subprocess.run([sys.executable, __file__] + command, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    delta = result['peak_rss_mb'] - result['baseline_rss_mb']
+    rate = size_mb / result['seconds'] if result['seconds'] else 0
+    print(f"{label:>8} {size_mb:>10} {result['seconds']:>10} {rate:>8.1f} {result['baseline_rss_mb']:>10} "
+          f"{result['peak_rss_mb']:>10} {delta:>8.1f}")
+
+
+def main(sizes):
+    print(f"{'upload':>8} {'size (MB)':>10} {'time (s)':>10} {'MB/s':>8} {'base RSS':>10} {'peak RSS':>10} {'delta':>8}")
+    for size_mb in sizes:
+        print_result("api", size_mb, ['--single', str(size_mb)])
+    for mode in ("read", "mmap"):
+        for size_mb in sizes:
+            print_result(mode, size_mb, ['--desktop', mode, str(size_mb)])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == '--single':
+        run_single(int(sys.argv[2]))
+    elif len(sys.argv) > 3 and sys.argv[1] == '--desktop':
+        run_desktop(int(sys.argv[3]), sys.argv[2])
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or [10, 1024])
@@ -1,5 +1,51 @@
 import sqlite3
 import os
+from api.chunk_store import dedup_stats
+from api.blob_store import storage_stats, sweep_blobs
+from api.database import get_connection, get_writer, close_pools
+from api.schema import (create_tables, init_schema, migrate_schema, run_migrations, pending_migrations,
+                        format_progress, check_query_plans)
+
+def print_dedup_report(cursor):
+    """Print how much space content deduplication is saving"""
+    try:
+        stats = dedup_stats(cursor)
+    except sqlite3.Error as e:
+        print(f"Could not compute deduplication report: {e}")
+        return
+    mb = 1024 * 1024
+    print(f"Deduplication: {stats['files']} files, {stats['logical_bytes'] / mb:.1f} MB of data in "
+          f"{stats['unique_bytes'] / mb:.1f} MB of distinct chunks (ratio {stats['ratio']:.2f}x)")
+    print(f"Compression: {stats['chunks']} chunks stored in {stats['stored_bytes'] / mb:.1f} MB "
+          f"({stats['compression_ratio']:.0%} of their size, {stats['saved_bytes'] / mb:.1f} MB saved in total)")
+
+def print_storage_report(cursor):
+    """Print where chunk bytes are kept, and delete blobs no chunk uses any more"""
+    try:
+        removed = sweep_blobs(get_writer().run)
+        stats = storage_stats(cursor)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Could not compute storage report: {e}")
+        return
+    mb = 1024 * 1024
+    print(f"Storage: new chunks go to {stats['backend']}; " + ", ".join(
+        f"{location} holds {usage['chunks']} chunks ({usage['bytes'] / mb:.1f} MB)"
+        for location, usage in sorted(stats['locations'].items())))
+    print(f"Released blobs: {removed} deleted, {stats['garbage']} kept until downloads reading them are done")
+
+def print_query_plan_report(cursor):
+    """Check that the hot lookups are answered from their indexes"""
+    try:
+        problems = check_query_plans(cursor)
+    except sqlite3.Error as e:
+        print(f"Could not check query plans: {e}")
+        return
+    if problems:
+        print("Query plan regressions found:")
+        for problem in problems:
+            print(f"  {problem}")
+    else:
+        print("Query plans: all hot queries use their indexes.")
 
 def repair_database():
     """
@@ -13,23 +59,35 @@ def repair_database():
         return
     
     try:
-        # Create backup first
+        # Connect to database
+        conn = get_connection()
+        cursor = conn.cursor()
+        
+        # Create backup first; recent commits may still be in the write-ahead
+        # log, so fold them into the main file before copying it
         if os.path.exists("file_manager.db"):
             print("Creating backup of current database...")
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
             with open("file_manager.db", "rb") as src:
                 with open("file_manager.db.backup", "wb") as dst:
                     dst.write(src.read())
         
-        # Connect to database
-        conn = sqlite3.connect("file_manager.db")
-        cursor = conn.cursor()
-        
         # Integrity check
         cursor.execute("PRAGMA integrity_check;")
         integrity_result = cursor.fetchone()[0]
         
         if integrity_result == "ok":
             print("Database integrity check passed.")
+            init_schema(cursor)
+            conn.commit()
+            # Online migrations take turns with anything else using the database
+            if pending_migrations(cursor):
+                version = run_migrations(progress=lambda progress: print(format_progress(progress)))
+                print(f"Schema migrated to version {version}.")
+            print_dedup_report(cursor)
+            print_storage_report(cursor)
+            print_query_plan_report(cursor)
+            conn.close()
         else:
             print(f"Database integrity issues found: {integrity_result}")
             print("Attempting repair...")
@@ -40,52 +98,83 @@ def repair_database():
             tables = cursor.fetchall()
             
             # Create new database structure
-            new_conn = sqlite3.connect("file_manager_repaired.db")
+            new_conn = get_connection("file_manager_repaired.db")
             new_cursor = new_conn.cursor()
             
-            # Recreate tables in new database
-            new_cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                                username TEXT UNIQUE,
-                                password TEXT
-                            )''')
-            new_cursor.execute('''CREATE TABLE IF NOT EXISTS files (
-                                id INTEGER PRIMARY KEY,
-                                user_id INTEGER,
-                                file_name TEXT,
-                                file_data BLOB,
-                                file_size INTEGER,
-                                file_type TEXT,
-                                action TEXT,
-                                timestamp TEXT,
-                                FOREIGN KEY(user_id) REFERENCES users(id)
-                            )''')
+            # Recreate tables in new database; migrations run once the data is in
+            create_tables(new_cursor)
             
             # Copy recoverable data
             try:
                 # Copy users
-                cursor.execute("SELECT id, username, password FROM users")
+                cursor.execute("SELECT id, username, password, kdf_salt FROM users")
                 users = cursor.fetchall()
                 for user in users:
                     try:
-                        new_cursor.execute("INSERT INTO users (id, username, password) VALUES (?, ?, ?)", user)
+                        new_cursor.execute("INSERT INTO users (id, username, password, kdf_salt) VALUES (?, ?, ?, ?)", user)
                     except sqlite3.Error as e:
                         print(f"Could not copy user {user[0]}: {e}")
                 
                 # Copy files
-                cursor.execute("SELECT id, user_id, file_name, file_data, file_size, file_type, action, timestamp FROM files")
+                cursor.execute('''SELECT id, user_id, file_name, file_data, file_size, file_type, action, timestamp,
+                                  content_hash, codec, compression_ratio FROM files''')
                 files = cursor.fetchall()
                 for file in files:
                     try:
                         new_cursor.execute('''INSERT INTO files 
-                                        (id, user_id, file_name, file_data, file_size, file_type, action, timestamp) 
-                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', file)
+                                        (id, user_id, file_name, file_data, file_size, file_type, action, timestamp,
+                                         content_hash, codec, compression_ratio) 
+                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', file)
                     except sqlite3.Error as e:
                         print(f"Could not copy file {file[0]}: {e}")
                 
+                # Copy chunk store (manifests first, then the chunks they reference)
+                try:
+                    cursor.execute("SELECT file_id, seq, chunk_hash FROM file_chunks")
+                    for entry in cursor.fetchall():
+                        try:
+                            new_cursor.execute("INSERT INTO file_chunks (file_id, seq, chunk_hash) VALUES (?, ?, ?)", entry)
+                        except sqlite3.Error as e:
+                            print(f"Could not copy manifest entry {entry[0]}/{entry[1]}: {e}")
+                    cursor.execute("SELECT hash FROM chunks")
+                    for (chunk_hash,) in cursor.fetchall():
+                        try:
+                            cursor.execute('''SELECT hash, data, size, refcount, codec, location, stored_size
+                                              FROM chunks WHERE hash = ?''', (chunk_hash,))
+                            new_cursor.execute('''INSERT INTO chunks (hash, data, size, refcount, codec, location, stored_size)
+                                                  VALUES (?, ?, ?, ?, ?, ?, ?)''', cursor.fetchone())
+                        except sqlite3.Error as e:
+                            print(f"Could not copy chunk {chunk_hash}: {e}")
+                    # Blobs released but not yet deleted; left out, they would never be
+                    cursor.execute("SELECT hash, location, released FROM blob_garbage")
+                    new_cursor.executemany("INSERT OR IGNORE INTO blob_garbage (hash, location, released) VALUES (?, ?, ?)",
+                                           cursor.fetchall())
+                except sqlite3.Error as e:
+                    print(f"Could not copy chunk store: {e}")
+                
+                # Copy wrapped data keys; without them encrypted files can't be opened
+                try:
+                    cursor.execute("SELECT key_id, file_id, user_id, wrapped_key, wrap_info FROM file_keys")
+                    for key_row in cursor.fetchall():
+                        try:
+                            new_cursor.execute('''INSERT INTO file_keys 
+                                            (key_id, file_id, user_id, wrapped_key, wrap_info) 
+                                            VALUES (?, ?, ?, ?, ?)''', key_row)
+                        except sqlite3.Error as e:
+                            print(f"Could not copy key for file {key_row[1]}: {e}")
+                except sqlite3.Error as e:
+                    print(f"Could not copy file keys: {e}")
+                
+                # Indexes added by migrations, and duplicate names renamed to fit them
+                migrate_schema(new_cursor)
                 new_conn.commit()
+                print_dedup_report(new_cursor)
+                print_query_plan_report(new_cursor)
+                new_cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
                 new_conn.close()
                 conn.close()
+                # Pooled connections would keep the files open across the rename
+                close_pools()
                 
                 # Replace old database with new one
                 os.rename("file_manager.db", "file_manager.db.old")
@@ -1,11 +1,13 @@
 import tkinter as tk
-from tkinter import simpledialog, messagebox
-import bcrypt
+from tkinter import simpledialog, messagebox, ttk
 import sqlite3
 import datetime
 import psutil
 from themes import get_current_theme_colors, style_dialog
 from PIL import Image, ImageTk
+from api.auth import AuthBusy, check_password, hash_new_password
+from api.database import get_connection, get_writer
+from jobs import RUNNING
 
 # Try to import matplotlib, but provide fallback if not available
 MATPLOTLIB_AVAILABLE = False
@@ -74,6 +76,21 @@ class StyledButton(tk.Button):
     def _on_leave(self, e):
         self.config(bg=self.normal_bg)
 
+def _when_done(widget, future, callback):
+    """Call `callback(future)` on the Tk thread once `future` has finished, unless `widget` is gone by then"""
+    if not widget.winfo_exists():
+        return
+    if future.done():
+        callback(future)
+    else:
+        widget.after(50, _when_done, widget, future, callback)
+
+def _insert_user(cursor, username, hashed_password):
+    cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))
+
+def _update_password_hash(cursor, user_id, hashed_password):
+    cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed_password, user_id))
+
 def login_dialog(parent, current_theme="dark"):
     """Enhanced login dialog with better styling"""
     dialog = tk.Toplevel(parent)
@@ -126,9 +143,12 @@ def login_dialog(parent, current_theme="dark"):
     
     # Result variable
     result = {"username": None, "password": None, "success": False}
+    checking = {"active": False}
     
     # Login function
     def do_login():
+        if checking["active"]:
+            return
         username = username_var.get()
         password = password_var.get()
         
@@ -136,21 +156,45 @@ def login_dialog(parent, current_theme="dark"):
             messagebox.showerror("Error", "Please enter both username and password")
             return
         
-        # Verify credentials
-        conn = sqlite3.connect("file_manager.db")
+        # Verify credentials (a pooled connection, configured like every other)
+        conn = get_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT id, username, password FROM users WHERE username = ?", (username,))
         user_data = cursor.fetchone()
         conn.close()
         
-        if user_data and bcrypt.checkpw(password.encode(), user_data[2]):
+        if not user_data:
+            messagebox.showerror("Login Failed", "Invalid username or password")
+            return
+        
+        # bcrypt runs on the auth pool so the window keeps repainting meanwhile
+        try:
+            future = check_password(username, password, user_data[2])
+        except AuthBusy:
+            messagebox.showerror("Login Failed", "Too many logins in progress, try again shortly")
+            return
+        checking["active"] = True
+        
+        def finished(future):
+            checking["active"] = False
+            try:
+                ok, new_hash = future.result()
+            except Exception as e:
+                messagebox.showerror("Login Failed", f"Could not check the password: {e}")
+                return
+            if not ok:
+                messagebox.showerror("Login Failed", "Invalid username or password")
+                return
+            if new_hash:
+                # Stored with an old cost factor; queued for the writer, the login doesn't wait for it
+                get_writer().submit(_update_password_hash, user_data[0], new_hash)
             result["username"] = username
             result["password"] = password  # Consider not storing this for security
             result["user_id"] = user_data[0]
             result["success"] = True
             dialog.destroy()
-        else:
-            messagebox.showerror("Login Failed", "Invalid username or password")
+        
+        _when_done(dialog, future, finished)
     
     # Buttons
     button_frame = tk.Frame(content_frame, bg=get_current_theme_colors(current_theme)["bg"])
@@ -244,9 +288,12 @@ def register_dialog(parent, current_theme="dark"):
     
     # Result variable
     result = {"username": None, "success": False}
+    hashing = {"active": False}
     
     # Registration function
     def do_register():
+        if hashing["active"]:
+            return
         username = username_var.get()
         password = password_var.get()
         confirm = confirm_var.get()
@@ -263,22 +310,37 @@ def register_dialog(parent, current_theme="dark"):
             messagebox.showerror("Error", "Password must be at least 6 characters")
             return
         
-        # Register user
+        # Hash on the auth pool, then register the user back on the Tk thread
         try:
-            hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-            conn = sqlite3.connect("file_manager.db")
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", 
-                         (username, hashed_password))
-            conn.commit()
-            conn.close()
-            
+            future = hash_new_password(password)
+        except AuthBusy:
+            messagebox.showerror("Error", "Too many logins in progress, try again shortly")
+            return
+        hashing["active"] = True
+        
+        def hashed(future):
+            try:
+                hashed_password = future.result()
+            except Exception as e:
+                hashing["active"] = False
+                messagebox.showerror("Error", f"Could not hash the password: {e}")
+                return
+            # The insert is queued for the writer; its result comes back here too
+            _when_done(dialog, get_writer().submit(_insert_user, username, hashed_password), inserted)
+        
+        def inserted(future):
+            hashing["active"] = False
+            try:
+                future.result()
+            except sqlite3.IntegrityError:
+                messagebox.showerror("Error", "Username already exists!")
+                return
             result["username"] = username
             result["success"] = True
             messagebox.showinfo("Success", "Account created successfully!")
             dialog.destroy()
-        except sqlite3.IntegrityError:
-            messagebox.showerror("Error", "Username already exists!")
+        
+        _when_done(dialog, future, hashed)
     
     # Buttons
     button_frame = tk.Frame(content_frame, bg=get_current_theme_colors(current_theme)["bg"])
@@ -661,8 +723,11 @@ def show_process_info_dialog(parent, current_theme="dark"):
     # Wait for dialog to close
     parent.wait_window(dialog)
 
-def analyze_storage_dialog(parent, files, current_theme="dark"):
-    """Enhanced storage analysis dialog with visualizations"""
+def analyze_storage_dialog(parent, files, current_theme="dark", dedup=None):
+    """Enhanced storage analysis dialog with visualizations
+
+    `dedup` is the report from api.chunk_store.dedup_stats, if available.
+    """
     dialog = tk.Toplevel(parent)
     
     content_frame = style_dialog(dialog, current_theme, "Storage Analysis", 650, 550)
@@ -737,6 +802,8 @@ def analyze_storage_dialog(parent, files, current_theme="dark"):
              get_current_theme_colors(current_theme)["accent3"] if total_fragmentation > 0.3 
              else get_current_theme_colors(current_theme)["accent2"])
         ]
+        if dedup:
+            stats.append(("Dedup Ratio", f"{dedup['ratio']:.2f}x", get_current_theme_colors(current_theme)["accent1"]))
         
         # Create stylish stat boxes
         for i, (label, value, color) in enumerate(stats):
@@ -749,9 +816,8 @@ def analyze_storage_dialog(parent, files, current_theme="dark"):
             tk.Label(stat_frame, text=value, font=("Arial", 16, "bold"), 
                    bg=color, fg="white").pack(anchor='w', pady=(5, 0))
             
-        summary_frame.grid_columnconfigure(0, weight=1)
-        summary_frame.grid_columnconfigure(1, weight=1)
-        summary_frame.grid_columnconfigure(2, weight=1)
+        for column in range(len(stats)):
+            summary_frame.grid_columnconfigure(column, weight=1)
         
         # Create a visualization area
         if files:
@@ -1068,8 +1134,11 @@ def analyze_storage_dialog(parent, files, current_theme="dark"):
     # Wait for dialog to close
     parent.wait_window(dialog)
 
-def show_file_metadata_dialog(parent, file_info, current_theme="dark"):
-    """Enhanced file metadata dialog with better styling"""
+def show_file_metadata_dialog(parent, file_info, current_theme="dark", compression=None):
+    """Enhanced file metadata dialog with better styling
+
+    `compression` is the file's (codec, compression ratio), if known.
+    """
     dialog = tk.Toplevel(parent)
     
     file_name, file_size, file_type, action, timestamp = file_info
@@ -1131,6 +1200,12 @@ def show_file_metadata_dialog(parent, file_info, current_theme="dark"):
         ("Last Action", action or "None"),
         ("Modified", timestamp or "Unknown"),
     ]
+    if compression:
+        codec, ratio = compression
+        if codec and ratio is not None:
+            metadata_items.append(("Compression", f"{codec}, stored at {ratio:.0%} of original size"))
+        else:
+            metadata_items.append(("Compression", codec or "None"))
     
     # Additional computed metadata
     if file_size > 0:
@@ -1182,3 +1257,102 @@ def show_file_metadata_dialog(parent, file_info, current_theme="dark"):
     
     # Wait for dialog to close
     parent.wait_window(dialog)
+
+def _format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def _format_duration(seconds):
+    if seconds is None:
+        return ""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def jobs_dialog(parent, manager, current_theme="dark"):
+    """Window listing background jobs with their progress, throughput and time left
+
+    `manager` is the jobs.JobManager the jobs run on. The window isn't
+    modal; while it is open its rows are updated as the manager reports
+    changes. Returns it.
+    """
+    dialog = tk.Toplevel(parent)
+    theme = get_current_theme_colors(current_theme)
+    
+    content_frame = style_dialog(dialog, current_theme, "Jobs", 700, 380)
+    
+    columns = ("kind", "name", "progress", "speed", "eta", "state")
+    headings = ("Job", "File", "Progress", "Speed", "Time Left", "Status")
+    widths = (80, 200, 150, 90, 80, 80)
+    tree = ttk.Treeview(content_frame, columns=columns, show="headings", height=10, selectmode="browse")
+    for column, heading, width in zip(columns, headings, widths):
+        tree.heading(column, text=heading)
+        tree.column(column, width=width, anchor="w")
+    tree.pack(fill=tk.BOTH, expand=True)
+    
+    def row_values(job):
+        if job.total:
+            progress = f"{job.fraction():.0%} of {_format_bytes(job.total)}"
+        else:
+            progress = _format_bytes(job.done)
+        if job.state == RUNNING:
+            speed = f"{_format_bytes(job.throughput())}/s"
+        elif job.finished and job.started and job.finished > job.started:
+            # Average over the whole job once it has ended
+            speed = f"{_format_bytes(job.done / (job.finished - job.started))}/s"
+        else:
+            speed = ""
+        state = job.state
+        if job.active and job.cancelled:
+            state = "Cancelling"
+        elif job.error is not None:
+            state = f"Failed: {job.error}"
+        return (job.kind, job.name, progress, speed, _format_duration(job.eta()), state)
+    
+    def show_job(job):
+        item = str(job.id)
+        if job not in manager.jobs:
+            return
+        if tree.exists(item):
+            tree.item(item, values=row_values(job))
+        else:
+            tree.insert("", tk.END, iid=item, values=row_values(job))
+    
+    def clear_finished():
+        manager.clear_finished()
+        kept = {str(job.id) for job in manager.jobs}
+        for item in tree.get_children():
+            if item not in kept:
+                tree.delete(item)
+    
+    def cancel_selected():
+        for item in tree.selection():
+            manager.cancel(int(item))
+    
+    def on_destroy(event):
+        if event.widget is dialog and show_job in manager.listeners:
+            manager.listeners.remove(show_job)
+    
+    button_frame = tk.Frame(content_frame, bg=theme["bg"], pady=10)
+    button_frame.pack(fill=tk.X)
+    
+    cancel_btn = StyledButton(button_frame, text="Cancel Job", command=cancel_selected,
+                            bg=theme["accent3"], theme=current_theme)
+    cancel_btn.pack(side=tk.LEFT)
+    
+    clear_btn = StyledButton(button_frame, text="Clear Finished", command=clear_finished,
+                           bg=theme["button_bg"], fg=theme["fg"], theme=current_theme)
+    clear_btn.pack(side=tk.LEFT, padx=10)
+    
+    close_btn = StyledButton(button_frame, text="Close", command=dialog.destroy,
+                           bg=theme["accent1"], theme=current_theme)
+    close_btn.pack(side=tk.RIGHT)
+    
+    for job in list(manager.jobs):
+        show_job(job)
+    manager.listeners.append(show_job)
+    dialog.bind("<Destroy>", on_destroy)
+    return dialog
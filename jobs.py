@@ -0,0 +1,316 @@
+# Background work for the desktop app.
+#
+# Everything the app does off the Tk thread goes through one
+# BackgroundExecutor: a fixed pool of daemon worker threads, so rapid
+# clicking queues work instead of starting a thread (and a database
+# connection) per click, and closing the window never waits for a
+# transfer. Work is submitted to one of two lanes. INTERACTIVE work (a
+# preview, a storage report) always goes ahead of queued BULK work
+# (transfers, encryption), and BULK work may only occupy all but one of
+# the workers, so a preview never waits behind a row of uploads. Work
+# submitted with a key, such as (user id, file name), never runs at the
+# same time as other work with that key, so two jobs never touch the same
+# file's rows at once; the later one waits its turn.
+#
+# Workers never touch widgets. Results and progress are handed to the Tk
+# thread through a single queue that it drains with root.after
+# (BackgroundExecutor.dispatch), where their callbacks run.
+#
+# Uploads, downloads, encryption and decryption run as Jobs. A job's
+# function gets the Job as its first argument and reports progress through
+# it. Cancelling a job makes its next report raise JobCancelled, unwinding
+# the job through its own cleanup (discarding a half-stored upload,
+# removing a partial download, rolling back).
+import os
+import time
+import queue
+import itertools
+import threading
+import collections
+import concurrent.futures
+
+WORKERS = int(os.environ.get("SFMS_DESKTOP_WORKERS", 3))
+INTERACTIVE, BULK = "interactive", "bulk"
+# Seconds between progress reports passed to the Tk thread for one job
+REPORT_INTERVAL = 0.1
+# Seconds of progress the throughput is averaged over
+RATE_WINDOW = 3.0
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "Queued", "Running", "Done", "Failed", "Cancelled"
+
+_Task = collections.namedtuple("_Task", "future fn args kwargs lane key")
+
+
+class BackgroundExecutor(concurrent.futures.Executor):
+    """Runs work on `workers` daemon threads in two priority lanes, serializing work with the same key"""
+
+    def __init__(self, workers=WORKERS):
+        workers = max(1, workers)
+        self._lanes = {INTERACTIVE: collections.deque(), BULK: collections.deque()}
+        self._running = {INTERACTIVE: 0, BULK: 0}
+        # One worker is kept free of bulk work when there is more than one
+        self._bulk_limit = max(1, workers - 1)
+        self._busy_keys = set()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        # Callbacks for the Tk thread, run by dispatch()
+        self._callbacks = queue.Queue()
+        self._threads = [threading.Thread(target=self._work, name=f"background-{number}", daemon=True)
+                         for number in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args, lane=BULK, key=None, **kwargs):
+        """Queue `fn(*args, **kwargs)` in a lane, after any queued or running work with the same key"""
+        if lane not in self._lanes:
+            raise ValueError(f"Unknown lane {lane}")
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit work after shutdown")
+            self._lanes[lane].append(_Task(future, fn, args, kwargs, lane, key))
+            self._condition.notify()
+        return future
+
+    def _take(self):
+        # The first task, interactive lane first, that may start now; called with the lock held
+        for lane in (INTERACTIVE, BULK):
+            if lane == BULK and self._running[BULK] >= self._bulk_limit:
+                continue
+            tasks = self._lanes[lane]
+            # Keys are taken in order, so a later task never overtakes one with the same key
+            waiting = set()
+            for index, task in enumerate(tasks):
+                if task.key is None or (task.key not in self._busy_keys and task.key not in waiting):
+                    del tasks[index]
+                    return task
+                waiting.add(task.key)
+        return None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                task = self._take()
+                while task is None:
+                    if self._shutdown:
+                        return
+                    self._condition.wait()
+                    task = self._take()
+                if task.key is not None:
+                    self._busy_keys.add(task.key)
+                self._running[task.lane] += 1
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        result = task.fn(*task.args, **task.kwargs)
+                    except BaseException as e:
+                        task.future.set_exception(e)
+                    else:
+                        task.future.set_result(result)
+            finally:
+                with self._condition:
+                    self._busy_keys.discard(task.key)
+                    self._running[task.lane] -= 1
+                    self._condition.notify_all()
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                for tasks in self._lanes.values():
+                    for task in tasks:
+                        task.future.cancel()
+                    tasks.clear()
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def call_soon(self, fn, *args):
+        """Have dispatch() call `fn(*args)` on the Tk thread; safe from any thread"""
+        self._callbacks.put((fn, args))
+
+    def when_done(self, future, on_done=None, on_error=None):
+        """Once `future` finishes, call on_done(result) or on_error(exception) on the Tk thread"""
+        def finished(future):
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                if on_done is not None:
+                    self.call_soon(on_done, future.result())
+            elif on_error is not None:
+                self.call_soon(on_error, error)
+        future.add_done_callback(finished)
+
+    def dispatch(self):
+        """Run the callbacks queued for the Tk thread (call it there, e.g. from root.after)"""
+        # Only those queued so far, so a stream of progress reports can't keep the Tk thread here
+        for _ in range(self._callbacks.qsize()):
+            fn, args = self._callbacks.get_nowait()
+            fn(*args)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled"""
+
+
+class Job:
+    """A transfer or crypto job: what it is, how far it has got, and how it ended"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, manager, kind, name, total=None, on_done=None, on_error=None, key=None):
+        self.id = next(self._ids)
+        self.kind = kind
+        self.name = name
+        self.key = key
+        self.total = total
+        self.done = 0
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        # Called on the Tk thread with the result, or with the exception
+        self.on_done = on_done
+        self.on_error = on_error
+        self._manager = manager
+        self._future = None
+        self._cancel = threading.Event()
+        self._samples = collections.deque()
+        self._reported = 0.0
+
+    def progress(self, done, total=None):
+        """Record `done` bytes processed (of `total`, if now known); raises JobCancelled once cancelled"""
+        if self._cancel.is_set():
+            raise JobCancelled()
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        self._samples.append((now, done))
+        while len(self._samples) > 2 and now - self._samples[0][0] > RATE_WINDOW:
+            self._samples.popleft()
+        if now - self._reported >= REPORT_INTERVAL:
+            self._reported = now
+            self._manager._changed(self)
+
+    def track(self, pieces, start=0):
+        """Pass an iterable of bytes through, reporting the bytes so far as each piece goes by"""
+        done = start
+        for piece in pieces:
+            done += len(piece)
+            self.progress(done)
+            yield piece
+
+    def cancel(self):
+        """Ask the job to stop at its next report (JobManager.cancel also ends a queued job at once)"""
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+    def throughput(self):
+        """Bytes per second over the last few seconds"""
+        if len(self._samples) < 2:
+            return 0.0
+        (first_time, first_done), (last_time, last_done) = self._samples[0], self._samples[-1]
+        if last_time <= first_time:
+            return 0.0
+        return (last_done - first_done) / (last_time - first_time)
+
+    def eta(self):
+        """Seconds left at the current throughput, or None if unknown"""
+        rate = self.throughput()
+        if self.state != RUNNING or not self.total or rate <= 0:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+    def fraction(self):
+        if self.state == DONE:
+            return 1.0
+        return min(1.0, self.done / self.total) if self.total else 0.0
+
+
+class JobManager:
+    """Runs jobs in the bulk lane of a BackgroundExecutor and keeps track of them for the jobs window"""
+
+    def __init__(self, executor):
+        self.jobs = []
+        # Called on the Tk thread with each job that changes
+        self.listeners = []
+        self._executor = executor
+        self._lock = threading.Lock()
+
+    def submit(self, kind, name, fn, *args, key=None, total=None, on_done=None, on_error=None):
+        """Queue `fn(job, *args)` as a job and return the Job; `key` serializes it as for BackgroundExecutor"""
+        job = Job(self, kind, name, total, on_done, on_error, key)
+        with self._lock:
+            self.jobs.append(job)
+            job._future = self._executor.submit(self._run, job, fn, args, lane=BULK, key=key)
+        self._changed(job)
+        return job
+
+    def _run(self, job, fn, args):
+        with self._lock:
+            # Cancelled while queued
+            if job.state != QUEUED:
+                return
+            job.state = RUNNING
+            job.started = time.monotonic()
+        self._changed(job)
+        try:
+            job.result = fn(job, *args)
+        except JobCancelled:
+            self._finish(job, CANCELLED)
+        except Exception as e:
+            job.error = e
+            self._finish(job, FAILED)
+        else:
+            self._finish(job, DONE)
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished = time.monotonic()
+        self._changed(job)
+        if state == DONE and job.on_done is not None:
+            self._executor.call_soon(job.on_done, job.result)
+        elif state == FAILED and job.on_error is not None:
+            self._executor.call_soon(job.on_error, job.error)
+
+    def _changed(self, job):
+        self._executor.call_soon(self._notify, job)
+
+    def _notify(self, job):
+        for listener in list(self.listeners):
+            listener(job)
+
+    def cancel(self, job_id):
+        """Cancel an active job by id; returns whether there was one
+
+        A queued job ends at once; a running one stops at its next report.
+        """
+        with self._lock:
+            for job in self.jobs:
+                if job.id == job_id and job.active:
+                    job.cancel()
+                    if job.state == QUEUED:
+                        job._future.cancel()
+                        self._finish(job, CANCELLED)
+                    return True
+        return False
+
+    def active(self):
+        with self._lock:
+            return [job for job in self.jobs if job.active]
+
+    def clear_finished(self):
+        """Forget jobs that have ended"""
+        with self._lock:
+            self.jobs = [job for job in self.jobs if job.active]
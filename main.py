@@ -1,18 +1,13 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, ttk
-from cryptography.fernet import Fernet
-import hashlib
-import base64
 import os
-import datetime
 import sqlite3
 import bcrypt
 import mimetypes
-import threading
+import mmap
 from PIL import Image, ImageTk
 import io
 import fitz
-import multiprocessing
 import psutil
 from tkinter import font as tkfont
 import math
@@ -21,7 +16,20 @@ import time
 import random  # For particle animations
 from themes import get_current_theme_colors, get_glass_colors  # Import theme functions
 from custom_dialogs import (login_dialog, register_dialog, show_process_info_dialog, 
-                          analyze_storage_dialog, show_file_metadata_dialog)
+                          analyze_storage_dialog, show_file_metadata_dialog, jobs_dialog, StyledEntry)
+from jobs import BackgroundExecutor, JobManager, JobCancelled, INTERACTIVE, BULK
+from api.chunk_store import (append_chunk, prepare_chunk, write_chunks, read_file_data, dedup_stats, copy_file_data,
+                             stored_size)
+from api.compression import choose_codec
+from api.database import get_connection, get_writer
+from api.blob_store import start_blob_sweeper
+from api.schema import init_schema, migrate_in_background
+from api.listing import list_files
+from api.search import extract_text, index_file, rename_indexed_file, search_files
+from api.envelope import rewrap_keys, store_rewrapped_keys
+from api.kdf import user_kdf_salt
+from api.files import add_file, finish_file, discard_file, log_action, delete_job
+from api.rewrite import encrypt_contents, decrypt_contents, encrypted_job, decrypted_job, commit_rewrite
 
 # Global variables
 dark_mode = False
@@ -76,34 +84,76 @@ class StyledButton(tk.Button):
 
 # Database initialization function
 def init_db():
-    conn = sqlite3.connect("file_manager.db")
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT UNIQUE,
-                        password TEXT
-                    )''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS files (
-                    id INTEGER PRIMARY KEY,
-                    user_id INTEGER,
-                    file_name TEXT,
-                    file_data BLOB,
-                    file_size INTEGER,
-                    file_type TEXT,
-                    action TEXT,
-                    timestamp TEXT,
-                    FOREIGN KEY(user_id) REFERENCES users(id)
-                )''')
+    init_schema(cursor)
     conn.commit()
     conn.close()
+    # Anything left (moving old inline data) runs in the background while the app is used
+    migrate_in_background()
+    # Blobs of deleted files' chunks are removed once they are surely unused
+    start_blob_sweeper(get_writer().run)
+
+# All background work runs on one executor; uploads, downloads, encryption
+# and decryption run on it as jobs with progress and cancel (see jobs.py)
+executor = BackgroundExecutor()
+jobs = JobManager(executor)
+jobs_window = None
+# Milliseconds between runs of the callbacks of finished background work
+DISPATCH_MS = 50
+
+def file_key(user_id, file_name):
+    """Key serializing background work on one file"""
+    return (user_id, file_name)
+
+def run_in_background(fn, *args, lane=INTERACTIVE, key=None, on_done=None, on_error=None):
+    """Run `fn(*args)` on the executor; on_done(result) or on_error(exception) then runs on the Tk thread"""
+    future = executor.submit(fn, *args, lane=lane, key=key)
+    executor.when_done(future, on_done, on_error)
+    return future
+
+def file_busy(user_id, file_name):
+    """Whether a queued or running job is using the user's file"""
+    return any(job.key == file_key(user_id, file_name) for job in jobs.active())
+
+def start_job(kind, name, fn, user_id, *args, **kwargs):
+    """Queue `fn(job, user_id, *args)` as a job on the user's file `name` and show it in the jobs window"""
+    job = jobs.submit(kind, name, fn, user_id, *args, key=file_key(user_id, name), **kwargs)
+    show_jobs()
+    return job
+
+def show_jobs():
+    global jobs_window
+    if jobs_window is not None and jobs_window.winfo_exists():
+        jobs_window.lift()
+        return
+    jobs_window = jobs_dialog(root, jobs, current_theme)
 
-def update_file_dropdown():
-    conn = sqlite3.connect("file_manager.db")
+def dispatch_results():
+    """Run the callbacks of finished background work and job progress, on the Tk thread"""
+    try:
+        executor.dispatch()
+    finally:
+        root.after(DISPATCH_MS, dispatch_results)
+
+# The dropdown holds a page of names at a time; picking the last entry loads the next page
+DROPDOWN_PAGE_SIZE = 500
+LOAD_MORE_ENTRY = "More files..."
+dropdown_next_after = None
+
+def update_file_dropdown(load_more=False):
+    global dropdown_next_after
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT file_name FROM files WHERE user_id = ?", (current_user_id,))
-    files = cursor.fetchall()
+    # Answered from the (user_id, file_name) index alone, already sorted
+    files, next_after = list_files(cursor, current_user_id, sort="name", limit=DROPDOWN_PAGE_SIZE,
+                                   after_id=dropdown_next_after if load_more else None, columns="id, file_name")
     conn.close()
-    file_dropdown['values'] = [file[0] for file in files]
+    names = [file[1] for file in files]
+    if load_more:
+        names = [name for name in file_dropdown['values'] if name != LOAD_MORE_ENTRY] + names
+    dropdown_next_after = next_after
+    file_dropdown['values'] = names + ([LOAD_MORE_ENTRY] if next_after is not None else [])
 
 def update_ui_theme():
     scheme = color_schemes[current_theme]
@@ -144,124 +194,227 @@ def login_user():
 def logout_user():
     global current_user_id, username_label
     current_user_id = None
+    # Nothing keeps running for a user who has gone
+    for job in jobs.active():
+        jobs.cancel(job.id)
     messagebox.showinfo("Logout", "Successfully logged out!")
     username_label.config(text="Not logged in")
     file_dropdown['values'] = []
-
-def generate_key(password):
-    return base64.urlsafe_b64encode(hashlib.sha256(password.encode()).digest())
+    search_entry.delete(0, tk.END)
+    search_status_label.config(text="")
 
 def encrypt_file():
     selected_file = file_dropdown.get()
     password = simpledialog.askstring("Encrypt", "Enter a password for encryption:", show='*')
     if selected_file and password:
-        # Start encryption in a separate thread to prevent UI freezing
-        threading.Thread(target=_encrypt_file_thread, args=(selected_file, password)).start()
-        # Show "Processing" message immediately
-        status_message = messagebox.showinfo("Processing", "Encryption started. You can continue working.")
-
-def _encrypt_file_thread(selected_file, password):
-    """Background thread for file encryption"""
+        # Runs as a job so the UI stays responsive; progress shows in the jobs window
+        start_job("Encrypt", selected_file, _encrypt_job, current_user_id, selected_file, password,
+                  on_error=lambda e: messagebox.showerror("Error", f"Encryption failed: {e}"))
+
+def _find_file_id(cursor, user_id, selected_file):
+    cursor.execute("SELECT id FROM files WHERE file_name = ? AND user_id = ?", (selected_file, user_id))
+    result = cursor.fetchone()
+    if result is None:
+        raise LookupError("File not found")
+    return result[0]
+
+def _encrypt_job(job, user_id, selected_file, password):
+    """Encrypt a stored file; if cancelled, the file stays as it was
+
+    The file is read and encrypted here, on a read connection; only its new
+    chunks and the final swap are written, by the writer (see api/rewrite.py).
+    """
+    writer = get_writer()
+    conn = get_connection()
     try:
-        conn = sqlite3.connect("file_manager.db")
         cursor = conn.cursor()
-        cursor.execute("SELECT file_data FROM files WHERE file_name = ? AND user_id = ?", (selected_file, current_user_id))
-        result = cursor.fetchone()
-        if result:
-            key = generate_key(password)
-            cipher = Fernet(key)
-            encrypted_data = cipher.encrypt(result[0])
-            cursor.execute("UPDATE files SET file_data = ?, action = 'Encrypted' WHERE file_name = ? AND user_id = ?", 
-                         (encrypted_data, selected_file, current_user_id))
-            conn.commit()
-            conn.close()
-            # Schedule a message on the main thread
-            root.after(0, lambda: messagebox.showinfo("Success", "File encrypted successfully!"))
-    except Exception as e:
-        # Handle any errors
-        root.after(0, lambda: messagebox.showerror("Error", f"Encryption failed: {str(e)}"))
+        file_id = _find_file_id(cursor, user_id, selected_file)
+        job.progress(0, stored_size(cursor, file_id))
+        rewrite = encrypt_contents(cursor, writer.submit, file_id, user_id, password, job.progress)
+    finally:
+        conn.close()
+    commit_rewrite(writer.submit, rewrite, encrypted_job)
 
 def decrypt_file():
     selected_file = file_dropdown.get()
     password = simpledialog.askstring("Decrypt", "Enter the decryption password:", show='*')
     if selected_file and password:
-        # Start decryption in a separate thread
-        threading.Thread(target=_decrypt_file_thread, args=(selected_file, password)).start()
-        # Show "Processing" message immediately
-        status_message = messagebox.showinfo("Processing", "Decryption started. You can continue working.")
+        # Runs as a job so the UI stays responsive; progress shows in the jobs window
+        start_job("Decrypt", selected_file, _decrypt_job, current_user_id, selected_file, password,
+                  on_error=lambda e: messagebox.showerror("Error", f"Decryption failed: {e}"))
+
+def _decrypt_job(job, user_id, selected_file, password):
+    """Decrypt a stored file; if cancelled, the file stays encrypted
+
+    As _encrypt_job, the decryption runs here and only the writes go to the
+    writer. The text for search is extracted afterwards, also off the writer.
+    """
+    writer = get_writer()
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        file_id = _find_file_id(cursor, user_id, selected_file)
+        job.progress(0, stored_size(cursor, file_id))
+        try:
+            rewrite = decrypt_contents(cursor, writer.submit, file_id, user_id, password, job.progress)
+        except JobCancelled:
+            raise
+        except Exception:
+            raise ValueError("Incorrect password!")
+        commit_rewrite(writer.submit, rewrite, decrypted_job)
+        writer.run(index_file, file_id, extract_text(cursor, file_id))
+    finally:
+        conn.close()
 
-def _decrypt_file_thread(selected_file, password):
-    """Background thread for file decryption"""
+def change_file_password():
+    selected_file = file_dropdown.get()
+    if not selected_file:
+        messagebox.showerror("Error", "No file selected")
+        return
+    old_password = simpledialog.askstring("Change Password", "Enter the current password:", show='*')
+    if not old_password:
+        return
+    new_password = simpledialog.askstring("Change Password", "Enter the new password:", show='*')
+    if not new_password:
+        return
+    if file_busy(current_user_id, selected_file):
+        messagebox.showerror("Error", "The file is in use by a job; wait for it to finish or cancel it")
+        return
+    
+    def changed(rotated):
+        if rotated is None:
+            messagebox.showerror("Error", "File not found!")
+        elif rotated:
+            messagebox.showinfo("Success", "File password changed successfully!")
+        else:
+            messagebox.showerror("Error", "Password change failed. Incorrect password or file not encrypted!")
+    
+    # The key derivations take a moment, so they run in the background
+    run_in_background(_change_password, current_user_id, selected_file, old_password, new_password,
+                      key=file_key(current_user_id, selected_file), on_done=changed,
+                      on_error=lambda e: messagebox.showerror("Error", f"Password change failed: {e}"))
+
+def _change_password(user_id, selected_file, old_password, new_password):
+    """Re-wrap a file's data key under a new password; returns how many keys changed, or None without the file
+
+    Only the wrapped key is re-encrypted, not the contents. It is worked out
+    on a read connection; only the updated row goes through the writer.
+    """
+    writer = get_writer()
+    conn = get_connection()
     try:
-        conn = sqlite3.connect("file_manager.db")
         cursor = conn.cursor()
-        cursor.execute("SELECT file_data FROM files WHERE file_name = ? AND user_id = ?", (selected_file, current_user_id))
-        result = cursor.fetchone()
-        if result:
-            try:
-                key = generate_key(password)
-                cipher = Fernet(key)
-                decrypted_data = cipher.decrypt(result[0])
-                cursor.execute("UPDATE files SET file_data = ?, action = 'Decrypted' WHERE file_name = ? AND user_id = ?", 
-                             (decrypted_data, selected_file, current_user_id))
-                conn.commit()
-                conn.close()
-                # Schedule a message on the main thread
-                root.after(0, lambda: messagebox.showinfo("Success", "File decrypted successfully!"))
-            except:
-                root.after(0, lambda: messagebox.showerror("Error", "Decryption failed. Incorrect password!"))
-    except Exception as e:
-        # Handle any errors
-        root.after(0, lambda: messagebox.showerror("Error", f"Decryption failed: {str(e)}"))
+        try:
+            file_id = _find_file_id(cursor, user_id, selected_file)
+        except LookupError:
+            return None
+        updates, _ = rewrap_keys(cursor, user_id, old_password, new_password, writer.run(user_kdf_salt, user_id),
+                                 file_id=file_id)
+    finally:
+        conn.close()
+    return writer.run(store_rewrapped_keys, updates)
 
 def delete_file():
     selected_file = file_dropdown.get()
     if selected_file:
-        conn = sqlite3.connect("file_manager.db")
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM files WHERE file_name = ? AND user_id = ?", (selected_file, current_user_id))
-        conn.commit()
-        conn.close()
-        messagebox.showinfo("Success", "File deleted successfully!")
-        update_file_dropdown()
+        if file_busy(current_user_id, selected_file):
+            messagebox.showerror("Error", "The file is in use by a job; wait for it to finish or cancel it")
+            return
+        
+        def deleted(_):
+            messagebox.showinfo("Success", "File deleted successfully!")
+            update_file_dropdown()
+        
+        # Releasing a large file's chunks is written in the background, after any work queued on the file
+        run_in_background(get_writer().run, delete_job, current_user_id, selected_file, lane=BULK,
+                          key=file_key(current_user_id, selected_file), on_done=deleted,
+                          on_error=lambda e: messagebox.showerror("Error", f"Delete failed: {e}"))
 
 def rename_file():
     selected_file = file_dropdown.get()
     new_name = simpledialog.askstring("Rename", "Enter new file name:")
     if selected_file and new_name:
-        conn = sqlite3.connect("file_manager.db")
-        cursor = conn.cursor()
-        cursor.execute("UPDATE files SET file_name = ? WHERE file_name = ? AND user_id = ?", (new_name, selected_file, current_user_id))
-        conn.commit()
-        conn.close()
-        messagebox.showinfo("Success", "File renamed successfully!")
-        update_file_dropdown()
+        if file_busy(current_user_id, selected_file) or file_busy(current_user_id, new_name):
+            messagebox.showerror("Error", "The file is in use by a job; wait for it to finish or cancel it")
+            return
+        
+        def renamed(_):
+            messagebox.showinfo("Success", "File renamed successfully!")
+            update_file_dropdown()
+        
+        def failed(e):
+            if isinstance(e, sqlite3.IntegrityError):
+                messagebox.showerror("Error", "A file with this name already exists!")
+            else:
+                messagebox.showerror("Error", f"Rename failed: {e}")
+        
+        run_in_background(get_writer().run, _rename_file, current_user_id, selected_file, new_name,
+                          key=file_key(current_user_id, selected_file), on_done=renamed, on_error=failed)
+
+def _rename_file(cursor, user_id, selected_file, new_name):
+    """Write job renaming one of a user's files; raises sqlite3.IntegrityError if the name is taken"""
+    cursor.execute("UPDATE files SET file_name = ? WHERE file_name = ? AND user_id = ?", (new_name, selected_file, user_id))
+    cursor.execute("SELECT id FROM files WHERE file_name = ? AND user_id = ?", (new_name, user_id))
+    for (file_id,) in cursor.fetchall():
+        rename_indexed_file(cursor, file_id)
 
 def preview_file():
     selected_file = file_dropdown.get()
     if selected_file:
-        # Start loading file data in background thread
-        threading.Thread(target=_load_preview_data, args=(selected_file,)).start()
-        
-def _load_preview_data(selected_file):
-    """Background thread for loading file data for preview"""
+        # Loaded in the interactive lane, ahead of queued transfers, once no job is changing the file
+        run_in_background(_load_preview, current_user_id, selected_file,
+                          key=file_key(current_user_id, selected_file),
+                          on_done=lambda preview: _show_preview_window(selected_file, *preview),
+                          on_error=lambda e: messagebox.showerror("Error", str(e)))
+
+# Largest size of an image preview, in pixels
+PREVIEW_MAX_WIDTH = 700
+PREVIEW_MAX_HEIGHT = 500
+
+def _load_preview(user_id, selected_file):
+    """Read and decode a file for preview (in the background); returns (file_type, content)
+
+    The content is text for text files and a resized PIL image for images.
+    Tk objects aren't thread-safe, so the PhotoImage is made from it on the
+    main thread by _show_preview_window.
+    """
+    conn = get_connection()
     try:
-        conn = sqlite3.connect("file_manager.db")
         cursor = conn.cursor()
-        cursor.execute("SELECT file_data, file_type FROM files WHERE file_name = ? AND user_id = ?", 
-                     (selected_file, current_user_id))
+        cursor.execute("SELECT id, file_type FROM files WHERE file_name = ? AND user_id = ?", 
+                     (selected_file, user_id))
         result = cursor.fetchone()
+        if result is None:
+            raise LookupError("File not found!")
+        file_data = read_file_data(cursor, result[0])
+    finally:
         conn.close()
-        
-        if result:
-            # Schedule UI updates on the main thread
-            root.after(0, lambda: _show_preview_window(selected_file, result[0], result[1]))
-        else:
-            root.after(0, lambda: messagebox.showerror("Error", "File not found!"))
-    except Exception as e:
-        root.after(0, lambda: messagebox.showerror("Error", f"Error loading file: {str(e)}"))
-
-def _show_preview_window(selected_file, file_data, file_type):
+    
+    file_type = result[1]
+    if file_type and file_type.startswith("text"):
+        try:
+            return file_type, file_data.decode("utf-8")
+        except UnicodeDecodeError:
+            raise ValueError("Cannot preview this file. It may be non-text data.")
+    elif file_type and file_type.startswith("image"):
+        try:
+            image = Image.open(io.BytesIO(file_data))
+            
+            # Calculate proportional resize to fit window
+            img_width, img_height = image.size
+            aspect_ratio = img_width / img_height
+            if img_width > PREVIEW_MAX_WIDTH:
+                img_width = PREVIEW_MAX_WIDTH
+                img_height = int(img_width / aspect_ratio)
+            if img_height > PREVIEW_MAX_HEIGHT:
+                img_height = PREVIEW_MAX_HEIGHT
+                img_width = int(img_height * aspect_ratio)
+            return file_type, image.resize((img_width, img_height), Image.LANCZOS)
+        except Exception as e:
+            raise ValueError(f"Cannot preview this image.\n{e}")
+    raise ValueError("File format not supported for preview.")
+
+def _show_preview_window(selected_file, file_type, content):
     """Create and show the preview window (runs on main thread)"""
     # Create a styled preview window
     preview_window = tk.Toplevel(root)
@@ -280,102 +433,44 @@ def _show_preview_window(selected_file, file_data, file_type):
                           padx=20, pady=20)
     preview_frame.pack(expand=True, fill=tk.BOTH)
     
-    # Create a loading indicator
-    loading_label = tk.Label(preview_frame, text="Loading preview...", 
-                           font=("Arial", 14, "italic"),
-                           bg=color_schemes[current_theme]["bg"],
-                           fg=color_schemes[current_theme]["accent1"])
-    loading_label.pack(expand=True)
+    if isinstance(content, str):
+        # Handle Text Files with syntax highlighting
+        preview_text = tk.Text(preview_frame, wrap=tk.WORD, 
+                             font=("Consolas", 12),
+                             bg=color_schemes[current_theme]["button_bg"],
+                             fg=color_schemes[current_theme]["fg"],
+                             padx=10, pady=10,
+                             insertbackground=color_schemes[current_theme]["fg"])
+        preview_text.insert(tk.END, content)
+        preview_text.config(state=tk.DISABLED)
+        # Add scrollbar
+        scrollbar = tk.Scrollbar(preview_frame, command=preview_text.yview)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        preview_text.config(yscrollcommand=scrollbar.set)
+        preview_text.pack(expand=True, fill=tk.BOTH)
+    else:
+        # Handle Image Files with enhanced display
+        photo = ImageTk.PhotoImage(content)
+        # Create image info label
+        info_label = tk.Label(preview_frame, 
+                            text=f"Image Size: {content.width}x{content.height} px",
+                            font=("Arial", 10),
+                            bg=color_schemes[current_theme]["bg"],
+                            fg=color_schemes[current_theme]["fg"])
+        info_label.pack(pady=(0, 10))
+        # Create a canvas with border
+        img_canvas = tk.Canvas(preview_frame, 
+                             width=content.width+10, 
+                             height=content.height+10,
+                             bg=color_schemes[current_theme]["button_bg"],
+                             bd=0,
+                             highlightthickness=1,
+                             highlightbackground=color_schemes[current_theme]["accent1"])
+        img_canvas.pack(expand=True)
+        img_canvas.create_image(5, 5, anchor=tk.NW, image=photo)
+        img_canvas.image = photo  # Keep a reference
     
-    # Process the preview in a separate thread
-    threading.Thread(target=_process_preview, 
-                   args=(preview_window, preview_frame, loading_label, file_data, file_type)).start()
-
-def _process_preview(preview_window, preview_frame, loading_label, file_data, file_type):
-    """Process and display file preview in background thread"""
-    try:
-        if file_type and file_type.startswith("text"):
-            # Handle Text Files with syntax highlighting
-            try:
-                file_content = file_data.decode("utf-8")
-                
-                # Schedule UI update on main thread
-                def update_text_preview():
-                    loading_label.destroy()
-                    preview_text = tk.Text(preview_frame, wrap=tk.WORD, 
-                                         font=("Consolas", 12),
-                                         bg=color_schemes[current_theme]["button_bg"],
-                                         fg=color_schemes[current_theme]["fg"],
-                                         padx=10, pady=10,
-                                         insertbackground=color_schemes[current_theme]["fg"])
-                    preview_text.insert(tk.END, file_content)
-                    preview_text.config(state=tk.DISABLED)
-                    # Add scrollbar
-                    scrollbar = tk.Scrollbar(preview_frame, command=preview_text.yview)
-                    scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-                    preview_text.config(yscrollcommand=scrollbar.set)
-                    preview_text.pack(expand=True, fill=tk.BOTH)
-                
-                root.after(0, update_text_preview)
-            except UnicodeDecodeError:
-                root.after(0, lambda: messagebox.showerror("Error", "Cannot preview this file. It may be non-text data."))
-                root.after(0, loading_label.destroy)
-        elif file_type and file_type.startswith("image"):
-            # Handle Image Files with enhanced display
-            try:
-                image = Image.open(io.BytesIO(file_data))
-                
-                # Calculate proportional resize to fit window
-                max_width = 700
-                max_height = 500
-                img_width, img_height = image.size
-                # Calculate aspect ratio
-                aspect_ratio = img_width / img_height
-                if img_width > max_width:
-                    img_width = max_width
-                    img_height = int(img_width / aspect_ratio)
-                if img_height > max_height:
-                    img_height = max_height
-                    img_width = int(img_height * aspect_ratio)
-                image = image.resize((img_width, img_height), Image.LANCZOS)  
-                photo = ImageTk.PhotoImage(image)
-                
-                # Schedule UI update on main thread
-                def update_image_preview():
-                    loading_label.destroy()
-                    # Create image info label
-                    info_label = tk.Label(preview_frame, 
-                                        text=f"Image Size: {image.width}x{image.height} px",
-                                        font=("Arial", 10),
-                                        bg=color_schemes[current_theme]["bg"],
-                                        fg=color_schemes[current_theme]["fg"])
-                    info_label.pack(pady=(0, 10))
-                    # Create a canvas with border
-                    img_canvas = tk.Canvas(preview_frame, 
-                                         width=img_width+10, 
-                                         height=img_height+10,
-                                         bg=color_schemes[current_theme]["button_bg"],
-                                         bd=0,
-                                         highlightthickness=1,
-                                         highlightbackground=color_schemes[current_theme]["accent1"])
-                    img_canvas.pack(expand=True)
-                    img_canvas.create_image(5, 5, anchor=tk.NW, image=photo)
-                    img_canvas.image = photo  # Keep a reference
-                
-                root.after(0, update_image_preview)
-            except Exception as e:
-                root.after(0, lambda: messagebox.showerror("Error", f"Cannot preview this image.\n{e}"))
-                root.after(0, loading_label.destroy)
-        # ... Similar changes for PDF handling ...
-        else:
-            root.after(0, lambda: messagebox.showerror("Error", "File format not supported for preview."))
-            root.after(0, loading_label.destroy)
-            
-        # Add close button on main thread
-        root.after(0, lambda: _add_preview_close_button(preview_window))
-    except Exception as e:
-        root.after(0, lambda: messagebox.showerror("Error", f"Preview failed: {str(e)}"))
-        root.after(0, loading_label.destroy)
+    _add_preview_close_button(preview_window)
 
 def _add_preview_close_button(preview_window):
     """Add close button to preview window"""
@@ -390,15 +485,15 @@ def _add_preview_close_button(preview_window):
 def show_file_metadata():
     selected_file = file_dropdown.get()
     if selected_file:
-        conn = sqlite3.connect("file_manager.db")
+        conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT file_size, file_type, action, timestamp FROM files WHERE file_name = ? AND user_id = ?", (selected_file, current_user_id))
+        cursor.execute("SELECT file_size, file_type, action, timestamp, codec, compression_ratio FROM files WHERE file_name = ? AND user_id = ?", (selected_file, current_user_id))
         result = cursor.fetchone()
         conn.close()
         if result:
             # Pass the file information to the styled metadata dialog
             file_info = (selected_file, result[0], result[1], result[2], result[3])
-            show_file_metadata_dialog(root, file_info, current_theme)
+            show_file_metadata_dialog(root, file_info, current_theme, compression=(result[4], result[5]))
 
 def toggle_dark_mode():
     global dark_mode, current_theme
@@ -411,32 +506,39 @@ def toggle_dark_mode():
 def show_process_info():
     show_process_info_dialog(root, current_theme)
     
-def upload_file():
-    file_path = filedialog.askopenfilename()
-    if file_path:
-        file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-        file_type = mimetypes.guess_type(file_path)[0] or "Unknown"
-        # Memory management for large files
-        if file_size > 10 * 1024 * 1024:  # 10MB
-            messagebox.showinfo("Large File", "Processing large file with memory mapping")
-            # Use memory mapping for large files
-            with open(file_path, 'rb') as f:
-                import mmap
-                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                    file_data = mm.read()
-        else:
-            # Regular file reading for smaller files
-            with open(file_path, 'rb') as file:
-                file_data = file.read()
-        conn = sqlite3.connect("file_manager.db")
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO files (user_id, file_name, file_data, file_size, file_type, action, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                       (current_user_id, file_name, file_data, file_size, file_type, "Uploaded", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        conn.commit()
-        conn.close()
-        messagebox.showinfo("Success", "File uploaded successfully!")
-        update_file_dropdown()
+# Files larger than this are memory-mapped for upload instead of read
+MMAP_THRESHOLD = 10 * 1024 * 1024  # 10MB
+
+def _stream_upload(user_id, file_path, file_name, file_type, progress=None):
+    """Store a file from disk one chunk at a time and return its id
+
+    Files over MMAP_THRESHOLD are memory-mapped and sliced into chunks
+    without being read into memory as a whole; smaller ones are read a
+    chunk at a time. Each chunk is hashed, compressed and stored on this
+    thread and then inserted by its own queued write, so memory use doesn't
+    grow with the file size and other writers aren't held up. `progress(bytes_done)` is called as
+    chunks are committed. Contents already stored by another file share
+    its chunks. Raises sqlite3.IntegrityError if the name is taken.
+    """
+    codec = choose_codec(file_type, file_name)
+    writer = get_writer()
+    file_id = writer.run(add_file, user_id, file_name, file_type, codec)
+    write_chunk = lambda seq, data: writer.submit(append_chunk, file_id, seq, prepare_chunk(data, codec, writer.run))
+    try:
+        with open(file_path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size > MMAP_THRESHOLD:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise'):
+                        # Read ahead, and let pages already hashed and written be dropped
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    file_size, content_hash = write_chunks(mm, write_chunk, progress)
+            else:
+                file_size, content_hash = write_chunks(file, write_chunk, progress)
+        writer.run(finish_file, file_id, content_hash, file_size)
+    except Exception:
+        writer.run(discard_file, file_id)
+        raise
+    return file_id
 
 def download_file():
     selected_file = file_dropdown.get()
@@ -455,57 +557,35 @@ def download_file():
     )
     
     if save_path:
-        # Create progress indicator
-        progress_window = tk.Toplevel(root)
-        progress_window.title("Downloading")
-        progress_window.geometry("300x100")
-        progress_window.configure(bg=color_schemes[current_theme]["bg"])
-        progress_window.resizable(False, False)
-        
-        # Add progress label
-        progress_label = tk.Label(progress_window, text="Downloading file...", 
-                                font=("Arial", 12),
-                                bg=color_schemes[current_theme]["bg"],
-                                fg=color_schemes[current_theme]["fg"])
-        progress_label.pack(pady=(20, 10))
-        
-        # Start download in background thread
-        thread = threading.Thread(target=_download_file_thread, 
-                                args=(selected_file, save_path, progress_window))
-        thread.daemon = True
-        thread.start()
-
-def _download_file_thread(selected_file, save_path, progress_window):
-    """Background thread for file download"""
+        start_job("Download", selected_file, _download_job, current_user_id, selected_file, save_path,
+                  on_error=lambda e: messagebox.showerror("Error", f"Failed to save file: {e}"))
+
+def _download_job(job, user_id, selected_file, save_path):
+    """Save a stored file to disk; a failed or cancelled download leaves no partial file behind"""
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        conn = sqlite3.connect("file_manager.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_data, file_type FROM files WHERE file_name = ? AND user_id = ?", 
-                     (selected_file, current_user_id))
+        cursor.execute("SELECT id FROM files WHERE file_name = ? AND user_id = ?", (selected_file, user_id))
         result = cursor.fetchone()
-        
-        if result:
-            file_data, file_type = result
-            
+        if result is None:
+            raise LookupError("File not found in database")
+        file_id = result[0]
+        job.progress(0, stored_size(cursor, file_id))
+        try:
+            # Blobs kept as files are copied by the kernel rather than read into Python
             with open(save_path, 'wb') as file:
-                file.write(file_data)
-            
-            # Log download operation
-            cursor.execute("UPDATE files SET action = 'Downloaded', timestamp = ? WHERE file_name = ? AND user_id = ?", 
-                         (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), selected_file, current_user_id))
-            conn.commit()
-            conn.close()
-            
-            # Schedule UI updates on main thread
-            root.after(0, lambda: [progress_window.destroy(), 
-                                  messagebox.showinfo("Success", f"File saved to {save_path}")])
-        else:
-            conn.close()
-            root.after(0, lambda: [progress_window.destroy(), 
-                                  messagebox.showerror("Error", "File not found in database")])
-    except Exception as e:
-        root.after(0, lambda: [progress_window.destroy(), 
-                              messagebox.showerror("Error", f"Failed to save file: {e}")])
+                copy_file_data(cursor, file_id, file, job.progress)
+        except BaseException:
+            try:
+                os.remove(save_path)
+            except OSError:
+                pass
+            raise
+    finally:
+        conn.close()
+    # Log download operation
+    get_writer().run(log_action, file_id, 'Downloaded')
+    return save_path
 
 def analyze_fragmentation():
     if not current_user_id:
@@ -518,24 +598,24 @@ def analyze_fragmentation():
                           fg=color_schemes[current_theme]["accent1"],
                           bg=color_schemes[current_theme]["bg"])
     status_label.pack(pady=5)
-    root.update()
     
-    # Start analysis in background thread
-    threading.Thread(target=_analyze_fragmentation_thread, args=(status_label,)).start()
-
-def _analyze_fragmentation_thread(status_label):
-    """Background thread for analyzing file fragmentation"""
+    # Repeated clicks wait for the report being made instead of running alongside it
+    run_in_background(_load_storage_report, current_user_id, key=("storage report", current_user_id),
+                      on_done=lambda report: [status_label.destroy(),
+                                              analyze_storage_dialog(root, report[0], current_theme, report[1])],
+                      on_error=lambda e: [status_label.destroy(),
+                                          messagebox.showerror("Error", f"Analysis failed: {str(e)}")])
+
+def _load_storage_report(user_id):
+    """Read a user's file sizes and dedup report for the storage analysis (in the background)"""
+    conn = get_connection()
     try:
-        conn = sqlite3.connect("file_manager.db")
         cursor = conn.cursor()
-        cursor.execute("SELECT file_name, file_size FROM files WHERE user_id = ? ORDER BY id", (current_user_id,))
+        cursor.execute("SELECT file_name, file_size FROM files WHERE user_id = ? ORDER BY id", (user_id,))
         files = cursor.fetchall()
+        return files, dedup_stats(cursor, user_id)
+    finally:
         conn.close()
-        
-        # Schedule UI update on main thread
-        root.after(0, lambda: [status_label.destroy(), analyze_storage_dialog(root, files, current_theme)])
-    except Exception as e:
-        root.after(0, lambda: [status_label.destroy(), messagebox.showerror("Error", f"Analysis failed: {str(e)}")])
 
 def lock_file():
     selected_file = file_dropdown.get()
@@ -588,60 +668,65 @@ def update_lock_status():
 def threaded_upload():
     file_path = filedialog.askopenfilename()
     if file_path:
-        # Create a progress indicator
-        progress_window = tk.Toplevel(root)
-        progress_window.title("Uploading")
-        progress_window.geometry("300x100")
-        progress_window.configure(bg=color_schemes[current_theme]["bg"])
-        progress_window.resizable(False, False)
-        
-        # Add progress label
-        progress_label = tk.Label(progress_window, text="Uploading file...", 
-                                font=("Arial", 12),
-                                bg=color_schemes[current_theme]["bg"],
-                                fg=color_schemes[current_theme]["fg"])
-        progress_label.pack(pady=(20, 10))
-        
-        # Start upload in background thread
-        thread = threading.Thread(target=_upload_file_thread, args=(file_path, progress_window))
-        thread.daemon = True
-        thread.start()
-
-def _upload_file_thread(file_path, progress_window):
-    """Background thread for file upload"""
+        start_job("Upload", os.path.basename(file_path), _upload_job, current_user_id, file_path,
+                  total=os.path.getsize(file_path),
+                  on_done=lambda file_id: update_file_dropdown(), on_error=_upload_failed)
+
+def _upload_job(job, user_id, file_path):
+    """Upload a file from disk; a failed or cancelled upload's row and chunks are removed again
+
+    The text for search is extracted once the upload has committed, on a
+    read connection, so only the index update goes to the writer.
+    """
+    file_name = os.path.basename(file_path)
+    file_type = mimetypes.guess_type(file_path)[0] or "Unknown"
+    file_id = _stream_upload(user_id, file_path, file_name, file_type, job.progress)
+    conn = get_connection()
     try:
-        file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-        file_type = mimetypes.guess_type(file_path)[0] or "Unknown"
-        
-        # Memory management for large files
-        if file_size > 10 * 1024 * 1024:  # 10MB
-            # Use memory mapping for large files
-            with open(file_path, 'rb') as f:
-                import mmap
-                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                    file_data = mm.read()
-        else:
-            # Regular file reading for smaller files
-            with open(file_path, 'rb') as file:
-                file_data = file.read()
-                
-        conn = sqlite3.connect("file_manager.db")
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO files (user_id, file_name, file_data, file_size, file_type, action, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                     (current_user_id, file_name, file_data, file_size, file_type, "Uploaded", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        conn.commit()
+        text = extract_text(conn.cursor(), file_id)
+    finally:
         conn.close()
-        
-        # Schedule UI updates on main thread
-        root.after(0, lambda: [progress_window.destroy(), 
-                              messagebox.showinfo("Success", "File uploaded successfully!"),
-                              update_file_dropdown()])
-    except Exception as e:
-        root.after(0, lambda: [progress_window.destroy(), 
-                              messagebox.showerror("Error", f"Upload failed: {str(e)}")])
+    get_writer().run(index_file, file_id, text)
+    return file_id
+
+def _upload_failed(error):
+    if isinstance(error, sqlite3.IntegrityError):
+        messagebox.showerror("Error", "A file with this name already exists!")
+    else:
+        messagebox.showerror("Error", f"Upload failed: {error}")
+
+# Delay after the last keystroke before the search runs
+SEARCH_DELAY_MS = 250
+
+def schedule_search(event=None):
+    if hasattr(search_entry, 'search_after_id'):
+        search_entry.after_cancel(search_entry.search_after_id)
+    search_entry.search_after_id = search_entry.after(SEARCH_DELAY_MS, run_search)
+
+def run_search(event=None):
+    """Fill the file dropdown with the files matching the search box, best match first"""
+    if current_user_id is None:
+        return
+    query = search_entry.get().strip()
+    if not query:
+        search_status_label.config(text="")
+        update_file_dropdown()
+        return
+    conn = get_connection()
+    results = search_files(conn.cursor(), current_user_id, query)
+    conn.close()
+    file_dropdown['values'] = [result[1] for result in results]
+    search_status_label.config(text=f"{len(results)} match{'es' if len(results) != 1 else ''}")
+    # Enter picks the best match
+    if event is not None and results:
+        file_dropdown.set(results[0][1])
+        update_lock_status()
 
 def on_dropdown_select(event=None):
+    if file_dropdown.get() == LOAD_MORE_ENTRY:
+        file_dropdown.set("")
+        update_file_dropdown(load_more=True)
+        return
     update_lock_status()
 
 def create_tooltip(widget, text):
@@ -1023,6 +1108,23 @@ file_dropdown = ttk.Combobox(file_selection_frame, state="readonly", width=40, f
 file_dropdown.pack(side=tk.LEFT, fill=tk.X, expand=True)
 file_dropdown.bind("<<ComboboxSelected>>", on_dropdown_select)
 
+# Search box: matches file names, types and the text inside unencrypted files
+search_frame = tk.Frame(root, bg=color_schemes[current_theme]["bg"])
+search_frame.pack(fill=tk.X, padx=20)
+search_label = tk.Label(search_frame, text="Search:", 
+                      font=("Arial", 12, "bold"), 
+                      fg=color_schemes[current_theme]["fg"], 
+                      bg=color_schemes[current_theme]["bg"])
+search_label.pack(side=tk.LEFT, padx=(0, 10))
+search_entry = StyledEntry(search_frame, theme=current_theme, width=40)
+search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+search_entry.bind("<KeyRelease>", schedule_search)
+search_entry.bind("<Return>", run_search)
+search_status_label = tk.Label(search_frame, text="", font=("Arial", 10), 
+                             fg=color_schemes[current_theme]["fg"], 
+                             bg=color_schemes[current_theme]["bg"])
+search_status_label.pack(side=tk.LEFT, padx=(10, 0))
+
 # Main action buttons frame with a more organized layout
 main_actions_frame = tk.Frame(root, bg=color_schemes[current_theme]["bg"])
 main_actions_frame.pack(pady=15, fill=tk.X, padx=20)
@@ -1116,6 +1218,20 @@ fragmentation_button = StyledButton(auth_frame2, text="Analyze Storage", command
                                   hover_bg=color_schemes[current_theme]["hover_bg"])
 fragmentation_button.grid(row=0, column=2, padx=10)
 
+change_password_button = StyledButton(auth_frame2, text="Change Password", command=change_file_password,
+                                    font=("Arial", 12), 
+                                    bg=color_schemes[current_theme]["button_bg"], 
+                                    fg=color_schemes[current_theme]["button_fg"],
+                                    hover_bg=color_schemes[current_theme]["hover_bg"])
+change_password_button.grid(row=0, column=3, padx=10)
+
+jobs_button = StyledButton(auth_frame2, text="Jobs", command=show_jobs,
+                         font=("Arial", 12), 
+                         bg=color_schemes[current_theme]["button_bg"], 
+                         fg=color_schemes[current_theme]["button_fg"],
+                         hover_bg=color_schemes[current_theme]["hover_bg"])
+jobs_button.grid(row=0, column=4, padx=10)
+
 # File locking frame
 lock_frame = tk.Frame(root, bg=color_schemes[current_theme]["bg"])
 lock_frame.pack(pady=15)
@@ -1153,6 +1269,8 @@ create_tooltip(decrypt_button, "Decrypt the selected file with your password")
 create_tooltip(delete_button, "Delete the selected file permanently")
 create_tooltip(rename_button, "Rename the selected file")
 create_tooltip(metadata_button, "View metadata for the selected file")
+create_tooltip(change_password_button, "Change the encryption password of the selected file")
+create_tooltip(jobs_button, "Show uploads, downloads and encryption in progress, and cancel them")
 create_tooltip(lock_button, "Lock the file to prevent modifications")
 create_tooltip(unlock_button, "Unlock the file for editing")
 
@@ -1169,6 +1287,9 @@ draw_gradient_background()
 # Add call to show the welcome animation
 root.after(500, show_welcome_animation)
 
+# Start handing results of background work to the UI
+root.after(DISPATCH_MS, dispatch_results)
+
 # Register event for window resize to redraw background
 def on_resize(event):
     # Only redraw if window is fully visible
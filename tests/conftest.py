@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """A freshly migrated database in a temporary directory, which is also the working directory"""
+    from api.database import get_connection
+    from api.schema import init_schema, run_migrations
+
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "file_manager.db")
+    conn = get_connection(path)
+    init_schema(conn.cursor())
+    conn.commit()
+    conn.close()
+    run_migrations(path)
+    return path
@@ -0,0 +1,121 @@
+"""
+A minimal S3 stand-in, for trying the s3 storage backend without a bucket.
+
+Serves path-style PUT, GET (with Range) and DELETE of objects, kept in
+memory, over keep-alive HTTP/1.1, and rejects any request whose AWS
+Signature Version 4 doesn't check out against the credentials it was
+started with:
+
+    with S3StandIn() as s3:
+        blobs = S3Blobs(s3.endpoint, "bucket", access_key=s3.access_key, secret_key=s3.secret_key)
+"""
+import os
+import sys
+import hashlib
+import datetime
+import threading
+import urllib.parse
+import http.server
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from api.blob_store import sign_request  # noqa: E402
+
+
+class S3StandIn:
+    """An in-memory S3 endpoint on a free local port, served from a daemon thread"""
+
+    def __init__(self, access_key="standin", secret_key="standin-secret", region="us-east-1"):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.objects = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+        self._server.daemon_threads = True
+        self.endpoint = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="s3-standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def check_signature(self, method, path, headers, body):
+        """Whether a request (its headers named in lower case) is signed with this stand-in's credentials"""
+        authorization = headers.get('authorization', '')
+        amz_date = headers.get('x-amz-date', '')
+        if not authorization.startswith(f"AWS4-HMAC-SHA256 Credential={self.access_key}/") or not amz_date:
+            return False
+        if headers.get('x-amz-content-sha256') != hashlib.sha256(body).hexdigest():
+            return False
+        signed = authorization.split("SignedHeaders=")[1].split(",")[0].split(";")
+        # sign_request adds these three itself
+        extra = {name: headers[name] for name in signed if name not in ('host', 'x-amz-content-sha256', 'x-amz-date')
+                 and name in headers}
+        now = datetime.datetime.strptime(amz_date, "%Y%m%dT%H%M%SZ").replace(tzinfo=datetime.timezone.utc)
+        expected = sign_request(method, headers.get('host', ''), urllib.parse.unquote(path), {}, extra, body,
+                                self.region, self.access_key, self.secret_key, now)
+        return expected['Authorization'] == authorization
+
+
+def _handler(s3):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status, body=b"", headers=()):
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, method):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            with s3._lock:
+                s3.requests += 1
+            headers = {name.lower(): value for name, value in self.headers.items()}
+            if not s3.check_signature(method, self.path, headers, body):
+                return self._reply(403, b"<Error><Code>SignatureDoesNotMatch</Code></Error>")
+            with s3._lock:
+                if method == 'PUT':
+                    s3.objects[self.path] = body
+                    return self._reply(200)
+                if method == 'DELETE':
+                    s3.objects.pop(self.path, None)
+                    return self._reply(204)
+                data = s3.objects.get(self.path)
+            if data is None:
+                return self._reply(404, b"<Error><Code>NoSuchKey</Code></Error>")
+            requested = self.headers.get('Range')
+            if not requested:
+                return self._reply(200, data)
+            first, _, last = requested.split("=", 1)[1].partition("-")
+            stop = len(data) if not last else min(int(last) + 1, len(data))
+            return self._reply(206, data[int(first):stop],
+                               [('Content-Range', f"bytes {first}-{stop - 1}/{len(data)}")])
+
+        def do_PUT(self):
+            self._handle('PUT')
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+    return Handler
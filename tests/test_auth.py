@@ -0,0 +1,72 @@
+import time
+import threading
+import pytest
+from api import auth
+from api.auth import AuthBusy, AuthPool, check_password, hash_new_password, hash_password, hash_rounds
+
+
+@pytest.fixture(autouse=True)
+def cheap_hashes(monkeypatch):
+    """Use the cheapest bcrypt cost, and a fresh verify cache, so the tests run quickly and alone"""
+    monkeypatch.setattr(auth, "BCRYPT_ROUNDS", 4)
+    monkeypatch.setattr(auth, "verify_cache", auth.VerifyCache())
+
+
+@pytest.fixture
+def full_pool():
+    """A pool of one worker with both of its places taken until the test ends"""
+    pool = AuthPool(workers=1, max_pending=2)
+    release = threading.Event()
+    blocked = [pool.submit(release.wait) for _ in range(2)]
+    yield pool
+    release.set()
+    for future in blocked:
+        future.result(timeout=5)
+
+
+def test_full_pool_refuses_work_with_auth_busy(full_pool):
+    hashed = hash_password("secret")
+    with pytest.raises(AuthBusy):
+        check_password("alice", "secret", hashed, pool=full_pool)
+    with pytest.raises(AuthBusy):
+        hash_new_password("secret", pool=full_pool)
+    stats = full_pool.stats()
+    assert stats["pending"] == 2 and stats["rejected"] == 2
+
+
+def test_pool_takes_work_again_once_it_drains():
+    pool = AuthPool(workers=1, max_pending=1)
+    release = threading.Event()
+    blocked = pool.submit(release.wait)
+    with pytest.raises(AuthBusy):
+        pool.submit(lambda: None)
+    release.set()
+    blocked.result(timeout=5)
+    # The place is given back by a done-callback, which may run just after result() returns
+    while pool.stats()["pending"]:
+        time.sleep(0.01)
+    hashed = hash_new_password("secret", pool=pool).result(timeout=5)
+    assert check_password("alice", "secret", hashed, pool=pool).result(timeout=5) == (True, None)
+    assert pool.stats()["rejected"] == 1
+
+
+def test_verified_passwords_skip_the_pool_but_wrong_ones_never_do(full_pool):
+    pool = AuthPool(workers=1)
+    hashed = hash_password("secret")
+    assert check_password("alice", "wrong", hashed, pool=pool).result(timeout=5) == (False, None)
+    assert check_password("alice", "secret", hashed, pool=pool).result(timeout=5) == (True, None)
+    # Remembered, so it is answered even while the pool is full
+    assert check_password("alice", "secret", hashed, pool=full_pool).result() == (True, None)
+    with pytest.raises(AuthBusy):
+        check_password("alice", "wrong", hashed, pool=full_pool)
+    # A new hash (a changed password) isn't covered by what was remembered
+    with pytest.raises(AuthBusy):
+        check_password("alice", "secret", hash_password("secret"), pool=full_pool)
+
+
+def test_hashes_of_another_cost_are_replaced():
+    pool = AuthPool(workers=1)
+    old = hash_password("secret", rounds=5)
+    ok, new_hash = check_password("alice", "secret", old.decode(), pool=pool).result(timeout=5)
+    assert ok and hash_rounds(new_hash) == 4
+    assert check_password("alice", "secret", new_hash, pool=pool).result(timeout=5) == (True, None)
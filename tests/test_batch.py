@@ -0,0 +1,39 @@
+import pytest
+from api.batch import run_batch
+from api.database import get_writer
+
+
+def _insert(cursor, value):
+    if value < 0:
+        raise ValueError("negative")
+    cursor.execute("INSERT INTO users (username, password) VALUES (?, 'x')", (f"user{value}",))
+    return value
+
+
+def _prepare(item):
+    if item == 13:
+        raise LookupError("unlucky")
+    return item
+
+
+@pytest.fixture
+def writer(db_path):
+    return get_writer(db_path)
+
+
+def test_results_in_order_with_failures_alone(writer):
+    discarded = []
+    items = [1, 2, -3, 4, 13, 6, 7]
+    results = list(run_batch(writer.submit, _insert, items, _prepare,
+                             lambda cursor, value: discarded.append(value), group_size=2, window=2))
+    assert [item for item, _, _ in results] == items
+    assert [ok for _, ok, _ in results] == [True, True, False, True, False, True, True]
+    assert results[2][2] == "negative" and results[4][2] == "unlucky"
+    # Only the item whose write failed is discarded; one that failed to prepare had nothing to undo
+    assert discarded == [-3]
+    rows = writer.run(lambda cursor: cursor.execute("SELECT username FROM users ORDER BY id").fetchall())
+    assert [row[0] for row in rows] == ["user1", "user2", "user4", "user6", "user7"]
+
+
+def test_without_prepare_items_go_to_the_job(writer):
+    assert list(run_batch(writer.submit, _insert, [5, -1])) == [(5, True, 5), (-1, False, "negative")]
@@ -0,0 +1,38 @@
+import os
+import pytest
+from api.compression import CODECS, compress_stream, decompress_stream
+
+# Compressible, with a stretch that makes for RLE and raw blocks in zstd
+DATA = b"".join(b"line %d of some text\n" % number for number in range(50000)) + bytes(300000) + os.urandom(70000)
+
+
+def _compressed(codec, data=DATA):
+    return b"".join(compress_stream([data[i:i + 65536] for i in range(0, len(data), 65536)], codec))
+
+
+def _pieces(data, size=10000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_stream_round_trip(codec):
+    assert b"".join(decompress_stream(_pieces(_compressed(codec)), codec)) == DATA
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+@pytest.mark.parametrize("cut", [1, 100, 0.5])
+def test_truncated_stream_is_detected(codec, cut):
+    packed = _compressed(codec)
+    packed = packed[:-cut] if isinstance(cut, int) else packed[:int(len(packed) * cut)]
+    with pytest.raises(ValueError, match="truncated"):
+        b"".join(decompress_stream(_pieces(packed), codec))
+
+
+def test_zstd_frames_with_checksum_and_content_size():
+    zstandard = pytest.importorskip("zstandard")
+    packed = zstandard.ZstdCompressor(level=1, write_checksum=True).compress(DATA)
+    assert b"".join(decompress_stream(_pieces(packed), "zstd")) == DATA
+    # Two frames back to back are one stream
+    assert b"".join(decompress_stream(_pieces(packed + packed), "zstd")) == DATA + DATA
+    with pytest.raises(ValueError, match="truncated"):
+        b"".join(decompress_stream(_pieces(packed + packed[:-2]), "zstd"))
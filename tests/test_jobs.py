@@ -0,0 +1,159 @@
+import time
+import threading
+import pytest
+from jobs import BackgroundExecutor, JobManager, INTERACTIVE, BULK, DONE, CANCELLED, FAILED
+
+
+@pytest.fixture
+def executor():
+    executor = BackgroundExecutor(workers=3)
+    yield executor
+    executor.shutdown(cancel_futures=True)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def test_interactive_work_goes_ahead_of_queued_bulk_work():
+    executor = BackgroundExecutor(workers=1)
+    release = threading.Event()
+    order = []
+    executor.submit(release.wait, lane=BULK)
+    bulk = [executor.submit(order.append, f"bulk{number}", lane=BULK) for number in range(3)]
+    interactive = executor.submit(order.append, "interactive", lane=INTERACTIVE)
+    release.set()
+    for future in bulk + [interactive]:
+        future.result(timeout=5)
+    assert order == ["interactive", "bulk0", "bulk1", "bulk2"]
+    executor.shutdown()
+
+
+def test_bulk_work_leaves_a_worker_for_interactive_work(executor):
+    release = threading.Event()
+    blocked = [executor.submit(release.wait, lane=BULK) for _ in range(3)]
+    # Two workers are busy with bulk work and the third bulk task waits, so this runs at once
+    assert executor.submit(lambda: "preview", lane=INTERACTIVE).result(timeout=5) == "preview"
+    assert not blocked[2].running()
+    release.set()
+    for future in blocked:
+        future.result(timeout=5)
+
+
+def test_work_with_the_same_key_never_overlaps_and_keeps_its_order(executor):
+    lock = threading.Lock()
+    running = []
+    overlaps = []
+    order = []
+
+    def work(name):
+        with lock:
+            running.append(name)
+            if len(running) > 1:
+                overlaps.append(list(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(name)
+            order.append(name)
+
+    futures = [executor.submit(work, number, key=(1, "a.txt")) for number in range(5)]
+    # Interactive work may overtake bulk work with its key, but never runs alongside it
+    futures += [executor.submit(work, number, key=(1, "a.txt"), lane=INTERACTIVE) for number in range(5, 8)]
+    for future in futures:
+        future.result(timeout=5)
+    assert overlaps == []
+    assert [name for name in order if name < 5] == [0, 1, 2, 3, 4]
+    assert [name for name in order if name >= 5] == [5, 6, 7]
+
+
+def test_other_keys_still_run_alongside(executor):
+    release = threading.Event()
+    held = executor.submit(release.wait, key=(1, "a.txt"))
+    assert executor.submit(lambda: "other", key=(1, "b.txt")).result(timeout=5) == "other"
+    release.set()
+    held.result(timeout=5)
+
+
+def test_dispatch_runs_only_callbacks_queued_before_it(executor):
+    calls = []
+
+    def callback(number):
+        calls.append(number)
+        executor.call_soon(callback, number + 1)
+
+    executor.call_soon(callback, 0)
+    executor.dispatch()
+    assert calls == [0]
+    executor.dispatch()
+    assert calls == [0, 1]
+
+
+def test_cancel_stops_a_job_at_its_next_progress_report(executor):
+    manager = JobManager(executor)
+    started = threading.Event()
+    reports = []
+    errors = []
+
+    def work(job):
+        job.progress(0, 100)
+        started.set()
+        for done in range(1, 10000):
+            time.sleep(0.001)
+            job.progress(done)
+            reports.append(done)
+        return "finished"
+
+    job = manager.submit("Upload", "a.bin", work, on_error=errors.append)
+    assert started.wait(5)
+    assert manager.cancel(job.id)
+    _wait_for(lambda: not job.active)
+    assert job.state == CANCELLED and job.result is None
+    # It stopped at the first report after the cancel, not at the end of its work
+    assert len(reports) < 9999
+    executor.dispatch()
+    assert errors == []
+    assert not manager.cancel(job.id)
+
+
+def test_cancelling_a_queued_job_ends_it_at_once(executor):
+    manager = JobManager(executor)
+    release = threading.Event()
+    ran = []
+    first = manager.submit("Encrypt", "a.txt", lambda job: release.wait(), key=(1, "a.txt"))
+    queued = manager.submit("Decrypt", "a.txt", lambda job: ran.append(job), key=(1, "a.txt"))
+    manager.cancel(queued.id)
+    assert queued.state == CANCELLED
+    release.set()
+    _wait_for(lambda: first.state == DONE)
+    assert ran == []
+    manager.clear_finished()
+    assert manager.jobs == []
+
+
+def test_progress_throughput_and_eta(executor):
+    manager = JobManager(executor)
+    done = []
+    errors = []
+    measured = {}
+
+    def work(job):
+        for _ in job.track([b"x" * 1000] * 5):
+            time.sleep(0.02)
+        measured.update(rate=job.throughput(), eta=job.eta(), fraction=job.fraction())
+        return job.done
+
+    job = manager.submit("Download", "a.bin", work, total=10000, on_done=done.append)
+    failing = manager.submit("Download", "b.bin", lambda job: 1 / 0, on_error=errors.append)
+    _wait_for(lambda: not job.active and not failing.active)
+    assert job.state == DONE and failing.state == FAILED
+    assert measured["fraction"] == 0.5 and measured["rate"] > 0
+    # Half of it left at the measured rate
+    assert measured["eta"] == pytest.approx(5000 / measured["rate"])
+    assert job.fraction() == 1.0 and job.eta() is None
+    executor.dispatch()
+    assert done == [5000]
+    assert isinstance(errors[0], ZeroDivisionError)
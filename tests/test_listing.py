@@ -0,0 +1,77 @@
+import pytest
+from api.database import get_connection, get_writer
+from api.listing import list_files, count_files
+
+
+def _add_files(cursor, files):
+    cursor.execute("INSERT INTO users (id, username, password) VALUES (1, 'alice', 'x'), (2, 'bob', 'x')")
+    for user_id, name, size, file_type, timestamp in files:
+        cursor.execute("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                       "VALUES (?, ?, ?, ?, 'Uploaded', ?)", (user_id, name, size, file_type, timestamp))
+
+
+@pytest.fixture
+def cursor(db_path):
+    # Several files share a size and a timestamp, so only the id tells them apart
+    get_writer(db_path).run(_add_files, [
+        (1, "a.txt", 100, "text/plain", "2024-01-01 00:00:00"),
+        (1, "b.png", 500, "image/png", "2024-01-02 00:00:00"),
+        (1, "c.txt", 100, "text/plain", "2024-01-02 00:00:00"),
+        (1, "d.jpg", 100, "image/jpeg", "2024-01-02 00:00:00"),
+        (1, "e.txt", 500, "text/plain", "2024-01-03 00:00:00"),
+        (2, "other.txt", 100, "text/plain", "2024-01-02 00:00:00"),
+    ])
+    conn = get_connection(db_path)
+    yield conn.cursor()
+    conn.close()
+
+
+def _all_pages(cursor, limit, **options):
+    """The names on every page in turn, following next_after_id"""
+    pages = []
+    after_id = None
+    while True:
+        rows, after_id = list_files(cursor, 1, after_id=after_id, limit=limit, columns="id, file_name", **options)
+        pages.append([name for _, name in rows])
+        if after_id is None:
+            return pages
+
+
+@pytest.mark.parametrize("sort, descending, expected", [
+    ("size", None, ["e.txt", "b.png", "d.jpg", "c.txt", "a.txt"]),
+    ("size", False, ["a.txt", "c.txt", "d.jpg", "b.png", "e.txt"]),
+    ("timestamp", None, ["e.txt", "d.jpg", "c.txt", "b.png", "a.txt"]),
+    ("name", None, ["a.txt", "b.png", "c.txt", "d.jpg", "e.txt"]),
+])
+def test_pages_with_shared_sort_keys_cover_every_file_once(cursor, sort, descending, expected):
+    for limit in (1, 2, 3, 5):
+        pages = _all_pages(cursor, limit, sort=sort, descending=descending)
+        assert sum(pages, []) == expected
+        assert all(len(page) == limit for page in pages[:-1])
+
+
+def test_paging_stays_stable_when_a_file_is_added(db_path, cursor):
+    rows, after_id = list_files(cursor, 1, sort="size", limit=2, columns="id, file_name")
+    assert [name for _, name in rows] == ["e.txt", "b.png"]
+    # A new file sorting before the position already reached doesn't shift the next page
+    get_writer(db_path).run(lambda write: write.execute(
+        "INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+        "VALUES (1, 'big.bin', 900, 'application/octet-stream', 'Uploaded', '2024-01-04 00:00:00')"))
+    rows, _ = list_files(cursor, 1, sort="size", after_id=after_id, limit=2, columns="id, file_name")
+    assert [name for _, name in rows] == ["d.jpg", "c.txt"]
+
+
+def test_filters_and_counts(cursor):
+    rows, after_id = list_files(cursor, 1, sort="name", file_type="image/*", columns="id, file_name")
+    assert [name for _, name in rows] == ["b.png", "d.jpg"] and after_id is None
+    assert count_files(cursor, 1, file_type="text/plain", max_size=100) == 2
+    assert count_files(cursor, 1, min_size=500) == 2
+    assert count_files(cursor, 2) == 1
+
+
+def test_bad_sort_keys_and_other_users_files_are_refused(cursor):
+    with pytest.raises(ValueError):
+        list_files(cursor, 1, sort="owner")
+    other_id = cursor.execute("SELECT id FROM files WHERE user_id = 2").fetchone()[0]
+    with pytest.raises(ValueError):
+        list_files(cursor, 1, after_id=other_id)
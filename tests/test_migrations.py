@@ -0,0 +1,62 @@
+import base64
+import hashlib
+import pytest
+from cryptography.fernet import Fernet
+from api.database import get_connection
+from api.chunk_store import CHUNK_SIZE, read_file_data, iter_file_data
+from api.schema import SCHEMA_VERSION, create_tables, run_migrations, schema_version, check_query_plans
+from api.search import search_files
+from api.stream_cipher import decrypt_pieces
+
+TEXT = b"quarterly report\n" * 100000
+BINARY = bytes(range(256)) * (CHUNK_SIZE // 256 + 10)
+TOKEN = Fernet(base64.urlsafe_b64encode(hashlib.sha256(b"secret").digest())).encrypt(b"old secret")
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """A database as the first release left it: contents inline in `files`, names not unique"""
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "file_manager.db")
+    conn = get_connection(path)
+    cursor = conn.cursor()
+    create_tables(cursor)
+    cursor.execute("INSERT INTO users (id, username, password) VALUES (1, 'alice', 'x')")
+    for name, file_type, data in (("report.txt", "text/plain", TEXT), ("report.txt", "text/plain", b"again"),
+                                  ("data.bin", "application/octet-stream", BINARY),
+                                  ("secret.txt", "text/plain", TOKEN)):
+        cursor.execute("INSERT INTO files (user_id, file_name, file_data, file_size, file_type, action, timestamp) "
+                       "VALUES (1, ?, ?, ?, ?, 'Uploaded', '2020-01-01 00:00:00')", (name, data, len(data), file_type))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_migrations_move_inline_data_and_keep_contents(legacy_db):
+    assert run_migrations(legacy_db, batch_bytes=CHUNK_SIZE) == SCHEMA_VERSION
+    conn = get_connection(legacy_db)
+    cursor = conn.cursor()
+    assert schema_version(cursor) == SCHEMA_VERSION
+    cursor.execute("SELECT id, file_name FROM files ORDER BY id")
+    files = cursor.fetchall()
+    # The later duplicate got a numbered name
+    assert [name for _, name in files] == ["report.txt", "report (2).txt", "data.bin", "secret.txt"]
+    assert cursor.execute("SELECT COUNT(*) FROM files WHERE file_data IS NOT NULL").fetchone()[0] == 0
+    contents = [read_file_data(cursor, file_id) for file_id, _ in files]
+    assert contents == [TEXT, b"again", BINARY, TOKEN]
+    assert b"".join(decrypt_pieces(iter_file_data(cursor, files[3][0]), "secret")) == b"old secret"
+    # Existing text files were indexed for search
+    assert [row[1] for row in search_files(cursor, 1, "quarterly")] == ["report.txt"]
+    assert check_query_plans(cursor) == []
+    conn.close()
+
+
+def test_migrations_run_once(legacy_db):
+    run_migrations(legacy_db)
+    conn = get_connection(legacy_db)
+    chunks = conn.execute("SELECT COUNT(*), SUM(refcount) FROM chunks").fetchone()
+    conn.close()
+    assert run_migrations(legacy_db) == SCHEMA_VERSION
+    conn = get_connection(legacy_db)
+    assert conn.execute("SELECT COUNT(*), SUM(refcount) FROM chunks").fetchone() == chunks
+    conn.close()
@@ -0,0 +1,18 @@
+from api.database import get_connection
+from api.schema import check_query_plans
+
+
+def test_hot_queries_use_their_indexes(db_path):
+    conn = get_connection(db_path)
+    assert check_query_plans(conn.cursor()) == []
+    conn.close()
+
+
+def test_missing_index_is_reported(db_path):
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    cursor.execute("DROP INDEX idx_files_user_time")
+    problems = check_query_plans(cursor)
+    assert len(problems) == 1 and problems[0].startswith("file listing:")
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,92 @@
+import os
+import hashlib
+import pytest
+from api.chunk_store import CHUNK_SIZE
+
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    """The Flask app on a database of its own, logged in as a fresh user
+
+    The app keeps its database in the working directory, so it stays in
+    this one for all the tests here.
+    """
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp("resumable"))
+        from api.index import app
+        client = app.test_client()
+        credentials = {"username": "alice", "password": "secret"}
+        client.post("/api/register", json=credentials)
+        session_id = client.post("/api/login", json=credentials).get_json()["session_id"]
+        client.environ_base["HTTP_COOKIE"] = f"session_id={session_id}"
+        yield client
+
+
+def _open(client, name):
+    response = client.post("/api/uploads", json={"filename": name}).get_json()
+    assert response["success"]
+    return response["upload_id"]
+
+
+def _put(client, upload_id, number, data, sha256=None):
+    headers = {"X-Content-SHA256": sha256} if sha256 else {}
+    return client.put(f"/api/uploads/{upload_id}/parts/{number}", data=data, headers=headers).get_json()
+
+
+def _download(client, name):
+    response = client.get(f"/api/download?filename={name}")
+    assert response.status_code == 200
+    return response.data
+
+
+def test_parts_sent_out_of_order_are_assembled_in_order(client):
+    parts = [os.urandom(CHUNK_SIZE + 100), os.urandom(CHUNK_SIZE), os.urandom(1000)]
+    upload_id = _open(client, "out-of-order.bin")
+    for number in (3, 1, 2):
+        assert _put(client, upload_id, number, parts[number - 1])["success"]
+    listed = client.get(f"/api/uploads/{upload_id}").get_json()["parts"]
+    assert [part["part_number"] for part in listed] == [1, 2, 3]
+    completed = client.post(f"/api/uploads/{upload_id}/complete",
+                            json={"parts": [{"part_number": part["part_number"], "sha256": part["sha256"]}
+                                            for part in reversed(listed)]}).get_json()
+    assert completed["success"] and completed["size"] == sum(map(len, parts))
+    assert _download(client, "out-of-order.bin") == b"".join(parts)
+    # The upload is closed
+    assert not client.get(f"/api/uploads/{upload_id}").get_json()["success"]
+
+
+def test_a_missing_part_stops_completion(client):
+    upload_id = _open(client, "gap.bin")
+    _put(client, upload_id, 1, b"first")
+    _put(client, upload_id, 3, b"third")
+    response = client.post(f"/api/uploads/{upload_id}/complete", json={}).get_json()
+    assert not response["success"] and "Missing parts: 2" in response["message"]
+    assert client.delete(f"/api/uploads/{upload_id}").get_json()["success"]
+
+
+def test_a_retried_part_replaces_the_earlier_copy(client):
+    upload_id = _open(client, "retried.bin")
+    _put(client, upload_id, 1, b"stale first part")
+    _put(client, upload_id, 2, b" and the second")
+    retried = _put(client, upload_id, 1, b"first part")
+    assert retried["sha256"] == hashlib.sha256(b"first part").hexdigest()
+    listed = client.get(f"/api/uploads/{upload_id}").get_json()["parts"]
+    assert [part["size"] for part in listed] == [len(b"first part"), len(b" and the second")]
+    assert client.post(f"/api/uploads/{upload_id}/complete", json={}).get_json()["success"]
+    assert _download(client, "retried.bin") == b"first part and the second"
+
+
+def test_a_part_with_the_wrong_sha256_is_refused_and_the_good_copy_kept(client):
+    upload_id = _open(client, "checked.bin")
+    good = _put(client, upload_id, 1, b"good part", hashlib.sha256(b"good part").hexdigest())
+    assert good["success"]
+    bad = _put(client, upload_id, 1, b"corrupted!", good["sha256"])
+    assert not bad["success"] and "X-Content-SHA256" in bad["message"]
+    listed = client.get(f"/api/uploads/{upload_id}").get_json()["parts"]
+    assert listed == [{"part_number": 1, "size": len(b"good part"), "sha256": good["sha256"]}]
+    # Listing parts that weren't received is refused too
+    wrong = client.post(f"/api/uploads/{upload_id}/complete",
+                        json={"parts": [{"part_number": 1, "sha256": "0" * 64}]}).get_json()
+    assert not wrong["success"]
+    assert client.post(f"/api/uploads/{upload_id}/complete", json={}).get_json()["success"]
+    assert _download(client, "checked.bin") == b"good part"
@@ -0,0 +1,80 @@
+import os
+import pytest
+from api.chunk_store import iter_chunks, store_file_data, read_file_data, append_chunk, discard_stage, sweep_stages
+from api.database import get_connection, get_writer
+from api.rewrite import encrypt_contents, decrypt_contents, apply_rewrite, commit_rewrite
+from api.stream_cipher import is_stream_encrypted
+
+
+def _new_file(cursor, data):
+    cursor.execute("INSERT INTO users (username, password) VALUES ('alice', 'x')")
+    user_id = cursor.lastrowid
+    cursor.execute("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                   "VALUES (?, 'a.txt', ?, 'text/plain', 'Uploaded', '')", (user_id, len(data)))
+    file_id = cursor.lastrowid
+    store_file_data(cursor, file_id, iter_chunks(data))
+    return user_id, file_id
+
+
+def _count(cursor, table):
+    return cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+@pytest.fixture
+def stored(db_path):
+    """A user's text file of a few chunks; yields (writer, read cursor, user id, file id, contents)"""
+    writer = get_writer(db_path)
+    data = b"some text to encrypt\n" * 200000 + os.urandom(1000)
+    user_id, file_id = writer.run(_new_file, data)
+    conn = get_connection(db_path)
+    yield writer, conn.cursor(), user_id, file_id, data
+    conn.close()
+
+
+def test_encrypt_and_decrypt_in_place(stored):
+    writer, cursor, user_id, file_id, data = stored
+    rewrite = encrypt_contents(cursor, writer.submit, file_id, user_id, "secret")
+    # Staged, but not yet the file's contents
+    assert read_file_data(cursor, file_id) == data
+    assert _count(cursor, "staged_chunks") == rewrite.chunks
+    commit_rewrite(writer.submit, rewrite)
+    assert is_stream_encrypted(read_file_data(cursor, file_id))
+    assert _count(cursor, "staged_chunks") == 0
+    assert _count(cursor, "file_keys") == 1
+
+    commit_rewrite(writer.submit, decrypt_contents(cursor, writer.submit, file_id, user_id, "secret"))
+    assert read_file_data(cursor, file_id) == data
+    assert _count(cursor, "file_keys") == 0
+
+
+def test_wrong_password_leaves_file_alone(stored):
+    writer, cursor, user_id, file_id, data = stored
+    commit_rewrite(writer.submit, encrypt_contents(cursor, writer.submit, file_id, user_id, "secret"))
+    encrypted = read_file_data(cursor, file_id)
+    with pytest.raises(Exception):
+        decrypt_contents(cursor, writer.submit, file_id, user_id, "wrong")
+    assert read_file_data(cursor, file_id) == encrypted
+    assert _count(cursor, "staged_chunks") == 0
+
+
+def test_swap_refused_after_concurrent_change(stored):
+    writer, cursor, user_id, file_id, data = stored
+    chunks = _count(cursor, "chunks")
+    rewrite = encrypt_contents(cursor, writer.submit, file_id, user_id, "secret")
+    writer.run(append_chunk, file_id, 1000, b"appended meanwhile")
+    with pytest.raises(ValueError):
+        commit_rewrite(writer.submit, rewrite, apply_rewrite)
+    assert read_file_data(cursor, file_id) == data + b"appended meanwhile"
+    assert _count(cursor, "staged_chunks") == 0
+    # The staged chunks were released, and nothing but the appended one is referenced
+    assert cursor.execute("SELECT COUNT(*) FROM chunks WHERE refcount > 0").fetchone()[0] == chunks + 1
+
+
+def test_stale_stages_are_swept(stored):
+    writer, cursor, user_id, file_id, data = stored
+    rewrite = encrypt_contents(cursor, writer.submit, file_id, user_id, "secret")
+    assert sweep_stages(writer.run) == 0
+    assert sweep_stages(writer.run, expiry=-1) == 1
+    assert _count(cursor, "staged_chunks") == 0
+    # Discarding twice is harmless
+    writer.run(discard_stage, rewrite.stage_id)
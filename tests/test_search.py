@@ -0,0 +1,96 @@
+import pytest
+from api.chunk_store import iter_chunks, store_file_data
+from api.database import get_connection, get_writer
+from api.schema import SCHEMA_VERSION, run_migrations, schema_version, _set_schema_version
+from api.search import FTS5_AVAILABLE, index_file, search_files, _extract_unindexed, _index_existing_files
+
+pytestmark = pytest.mark.skipif(not FTS5_AVAILABLE, reason="SQLite was built without FTS5")
+
+
+def _add_file(cursor, user_id, name, file_type, data, timestamp="2024-01-01 00:00:00"):
+    cursor.execute("INSERT OR IGNORE INTO users (id, username, password) VALUES (?, ?, 'x')",
+                   (user_id, f"user{user_id}"))
+    cursor.execute("INSERT INTO files (user_id, file_name, file_size, file_type, action, timestamp) "
+                   "VALUES (?, ?, ?, ?, 'Uploaded', ?)", (user_id, name, len(data), file_type, timestamp))
+    file_id = cursor.lastrowid
+    store_file_data(cursor, file_id, iter_chunks(data))
+    return file_id
+
+
+def _add_files(cursor, files):
+    return [_add_file(cursor, *file) for file in files]
+
+
+def _names(results):
+    return [row[1] for row in results]
+
+
+@pytest.fixture
+def unindexed(db_path):
+    """Files stored before the search index existed, with the schema back at version 3"""
+    writer = get_writer(db_path)
+    writer.run(_add_files, [
+        (1, "notes.txt", "text/plain", b"meeting about the quarterly budget\n" * 500),
+        (1, "budget.csv", "text/csv", b"item,amount\nrent,100\n"),
+        (1, "photo.jpg", "image/jpeg", b"\xff\xd8 budget"),
+        (2, "budget-other.txt", "text/plain", b"someone else's quarterly budget"),
+    ])
+    writer.run(lambda cursor: cursor.execute("DELETE FROM files_fts"))
+    writer.run(_set_schema_version, 3)
+    return db_path
+
+
+def test_migration_indexes_existing_files(unindexed):
+    assert run_migrations(unindexed, batch_bytes=1) == SCHEMA_VERSION
+    conn = get_connection(unindexed)
+    cursor = conn.cursor()
+    assert schema_version(cursor) == SCHEMA_VERSION
+    assert cursor.execute("SELECT COUNT(*) FROM files_fts").fetchone()[0] == 4
+    # Contents of text files are searchable; binary files only by name
+    assert _names(search_files(cursor, 1, "quarterly")) == ["notes.txt"]
+    assert _names(search_files(cursor, 1, "rent")) == ["budget.csv"]
+    assert _names(search_files(cursor, 1, "jpeg")) == ["photo.jpg"]
+    conn.close()
+
+
+def test_migration_keeps_entries_indexed_meanwhile(unindexed):
+    conn = get_connection(unindexed)
+    batch = _extract_unindexed(conn.cursor(), 1024 * 1024, 0)
+    conn.close()
+    texts, _, after_id = batch
+    assert len(texts) == 4 and after_id == texts[-1][0]
+
+    writer = get_writer(unindexed)
+    notes_id = texts[0][0]
+    writer.run(index_file, notes_id, "rewritten since")
+    assert writer.run(_index_existing_files, batch)[0] == 4
+    conn = get_connection(unindexed)
+    cursor = conn.cursor()
+    assert _names(search_files(cursor, 1, "rewritten")) == ["notes.txt"]
+    assert search_files(cursor, 1, "meeting") == []
+    conn.close()
+
+
+def test_search_puts_name_matches_first_and_sees_only_the_users_files(db_path):
+    writer = get_writer(db_path)
+    ids = writer.run(_add_files, [
+        (1, "budget.txt", "text/plain", b"numbers"),
+        (1, "minutes.txt", "text/plain", b"we went over the budget again"),
+        (1, "budget-2023.txt", "text/plain", b"older numbers"),
+        (2, "budget.txt", "text/plain", b"budget"),
+    ])
+    for file_id, text in zip(ids, ["numbers", "we went over the budget again", "older numbers", "budget"]):
+        writer.run(index_file, file_id, text)
+
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    # Name matches newest first, then the content match, with the hit marked in the snippet
+    results = search_files(cursor, 1, "budg")
+    assert _names(results) == ["budget-2023.txt", "budget.txt", "minutes.txt"]
+    assert "[budget]" in results[2][5]
+    assert _names(search_files(cursor, 1, "budget", limit=1)) == ["budget-2023.txt"]
+    # Every word must match; FTS5 syntax in the query is just punctuation
+    assert _names(search_files(cursor, 1, 'older "numbers*')) == ["budget-2023.txt"]
+    assert search_files(cursor, 1, "*:()") == []
+    assert _names(search_files(cursor, 2, "budget")) == ["budget.txt"]
+    conn.close()
@@ -0,0 +1,77 @@
+import time
+import pytest
+from api.database import get_connection, get_writer
+from api.sessions import SQLiteSessionStore, MemorySessionStore, create_session_store, _session_key
+
+
+def _set_expiry(cursor, session_id, expires):
+    cursor.execute("UPDATE sessions SET expires = ? WHERE key = ?", (expires, _session_key(session_id)))
+
+
+@pytest.fixture
+def store(db_path):
+    return SQLiteSessionStore(db_path, lifetime=3600)
+
+
+def test_sessions_are_shared_through_the_database(db_path, store):
+    session_id = store.create(1, "alice")
+    other_worker = SQLiteSessionStore(db_path, lifetime=3600)
+    assert other_worker.get_cached(session_id) is None
+    assert other_worker.get(session_id)["username"] == "alice"
+    assert other_worker.get_cached(session_id)["user_id"] == 1
+    assert store.get("not a session") is None and store.get(None) is None
+
+
+def test_expired_sessions_are_refused_and_swept(db_path, store):
+    session_id = store.create(1, "alice")
+    get_writer(db_path).run(_set_expiry, session_id, time.time() - 1)
+    # A database lookup sees the expiry at once; another worker's cached copy would be trusted for its TTL
+    assert store.load(session_id) is None
+    assert SQLiteSessionStore(db_path, cache_ttl=0).get(session_id) is None
+    assert store.sweep() == 1
+    conn = get_connection(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 0
+    conn.close()
+
+
+def test_sessions_are_renewed_past_half_their_lifetime(db_path, store):
+    session_id = store.create(1, "alice")
+    soon = time.time() + 60
+    get_writer(db_path).run(_set_expiry, session_id, soon)
+    assert store.load(session_id)["expires"] > time.time() + 3000
+    # The renewal is queued without waiting; writes run in order, so once this one has it is in
+    get_writer(db_path).run(lambda cursor: None)
+    conn = get_connection(db_path)
+    expires = conn.execute("SELECT expires FROM sessions WHERE key = ?", (_session_key(session_id),)).fetchone()[0]
+    assert expires > soon
+    conn.close()
+
+
+def test_logout_drops_the_session_from_the_cache(db_path, store):
+    session_id = store.create(1, "alice")
+    other_worker = SQLiteSessionStore(db_path, lifetime=3600, cache_ttl=0.2)
+    assert other_worker.get(session_id) is not None
+    store.delete(session_id)
+    # Gone at once where the logout happened, and from the database
+    assert store.get_cached(session_id) is None
+    assert store.get(session_id) is None
+    # Elsewhere the cached copy lasts no longer than the cache TTL
+    time.sleep(0.25)
+    assert other_worker.get(session_id) is None
+    assert store.stats()["sessions"] == 0
+
+
+def test_memory_sessions_expire_and_log_out():
+    store = create_session_store("memory")
+    assert isinstance(store, MemorySessionStore)
+    session_id = store.create(1, "alice")
+    assert store.get(session_id)["username"] == "alice"
+    store.delete(session_id)
+    assert store.get(session_id) is None
+
+    short = MemorySessionStore(lifetime=0.05)
+    session_id = short.create(1, "alice")
+    time.sleep(0.1)
+    assert short.get(session_id) is None
+    with pytest.raises(ValueError):
+        create_session_store("redis")
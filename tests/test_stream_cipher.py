@@ -0,0 +1,83 @@
+import base64
+import struct
+import hashlib
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from api.database import get_connection, get_writer
+from api.envelope import new_data_key, store_data_key, encrypt_with_data_key, key_resolver
+from api.kdf import SALT_SIZE, KdfParams
+from api.stream_cipher import (MAGIC, ENVELOPE_VERSION, encrypt_stream, encrypt_with_password, decrypt_pieces,
+                               parse_header, plaintext_size)
+
+# Spans several segments and ends mid-segment
+DATA = bytes(range(256)) * 1000 + b"tail"
+# Cheap scrypt parameters, so the tests don't spend their time deriving keys
+FAST_KDF = KdfParams("scrypt", 10, 8, 1, 0)
+
+
+def _pieces(data, size=70000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_version_1_layout_written_by_hand_still_decrypts():
+    # The stored format, built here from its description rather than by encrypt_stream
+    key = hashlib.sha256(b"secret").digest()
+    prefix = b"\x01" * 7
+    header = MAGIC + struct.pack(">BI7s", 1, 16, prefix)
+    segments = [DATA[i:min(i + 16, 100)] for i in range(0, 100, 16)]
+    stored = header + b"".join(
+        AESGCM(key).encrypt(prefix + struct.pack(">IB", index, index == len(segments) - 1), segment, header)
+        for index, segment in enumerate(segments))
+    assert b"".join(decrypt_pieces(_pieces(stored, 7), "secret")) == DATA[:100]
+    assert plaintext_size(len(stored), parse_header(stored)) == 100
+
+
+def test_version_1_round_trip():
+    stored = b"".join(encrypt_stream(_pieces(DATA), hashlib.sha256(b"secret").digest(), b"", version=1))
+    assert parse_header(stored).version == 1
+    assert b"".join(decrypt_pieces(_pieces(stored), "secret")) == DATA
+
+
+def test_version_2_round_trip_and_wrong_password():
+    stored = b"".join(encrypt_with_password(_pieces(DATA), "secret", b"s" * SALT_SIZE, params=FAST_KDF))
+    header = parse_header(stored)
+    assert header.version == 2
+    assert plaintext_size(len(stored), header) == len(DATA)
+    assert b"".join(decrypt_pieces(_pieces(stored), "secret")) == DATA
+    with pytest.raises(InvalidTag):
+        b"".join(decrypt_pieces(_pieces(stored), "wrong"))
+
+
+@pytest.mark.parametrize("damage", ["truncate", "drop last segment", "flip"])
+def test_damaged_stream_fails_to_authenticate(damage):
+    stored = b"".join(encrypt_stream(_pieces(DATA), hashlib.sha256(b"secret").digest(), b"", version=1))
+    if damage == "truncate":
+        stored = stored[:-1]
+    elif damage == "drop last segment":
+        stored = stored[:-(len(DATA) % 65536 + 16)]
+    else:
+        stored = stored[:100] + bytes([stored[100] ^ 1]) + stored[101:]
+    with pytest.raises(InvalidTag):
+        b"".join(decrypt_pieces(_pieces(stored), "secret"))
+
+
+def test_version_3_envelope_round_trip(db_path):
+    writer = get_writer(db_path)
+    data_key, key_row = new_data_key(7, 1, "secret", b"s" * SALT_SIZE)
+    writer.run(store_data_key, key_row)
+    stored = b"".join(encrypt_with_data_key(_pieces(DATA), data_key, key_row))
+    assert parse_header(stored).version == ENVELOPE_VERSION
+
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+    assert b"".join(decrypt_pieces(_pieces(stored), "secret", key=key_resolver(cursor, "secret", scope=1))) == DATA
+    with pytest.raises(Exception):
+        b"".join(decrypt_pieces(_pieces(stored), "wrong", key=key_resolver(cursor, "wrong", scope=1)))
+    conn.close()
+
+
+def test_legacy_fernet_token():
+    token = Fernet(base64.urlsafe_b64encode(hashlib.sha256(b"secret").digest())).encrypt(DATA)
+    assert b"".join(decrypt_pieces(_pieces(token), "secret")) == DATA